@@ -0,0 +1,429 @@
+#####################################################################################
+## geoparser_benchmark.py
+## Throughput and accuracy benchmark for the two geoparsers over the test set of
+## known coordinates (test_set_full.csv). Each engine is run in its own process
+## so start-up cost and peak memory can be measured separately:
+##  "re"        - findCoordinates (jmap_geoparser_re.py)
+##  "pyparsing" - findCoordinates (jmap_geoparser.py), with the fast build
+##  "pyparsing-grammar" - the same with the pyparsing elements of the grammar
+##                (fast=False)
+##  "re-bytes"  - iterCoordinatesBytes (jmap_geoparser_re.py), scanning the
+##                UTF-8 bytes rather than decoded text
+##  "re-fullscan", "pyparsing-fullscan" - parser_re.finditer with GeoConvert, and
+##                coordinateParser.searchString with coordinate.calcDD: no degree
+##                mark prefilter, and one coordinate at a time
+## All of them normalize the marks in the text first (jmap_geocommon.py);
+## re-bytes only normalizes the text it decodes around the degree marks.
+##
+## For each engine it reports strings/sec, per-string latency percentiles, peak
+## memory, and accuracy checked the way geoparser_testing.py checks it: strings
+## not parsed (the geoparser made no match at all), strings it made a match in
+## but gave no coordinates for, and coordinates that don't match the known
+## values to 2 decimal places.
+## With --articles the engines are run over the body text of every article XML
+## file under a directory instead, to time them on full articles. There are no
+## known coordinates there, so instead of accuracy it reports how many
+## coordinates were found and a digest of them: engines that find exactly the
+## same coordinates have the same digest.
+## With --adversarial they are run over generated texts of the kind that make
+## a geoparser slow instead: OCR-garbled tables packed with numbers, degree,
+## minute and second marks and quotes. The figure to watch there is the
+## worst-case scan time per KB of text.
+## --packrat sets the packrat cache policy of the PyParsing engines (see
+## jmap_geoparser.py), e.g. "lru:4096", and the report gives the cache's
+## hit rate, to weigh throughput against memory for each policy.
+## Results can be saved as JSON and compared against an earlier run; the run
+## fails (exit code 1) if it regressed by more than the allowed threshold.
+##
+## Usage:
+##   python geoparser_benchmark.py
+##   python geoparser_benchmark.py --output bench.json
+##   python geoparser_benchmark.py --compare bench.json --threshold 0.1
+##   python geoparser_benchmark.py --articles /path/to/xml --engines re,re-fullscan
+##   python geoparser_benchmark.py --engines pyparsing-grammar --packrat lru:256
+##   python geoparser_benchmark.py --adversarial 50 --output adversarial.json
+#####################################################################################
+
+import os, sys, csv, json, math, hashlib, fnmatch, random
+import argparse
+import multiprocessing
+import platform
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+engineNames = ['re', 'pyparsing']
+fullScanEngines = ['re-fullscan', 'pyparsing-fullscan']
+grammarEngines = ['pyparsing-grammar']
+bytesEngines = ['re-bytes']
+
+
+def loadTestSet(path):
+    # Known latitude, known longitude and the coordinate string, as bytes
+    with open(path, 'rb') as f:
+        return [(float(row[0]), float(row[1]), row[2]) for row in csv.reader(f)]
+
+
+def loadArticles(path):
+    # The text jmapParseXML geoparses from each article XML file under path,
+    # as UTF-8 bytes; there are no known coordinates for these
+    from jmap_ingest import decodeArticleXML, readArticleXML
+    rows = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(fnmatch.filter(files, '*.xml')):
+            with open(os.path.join(root, name), 'rb') as f:
+                xml = f.read()
+            doc = readArticleXML(decodeArticleXML(xml)[0])
+            text = doc.formatData and doc.formatData.text
+            if text:
+                rows.append((None, None, text.encode('utf-8')))
+    return rows
+
+
+# What adversarial texts are made of, by kind: each text strings together
+# random picks from one of these
+adversarialPieces = {
+    'table':   [u'12', u'1', u'45', u'180', u'3.5', u'07', u'\xb0', u"'", u'"', u"''", u' ', u'\xb0'],
+    'marks':   [u"'", u'"', u"''", u'\u2032', u'\u2033', u'\xb0', u'\xba', u' ', u'1', u'12'],
+    'degrees': [u'1\xb0', u'1\xb0 ', u'12\xb01', u'deg', u' deg ', u'&deg;', u'5 degrees'],
+    'words':   [u'N ', u'S', u'lat ', u'LONG. ', u'1', u'12\xb0', u' ', u'E', u'by ', u'and ', u'Latitude: '],
+    'digits':  [u'1', u'2', u'3', u' ', u'.', u'5', u'|', u'\xb0'],
+    'dashes':  [u'-', u'\u2013', u'\u2212', u'1', u'\xb0', u' ', u'12'],
+}
+
+
+def makeAdversarial(count, size=16384, seed=0):
+    """
+    Generate count texts of about size characters of garbled tables, the
+    kinds in adversarialPieces in turn, as UTF-8 bytes in the row format of
+    loadArticles. The same seed always gives the same texts.
+    """
+    rng = random.Random(seed)
+    kinds = sorted(adversarialPieces)
+    rows = []
+    for i in xrange(count):
+        pieces = adversarialPieces[kinds[i % len(kinds)]]
+        text = []
+        length = 0
+        while length < size:
+            text.append(rng.choice(pieces))
+            length += len(text[-1])
+        rows.append((None, None, u''.join(text).encode('utf-8')))
+    return rows
+
+
+def peakMemoryKB():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes on OS X, kilobytes elsewhere
+        rss = rss // 1024
+    return rss
+
+
+def loadEngine(engine, packrat=None):
+    """
+    Import one geoparser and return (parserVersion, parse), where parse(s)
+    turns a UTF-8 coordinate string into (coords, matched): a list of
+    (latitude, longitude), and the number of matches the geoparser made.
+    packrat ("policy" or "policy:size") sets the PyParsing packrat cache.
+    """
+    from jmap_geocommon import normalizeMarks
+    if engine in ('re', 're-bytes', 're-fullscan'):
+        import jmap_geoparser_re as geo
+        def parseFullscan(s):
+            coords = []
+            matched = 0
+            for match in geo.parser_re.finditer(normalizeMarks(s.decode('utf-8'))[0]):
+                matched += 1
+                parts = geo.GeoCleanup(match.groupdict())
+                if not parts: break
+                lat, lon = geo.GeoConvert(*parts)
+                coords.append((float(lat), float(lon)))
+            return coords, matched
+    elif engine in ('pyparsing', 'pyparsing-grammar', 'pyparsing-fullscan'):
+        import jmap_geoparser as geo
+        if packrat:
+            policy, _, size = packrat.partition(':')
+            geo.packratPolicy = policy
+            if size:
+                geo.packratCacheSize = int(size)
+            geo.usePackrat()
+        def parseFullscan(s):
+            coords = []
+            found = geo.coordinateParser.searchString(normalizeMarks(s.decode('utf-8'))[0].encode('utf-8'))
+            for coord in found:
+                dd = geo.coordinate(coord).calcDD()
+                coords.append((float(dd['latitude']), float(dd['longitude'])))
+            return coords, len(found)
+    else:
+        raise ValueError("Unknown geoparser engine: %s" % engine)
+    if engine.endswith('-fullscan'):
+        return geo.parserVersion, parseFullscan
+    if engine == 're-bytes':
+        scanText = geo.iterCoordinatesBytes
+    elif engine == 'pyparsing-grammar':
+        scanText = lambda s: geo.iterCoordinates(s.decode('utf-8'), fast=False)
+    else:
+        scanText = lambda s: geo.iterCoordinates(s.decode('utf-8'))
+    def parse(s):
+        scan = scanText(s)
+        return [(coord.latitude, coord.longitude) for coord in scan], scan.matched
+    return geo.parserVersion, parse
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of an already sorted list
+    if not values:
+        return None
+    k = max(0, min(len(values)-1, int(math.ceil(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+
+def benchmarkEngine(engine, rows, repeat, packrat=None):
+    """
+    Run one engine over the test set (or article texts) `repeat` times and
+    return its results. Accuracy is counted on the first pass; timings cover
+    every pass. Accuracy is None for article texts, and the packrat cache
+    use None for the re engines.
+    """
+    baseMemory = peakMemoryKB()
+    start = timer()
+    version, parse = loadEngine(engine, packrat)
+    loadTime = timer() - start
+
+    errors = 0  # strings the engine raised an error for
+    notParsed = 0  # strings the engine made no match in
+    noCoordinates = 0  # strings it made a match in but gave no coordinates for
+    mismatched = 0
+    matched = 0
+    found = 0
+    digest = hashlib.sha1()
+    latencies = []
+    worstPerKB = 0.0  # slowest scan, in seconds per KB of text
+    total = 0.0
+    for n in xrange(repeat):
+        for latitude, longitude, coordString in rows:
+            start = timer()
+            try:
+                coords, matches = parse(coordString)
+            except Exception:
+                coords, matches = [], 0
+                errors += not n
+            elapsed = timer() - start
+            latencies.append(elapsed)
+            total += elapsed
+            if coordString:
+                worstPerKB = max(worstPerKB, elapsed * 1024 / len(coordString))
+            if n: continue
+            found += len(coords)
+            digest.update(repr(coords))
+            if latitude is None: continue
+            if not matches:
+                notParsed += 1
+            elif not coords:
+                noCoordinates += 1
+            for lat, lon in coords:
+                if round(lat, 2) == round(latitude, 2) and round(lon, 2) == round(longitude, 2):
+                    matched += 1
+                else:
+                    mismatched += 1
+
+    cache = None
+    cacheStats = None
+    if engine.startswith('pyparsing'):
+        import jmap_geoparser as geo
+        cacheStats = geo.packratCacheStats()  # None where pyparsing doesn't count them
+    if cacheStats is not None:
+        hits, misses = cacheStats
+        cache = {'policy': geo.packratPolicy,
+                 'size': geo.packratCacheSize if geo.packratPolicy == 'lru' else None,
+                 'hits': hits,
+                 'misses': misses,
+                 'hit_pct': 100.0 * hits / (hits + misses) if hits + misses else None}
+    latencies.sort()
+    textBytes = repeat * sum(len(row[2]) for row in rows)
+    if rows and rows[0][0] is None:
+        accuracy = None
+    else:
+        accuracy = {'tested': len(rows),
+                    'not_parsed': notParsed,
+                    'no_coordinates': noCoordinates,
+                    'mismatched': mismatched,
+                    'matched': matched,
+                    'not_parsed_pct': 100.0 * notParsed / len(rows),
+                    'mismatched_pct': 100.0 * mismatched / len(rows)}
+    return {'version': version,
+            'load_seconds': loadTime,
+            'strings': len(latencies),
+            'seconds': total,
+            'strings_per_sec': len(latencies) / total if total else None,
+            'mb_per_sec': textBytes / total / 1048576 if total else None,
+            'latency_ms': dict((name, 1000 * percentile(latencies, p)) for name, p in
+                               [('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)]),
+            'worst_ms_per_kb': 1000 * worstPerKB,
+            'peak_memory_kb': peakMemoryKB(),
+            'import_memory_kb': baseMemory,
+            'errors': errors,
+            'coordinates': found,
+            'coordinates_digest': digest.hexdigest(),
+            'accuracy': accuracy,
+            'packrat': cache}
+
+
+def _benchmarkWorker(engine, rows, repeat, packrat, queue):
+    try:
+        queue.put(benchmarkEngine(engine, rows, repeat, packrat))
+    except:
+        queue.put(None)  # so runBenchmark isn't left waiting
+        raise
+
+
+def runBenchmark(engines, testSet, repeat=1, isolate=True, articles=None, packrat=None, adversarial=None):
+    """
+    Benchmark each engine over the test set, or over the texts of the
+    articles under `articles` or `adversarial` generated texts if given,
+    each in a fresh process unless isolate is False, and return the results
+    as a dict ready to be saved. packrat sets the PyParsing packrat cache
+    policy (see loadEngine).
+    """
+    if adversarial:
+        rows = makeAdversarial(adversarial)
+        testSet = 'adversarial-%d' % adversarial
+    elif articles:
+        rows = loadArticles(articles)
+        testSet = os.path.abspath(articles)
+    else:
+        rows = loadTestSet(testSet)
+    results = {'test_set': os.path.basename(testSet),
+               'strings': len(rows),
+               'repeat': repeat,
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'date': datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S'),
+               'engines': {}}
+    for engine in engines:
+        if isolate:
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=_benchmarkWorker, args=(engine, rows, repeat, packrat, queue))
+            p.start()
+            results['engines'][engine] = queue.get()
+            p.join()
+            if results['engines'][engine] is None:
+                raise RuntimeError("Benchmark of the %s engine failed" % engine)
+        else:
+            results['engines'][engine] = benchmarkEngine(engine, rows, repeat, packrat)
+    return results
+
+
+def formatReport(results):
+    known = engineNames + grammarEngines + bytesEngines + fullScanEngines
+    engines = [e for e in known if e in results['engines']] + \
+              sorted(e for e in results['engines'] if e not in known)
+    def fmt(value, spec):
+        return 'n/a' if value is None else spec % value
+    lines = ["Geoparser benchmark: %d strings from %s x %d, Python %s" %
+             (results['strings'], results['test_set'], results['repeat'], results['python']),
+             "%-28s" % '' + ''.join("%22s" % e for e in engines)]
+    def row(label, get, spec):
+        lines.append("%-28s" % label + ''.join("%22s" % fmt(get(results['engines'][e]), spec) for e in engines))
+    row("Strings/sec", lambda r: r['strings_per_sec'], '%.1f')
+    row("MB/sec", lambda r: r.get('mb_per_sec'), '%.3f')
+    row("Latency p50 (ms)", lambda r: r['latency_ms']['p50'], '%.4f')
+    row("Latency p90 (ms)", lambda r: r['latency_ms']['p90'], '%.4f')
+    row("Latency p99 (ms)", lambda r: r['latency_ms']['p99'], '%.4f')
+    row("Latency max (ms)", lambda r: r['latency_ms']['max'], '%.4f')
+    row("Worst ms/KB", lambda r: r.get('worst_ms_per_kb'), '%.3f')
+    row("Engine load (s)", lambda r: r['load_seconds'], '%.3f')
+    row("Peak memory (MB)", lambda r: r['peak_memory_kb'] and r['peak_memory_kb'] / 1024.0, '%.1f')
+    row("Coordinates found", lambda r: r.get('coordinates'), '%d')
+    row("Errors", lambda r: r.get('errors'), '%d')
+    row("Coordinates digest", lambda r: r.get('coordinates_digest') and r['coordinates_digest'][:12], '%s')
+    accuracy = lambda key: lambda r: r['accuracy'] and r['accuracy'][key]
+    row("Not parsed", accuracy('not_parsed'), '%d')
+    row("Not parsed (%)", accuracy('not_parsed_pct'), '%.2f')
+    row("Matched, no coordinates", lambda r: r['accuracy'] and r['accuracy'].get('no_coordinates'), '%d')
+    row("Mismatched coordinates", accuracy('mismatched'), '%d')
+    row("Mismatched (%)", accuracy('mismatched_pct'), '%.2f')
+    row("Matched coordinates", accuracy('matched'), '%d')
+    row("Packrat cache", lambda r: r.get('packrat') and r['packrat']['policy'] + (':%d' % r['packrat']['size'] if r['packrat']['size'] else ''), '%s')
+    row("Packrat hit rate (%)", lambda r: r.get('packrat') and r['packrat']['hit_pct'], '%.1f')
+    return "\n".join(lines)
+
+
+def compareResults(results, baseline, threshold=0.1, accuracyThreshold=0):
+    """
+    Compare a run against a baseline run and return a list of regressions:
+    throughput, p90 latency or peak memory (and for adversarial texts the
+    worst-case time per KB) worse by more than `threshold` (a fraction), or
+    more than `accuracyThreshold` extra strings not parsed or mismatched
+    coordinates. Engines missing from either run are skipped.
+    """
+    regressions = []
+    for engine, new in sorted(results['engines'].items()):
+        old = baseline.get('engines', {}).get(engine)
+        if not old or baseline.get('test_set') != results['test_set']:
+            continue
+        if new['strings_per_sec'] < old['strings_per_sec'] * (1 - threshold):
+            regressions.append("%s: throughput %.1f strings/sec, was %.1f" % (engine, new['strings_per_sec'], old['strings_per_sec']))
+        if new['latency_ms']['p90'] > old['latency_ms']['p90'] * (1 + threshold):
+            regressions.append("%s: p90 latency %.4f ms, was %.4f" % (engine, new['latency_ms']['p90'], old['latency_ms']['p90']))
+        if new['peak_memory_kb'] and old['peak_memory_kb'] and new['peak_memory_kb'] > old['peak_memory_kb'] * (1 + threshold):
+            regressions.append("%s: peak memory %d KB, was %d" % (engine, new['peak_memory_kb'], old['peak_memory_kb']))
+        if results['test_set'].startswith('adversarial') and old.get('worst_ms_per_kb') and \
+           new['worst_ms_per_kb'] > old['worst_ms_per_kb'] * (1 + threshold):
+            regressions.append("%s: worst case %.3f ms/KB, was %.3f" % (engine, new['worst_ms_per_kb'], old['worst_ms_per_kb']))
+        if not (new['accuracy'] and old['accuracy']):
+            continue
+        for key in ('not_parsed', 'mismatched'):
+            if new['accuracy'][key] > old['accuracy'][key] + accuracyThreshold:
+                regressions.append("%s: %s %d, was %d" % (engine, key.replace('_', ' '), new['accuracy'][key], old['accuracy'][key]))
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark the regular expression and PyParsing geoparsers over a test set of known coordinates.")
+    ap.add_argument('--engines', default=','.join(engineNames), help="comma-separated engines to run, from %s (default: %%(default)s)" % ', '.join(engineNames + grammarEngines + bytesEngines + fullScanEngines))
+    ap.add_argument('--test-set', default=os.path.join(scriptDir, 'test_set_full.csv'), help="CSV of latitude, longitude, coordinate string")
+    ap.add_argument('--articles', help="directory of article XML files to run the engines over instead of the test set")
+    ap.add_argument('--adversarial', type=int, metavar='COUNT', help="run the engines over this many generated garbled-table texts instead of the test set")
+    ap.add_argument('--repeat', type=int, default=1, help="number of passes over the test set for timing")
+    ap.add_argument('--output', help="save the results to this JSON file")
+    ap.add_argument('--compare', help="JSON results of an earlier run to check for regressions")
+    ap.add_argument('--threshold', type=float, default=0.1, help="allowed fractional slowdown/memory growth before a run fails (default: %(default)s)")
+    ap.add_argument('--accuracy-threshold', type=int, default=0, help="allowed extra not-parsed or mismatched strings (default: %(default)s)")
+    ap.add_argument('--packrat', help="packrat cache policy for the PyParsing engines: document, lru[:size] or off (default: as set in jmap_geoparser.py)")
+    ap.add_argument('--no-isolate', action='store_true', help="run the engines in this process (peak memory is then shared)")
+    args = ap.parse_args(argv)
+
+    engines = [e.strip() for e in args.engines.split(',') if e.strip()]
+    results = runBenchmark(engines, args.test_set, args.repeat, isolate=not args.no_isolate, articles=args.articles, packrat=args.packrat, adversarial=args.adversarial)
+    print formatReport(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print "Results saved to " + args.output
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compareResults(results, baseline, args.threshold, args.accuracy_threshold)
+        print ""
+        if regressions:
+            print "Regressions against " + args.compare + ":"
+            for r in regressions:
+                print "  " + r
+            return 1
+        print "No regressions against " + args.compare
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
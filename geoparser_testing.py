@@ -1,152 +1,180 @@
 #parser_testing.py
-import os, sys, re, StringIO
+import os, sys, re
 import unicodecsv, csv
 sys.path.append('/Users/Jason/Dropbox/JournalMap/scripts/GeoParsers')
 
-class UnicodeWriter(object):
-    """
-    Like UnicodeDictWriter, but takes lists rather than dictionaries.
-    
-    Usage example:
-    
-    fp = open('my-file.csv', 'wb')
-    writer = UnicodeWriter(fp)
-    writer.writerows([
-        [u'Bob', 22, 7],
-        [u'Sue', 28, 6],
-        [u'Ben', 31, 8],
-        # \xc3\x80 is LATIN CAPITAL LETTER A WITH MACRON
-        ['\xc4\x80dam'.decode('utf8'), 11, 4],
-    ])
-    fp.close()
-    """
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        # Redirect output to a queue
-        self.queue = StringIO.StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
-        self.stream = f
-        self.encoding = encoding
-    
-    def writerow(self, row):
-        # Modified from original: now using unicode(s) to deal with e.g. ints
-        self.writer.writerow([unicode(s).encode("utf-8") for s in row])
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = data.encode(self.encoding)
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
-    
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
-
+# Geoparsers to test, as named on the command line (pyparsing, re), or both.
+# Only those are imported.
+geoparsers = sys.argv[1:] or ['pyparsing', 're']
 
 ##########################################################################################
 ###### Parse the test file using the Pyparsing GeoParser
 ##########################################################################################
 
-from jmap_geoparser import *
-
-## Set up the output file
-outDir = '/Users/Jason/Dropbox/JournalMap/scripts/GeoParsers'
-resultsFile = outDir + '/pyparsing_results.csv'
-of = open(resultsFile, 'wb')
-writer=UnicodeWriter(of)
-writer.writerow([u'inLat',u'inLong','outLat','outLong','coord_string',u'parse_error'])
-
-## Load the CSV file of the manually-entered coordinates from JournalMap
-notParsed = 0
-badParse = 0
-total = 0
-with open('test_set_full.csv', 'rb') as f:
-#with open('test_set4.csv', 'rb') as f:
-    reader = csv.reader(f)
-    for row in reader:
-        total+=1
-        latitude = row[0]
-        longitude = row[1]
-        coord_string = row[2]
-        print coord_string
-        coords = coordinateParser.searchString(coord_string)
-        if coords: print "test"
-        try:
-            assert coords
-        except:
-            #print "Coordinate not captured: " + coord_string
-            writer.writerow([latitude,longitude,'','',coord_string.decode('utf-8'),"Coordinate not parsed"])
-            notParsed+=1
-        for coord in coords:        
-            coordDD = coordinate(coord).calcDD
+if 'pyparsing' in geoparsers:
+    from jmap_geoparser import iterCoordinates
+
+    ## Set up the output file
+    outDir = '/Users/Jason/Dropbox/JournalMap/scripts/GeoParsers'
+    resultsFile = outDir + '/pyparsing_results.csv'
+    of = open(resultsFile, 'wb')
+    writer=unicodecsv.writer(of)
+    writer.writerow([u'inLat',u'inLong','outLat','outLong','coord_string',u'parse_error'])
+
+    ## Load the CSV file of the manually-entered coordinates from JournalMap
+    notParsed = 0  # strings the parser made no match in
+    noCoords = 0  # strings it made a match in but gave no coordinates for
+    badParse = 0
+    total = 0
+    with open('test_set_full.csv', 'rb') as f:
+    #with open('test_set4.csv', 'rb') as f:
+        reader = csv.reader(f)
+        for row in reader:
+            total+=1
+            latitude = row[0]
+            longitude = row[1]
+            coord_string = row[2]
+            print coord_string
+            coord_text = coord_string.decode('utf-8')
+            # One pass over the string, which counts the matches as it goes
+            scan = iterCoordinates(coord_text)
+            coords = list(scan)
+            if coords: print "test"
+            if scan.matched and not coords: noCoords+=1
             try:
-                assert (round(coordDD()['latitude'],2)==round(float(latitude),2) and round(coordDD()['longitude'],2)==round(float(longitude),2))
+                assert scan.matched > 0
             except:
-                #print "Error parsing coordinate " + coord_string
-                writer.writerow([latitude,longitude,coordDD()['latitude'],coordDD()['longitude'],coord_string.decode('utf-8'),"Parsed coordinates do not match original"])
-                badParse+=1
-            #print str(coordDD()) + ";  " + "{'latitude': "+latitude+", 'longitude': "+longitude+"}"
+                #print "Coordinate not captured: " + coord_string
+                writer.writerow([latitude,longitude,'','',coord_text,"Coordinate not parsed"])
+                notParsed+=1
+            for coord in coords:        
+                try:
+                    assert (round(coord.latitude,2)==round(float(latitude),2) and round(coord.longitude,2)==round(float(longitude),2))
+                except:
+                    #print "Error parsing coordinate " + coord_string
+                    writer.writerow([latitude,longitude,unicode(coord.latitude),unicode(coord.longitude),coord_text,"Parsed coordinates do not match original"])
+                    badParse+=1
+                #print coord.text + ";  " + "{'latitude': "+latitude+", 'longitude': "+longitude+"}"
     
-of.close()
-print ""
-print "PyParsing GeoParser Results"
-print "Total number of locations tested: "+str(total)
-print "Number of locations not parsed: "+str(notParsed)+" ("+str((100.0*notParsed)/total)+"%)"
-print "Number of locations where parsed coords do not match input: "+str(badParse)+" ("+str((100.0*badParse)/total)+"%)"
+    of.close()
+    print ""
+    print "PyParsing GeoParser Results"
+    print "Total number of locations tested: "+str(total)
+    print "Number of locations not parsed: "+str(notParsed)+" ("+str((100.0*notParsed)/total)+"%)"
+    print "Number of locations matched but giving no coordinates: "+str(noCoords)
+    print "Number of locations where parsed coords do not match input: "+str(badParse)+" ("+str((100.0*badParse)/total)+"%)"
 
 
 ##########################################################################################
 ###### Repeat parsing of text file using the RegEx GeoParser
 ##########################################################################################
 
-from jmap_geoparser_re import *
-
-## Set up the output file
-outDir = '/Users/Jason/Dropbox/JournalMap/scripts/GeoParsers'
-resultsFile = outDir + '/RegExParsing_results.csv'
-of = open(resultsFile, 'wb')
-writer=UnicodeWriter(of)
-writer.writerow([u'inLat',u'inLong','outLat','outLong','coord_string',u'parse_error'])
-
-## Load the CSV file of the manually-entered coordinates from JournalMap
-notParsed = 0
-badParse = 0
-total = 0
-with open('test_set_full.csv', 'rb') as f:
-#with open('test_set4.csv', 'rb') as f:
-    reader = csv.reader(f)
-    for row in reader:
-        total+=1
-        latitude = row[0]
-        longitude = row[1]
-        coord_string = row[2]
-        print coord_string
-        matches = parser_re.finditer(coord_string.decode('utf-8'))
-        coords = len(parser_re.findall(coord_string.decode('utf-8')))
-        try:
-            assert coords > 0
-        except:
-            #print "Coordinate not captured: " + coord_string
-            writer.writerow([latitude,longitude,'','',coord_string.decode('utf-8'),"Coordinate not parsed"])
-            notParsed+=1
-        for match in matches:        
-            t = match.group()
-            t2 = GeoCleanup(match.groupdict())
-            if not t2: break
-            coordDD = GeoConvert(t2[0], t2[1], t2[2], t2[3], t2[4], t2[5], t2[6], t2[7])
+if 're' in geoparsers:
+    from jmap_geoparser_re import iterCoordinates
+
+    ## Set up the output file
+    outDir = '/Users/Jason/Dropbox/JournalMap/scripts/GeoParsers'
+    resultsFile = outDir + '/RegExParsing_results.csv'
+    of = open(resultsFile, 'wb')
+    writer=unicodecsv.writer(of)
+    writer.writerow([u'inLat',u'inLong','outLat','outLong','coord_string',u'parse_error'])
+
+    ## Load the CSV file of the manually-entered coordinates from JournalMap
+    notParsed = 0  # strings the parser made no match in
+    noCoords = 0  # strings it made a match in but gave no coordinates for
+    badParse = 0
+    total = 0
+    with open('test_set_full.csv', 'rb') as f:
+    #with open('test_set4.csv', 'rb') as f:
+        reader = csv.reader(f)
+        for row in reader:
+            total+=1
+            latitude = row[0]
+            longitude = row[1]
+            coord_string = row[2]
+            print coord_string
+            coord_text = coord_string.decode('utf-8')
+            # One pass over the string, which counts the matches as it goes
+            scan = iterCoordinates(coord_text)
+            coords = list(scan)
+            if scan.matched and not coords: noCoords+=1
             try:
-                #assert (round(coordDD()['latitude'],2)==round(float(latitude),2) and round(coordDD()['longitude'],2)==round(float(longitude),2))
-                assert (round(float(coordDD[0]),2)==round(float(latitude),2) and round(float(coordDD[1]),2)==round(float(longitude),2))
+                assert scan.matched > 0
             except:
-                #print "Error parsing coordinate " + coord_string
-                writer.writerow([latitude,longitude,coordDD[0],coordDD[1],coord_string.decode('utf-8'),"Parsed coordinates do not match original"])
-                badParse+=1
+                #print "Coordinate not captured: " + coord_string
+                writer.writerow([latitude,longitude,'','',coord_text,"Coordinate not parsed"])
+                notParsed+=1
+            for coord in coords:        
+                try:
+                    assert (round(coord.latitude,2)==round(float(latitude),2) and round(coord.longitude,2)==round(float(longitude),2))
+                except:
+                    #print "Error parsing coordinate " + coord_string
+                    writer.writerow([latitude,longitude,u'%.5f' % coord.latitude,u'%.5f' % coord.longitude,coord_text,"Parsed coordinates do not match original"])
+                    badParse+=1
     
-of.close()
+    of.close()
+    print ""
+    print "RegEx Geoparser Results"
+    print "Total number of locations tested: "+str(total)
+    print "Number of locations not parsed: "+str(notParsed)+" ("+str((100.0*notParsed)/total)+"%)"
+    print "Number of locations matched but giving no coordinates: "+str(noCoords)
+    print "Number of locations where parsed coords do not match input: "+str(badParse)+" ("+str((100.0*badParse)/total)+"%)"
+
+
+##########################################################################################
+###### Check the RegEx GeoParser's degree mark prefilter against a full scan
+##########################################################################################
+
+# GeoFinditer has to give exactly the matches (spans and groups) parser_re.finditer
+# gives. Besides the test set, these are cases where the prefilter once started a
+# match at a different place: digits or punctuation before a LAT/LONG word.
+prefilterCases = [u"site 2 lat 45\u00b030'N, 120\u00b015'W",
+                  u"4 LAT4degrees4N,5degrees4",
+                  u"plot 3: long 110\u00b05'W, 45\u00b012'N",
+                  u"table 1. 2 latitude 12\u00b030' S 130\u00b045' E"]
+
+if 're' in geoparsers:
+    from jmap_geoparser_re import parser_re, GeoFinditer
+    from jmap_geocommon import normalizeMarks
+
+    with open('test_set_full.csv', 'rb') as f:
+        texts = [row[2].decode('utf-8') for row in csv.reader(f)] + prefilterCases
+    differ = 0
+    for text in texts:
+        norm = normalizeMarks(text)[0]
+        full = [(m.span(), m.groupdict()) for m in parser_re.finditer(norm)]
+        prefiltered = [(m.span(), m.groupdict()) for m in GeoFinditer(norm)]
+        if prefiltered != full:
+            print "Prefilter differs from a full scan: " + text.encode('utf-8')
+            differ+=1
+
+    print ""
+    print "RegEx Geoparser Prefilter Check"
+    print "Strings checked against a full scan: "+str(len(texts))
+    print "Number of strings where the prefiltered matches differ: "+str(differ)
+
+
+##########################################################################################
+###### Check that article files in other encodings are read as they were written
+##########################################################################################
+
+# decodeArticleXML converts a file to UTF-8 and the parser has to read it as
+# UTF-8, whatever its XML declaration said: (declared encoding, title, body text)
+decodeCases = [('ISO-8859-1', u'Caf\u00e9 on the Ma\u00f1a', u"At 45\u00b0 12' N, 110\u00b0 5' W"),
+               ('iso-8859-2', u'Caf\u010d v \u0141odzi', u"At 45\u00b0 12' N, 110\u00b0 5' W"),
+               ('UTF-16', u'Caf\u00e9 \u010d', u"At 45\u00b0 12' N, 110\u00b0 5' W")]
+
+from jmap_ingest import decodeArticleXML, readArticleXML
+
+for encoding, title, body in decodeCases:
+    xml = (u'<?xml version="1.0" encoding="%s"?><article><front><article-meta>'
+           u'<article-id pub-id-type="doi">10.1/decode</article-id><article-title>%s</article-title>'
+           u'</article-meta></front><body><p>%s</p></body></article>' % (encoding, title, body)).encode(encoding)
+    doc = readArticleXML(decodeArticleXML(xml)[0])
+    meta = doc.format.metadata(doc.formatData)
+    assert meta['title'] == title, "%s title read as %r" % (encoding, meta['title'])
+    assert doc.formatData.text.strip() == body, "%s body read as %r" % (encoding, doc.formatData.text)
+
 print ""
-print "RegEx Geoparser Results"
-print "Total number of locations tested: "+str(total)
-print "Number of locations not parsed: "+str(notParsed)+" ("+str((100.0*notParsed)/total)+"%)"
-print "Number of locations where parsed coords do not match input: "+str(badParse)+" ("+str((100.0*badParse)/total)+"%)"
+print "Article Decoding Check"
+print "Declared encodings read back as written: "+", ".join(encoding for encoding, title, body in decodeCases)
@@ -2,92 +2,144 @@
 ## jmapParseXML.py
 ## Parse a directory of publisher XML files to grab the citation information and 
 ## locations needed for JournalMap. Creates a set of CSV import files for JournalMap
-## Includes a log file of results.
+## (or the same tables in an SQLite database or a columnar file, see jmap_output.py).
+## Includes a log file of results, streamed as JSON lines (see jmap_log.py).
+## Zip and tar bundles in the directory are read too (see jmap_archive.py):
+## their XML members are parsed straight out of the archive.
 ##
 ## This importer works with the following XML formats:
 ## "-//NLM//DTD Journal Publishing DTD v2.3 20070202//EN" "journalpublishing.dtd"
 ## "-//NLM/DTD Journal Archiving and interchange DTD v2.2 20060430//EN
 ## "-//NLM//DTD Journal Publishing DTD v3.0 20080202//EN"
+## and Elsevier full-text XML. Each format is an adapter in jmap_formats.py; add
+## one there to read another publisher's XML.
+##
+## Set numWorkers to spread the article parsing over several processes. The
+## main process stays the only writer, so output order matches a serial run.
+## Parsed articles are cached in cacheFile, so reruns only parse files that are
+## new or changed, or everything after the geoparser changes.
+## Each file processed is checkpointed in manifestFile as the run goes. Run with
+## --resume to continue an interrupted run: the output files are cut back to the
+## last checkpoint and appended to, and files already finished are skipped.
+## Output rows are written outputBatchRows at a time, and the files behind them
+## are checkpointed once they are on disk.
+## Set instrumentRun to time each stage of the pipeline for every article (see
+## jmap_instrument.py); the report is written to stagesFile.
+## Files bigger than chunkedScanBytes (theses, data supplements, whole issues)
+## are never held in memory: they are read, parsed and geoparsed a chunk at a
+## time (see streamArticleXML in jmap_ingest.py and iterCoordinatesChunks in
+## the geoparsers), and give the same results as if they had been read whole.
+## Set articleTimeLimit and/or articleMemoryLimit to give each article a budget:
+## articles are then parsed in watched workers (see jmap_workers.py), and one
+## that goes over is stopped, its worker replaced, and the article recorded in
+## the log and manifest with the stage it was stopped in, while the rest of the
+## corpus carries on. With retryWithRegex it is then tried once more with the
+## cheaper "re" geoparser.
+## A progress line (articles, MB and matches per second, errors, queue depth,
+## ETA) is printed every progressSeconds, and with metricsFile set the same
+## numbers and the run's counters are kept in a Prometheus text file for node
+## exporter to scrape (see jmap_telemetry.py).
+##
+## The settings below are the defaults; the common ones can be given on the
+## command line instead (python jmapParseXML.py --help). Only the geoparser
+## selected is imported, once, before any workers are started, so forked
+## workers share its compiled grammar rather than building their own.
 #####################################################################################
 
-import os, sys, re, StringIO
-import fnmatch
-import unicodecsv, csv
+import os, sys, re
+import fnmatch, argparse, importlib
+import itertools, multiprocessing, threading, hashlib
 
 from decimal import Decimal, setcontext, ExtendedContext
 from datetime import datetime
-from bs4 import BeautifulSoup
-from bs4 import UnicodeDammit
+from jmap_ingest import decodeArticleXML, readArticleXML, decodePathNames, feedSize, readUTF8Chunks, streamArticleXML, ingestVersion
+from jmap_cache import ResultCache
+from jmap_manifest import RunManifest
+from jmap_log import RunLog
+from jmap_archive import isArchive, memberPath, iterArchive, listArchive
+from jmap_output import CSVSink, SQLiteSink, ColumnarSink
+from jmap_workers import WatchedPool, Retry, enterStage
+from jmap_telemetry import RunTelemetry
+import jmap_instrument
+from jmap_instrument import StageTimer, StageReport, noTimer
 sys.path.append('C:/Users/jasokarl/Dropbox/JournalMap/scripts/GeoParsers')
 
 startDir = 'C:/Users/jasokarl/Google Drive/JournalMap/Elsevier/RSE'
 #startDir = '/Volumes/XML Storage/TandF/journal_of_natural_history/processed'
 articlesFile = startDir + '/articles.csv'
 locationsFile = startDir + '/locations.csv'
-logFile = startDir + '/jmap_parse.log'
+outputFormat = "csv" # Output written: "csv" (articlesFile and locationsFile), "sqlite" (outputDatabase) or "columnar" (columnarFile)
+outputDatabase = startDir + '/jmap_output.sqlite' # articles and locations tables, when outputFormat is "sqlite"
+columnarFile = startDir + '/jmap_output.zip' # articles and locations stored by column, when outputFormat is "columnar"
+outputBatchRows = 500 # Output rows buffered before they are written out and checkpointed
+logFile = startDir + '/jmap_parse.jsonl' # Log of the run, one JSON record per line
+logLevel = "info" # Lowest level of record written to logFile: "debug" (adds every coordinate found), "info", "warning" or "error"
+consoleLevel = "warning" # Lowest level of record also printed as the run goes
+cacheFile = startDir + '/jmap_cache.sqlite' # Cache of parsed articles so reruns skip files that haven't changed ('' for no cache)
+manifestFile = startDir + '/jmap_manifest.csv' # Checkpoint of every file processed, used to resume an interrupted run
+readArchives = True # Also parse the XML files inside zip and tar bundles found in startDir
 collectionKeyword = "" # Add special keyword for organizing into a collection
 allArticles = False  # Include all articles (True) or only articles that have parsed locations in the output (False)?
 geoparser = "re" # Which geoparser to use: "re" (Regular Expression) or "pyparsing"
+numWorkers = 1 # Number of worker processes parsing articles: 1 parses in this process, 0 uses one per CPU core
+workerChunkSize = 8 # Number of articles handed to a worker at a time when numWorkers != 1
+cacheMaxEntries = 0 # Most articles kept in the cache; the least recently used are dropped first (0 = no limit)
+cacheMaxVersions = 2 # Number of geoparser versions/settings kept in the cache; older ones are dropped
+resumeRun = False # Carry on from where an interrupted run stopped instead of starting over (or run with --resume)
+instrumentRun = False # Record the wall/CPU time and bytes of each pipeline stage for every article
+stagesFile = startDir + '/jmap_parse_stages.json' # Stage report of an instrumented run
+slowestArticles = 20 # Number of slowest articles named in the stage report
+chunkedScanBytes = 64 * 1024 * 1024 # Files bigger than this are read and geoparsed in chunks rather than whole (0 = never)
+articleTimeLimit = 0 # Most seconds a worker may spend on one article before it is stopped and replaced (0 = no limit)
+articleMemoryLimit = 0 # Most MB of memory a worker may use on one article before it is stopped and replaced (0 = no limit; read from /proc)
+retryWithRegex = False # Parse an article stopped for going over its budget again with the "re" geoparser
+progressSeconds = 10 # Seconds between progress lines (throughput, errors, queue depth, ETA) printed as the run goes (0 = none)
+metricsFile = '' # Prometheus text file of the run's counters and rates, for node exporter's textfile collector ('' for none)
+metricsSeconds = 15 # Seconds between rewrites of metricsFile
+windowTimeLimit = None # Most seconds the re geoparser spends in front of one degree mark (None = no limit; a limit makes the output depend on machine load)
+documentTimeLimit = None # Most seconds the re geoparser spends scanning one article (None = no limit; a limit makes the output depend on machine load)
 
-if geoparser == "re":
-    from jmap_geoparser_re import *  # Regular Expression Parser Version
-else:
-    from jmap_geoparser import *  # PyParsing version    
+geoparserModules = {"re": "jmap_geoparser_re",  # Regular Expression Parser Version
+                    "pyparsing": "jmap_geoparser"}  # PyParsing version
+# Settings holding the path of a file in startDir
+startDirFiles = ['articlesFile', 'locationsFile', 'outputDatabase', 'columnarFile', 'logFile', 'cacheFile', 'manifestFile', 'stagesFile', 'metricsFile']
+# Settings the workers read, handed to them when they start in case they
+# don't inherit this process's globals (Windows starts workers afresh)
+workerSettings = ['geoparser', 'cacheFile', 'collectionKeyword', 'allArticles', 'instrumentRun', 'chunkedScanBytes', 'windowTimeLimit', 'documentTimeLimit']
 
-class UnicodeWriter(object):
-    """
-    Like UnicodeDictWriter, but takes lists rather than dictionaries.
-    
-    Usage example:
-    
-    fp = open('my-file.csv', 'wb')
-    writer = UnicodeWriter(fp)
-    writer.writerows([
-        [u'Bob', 22, 7],
-        [u'Sue', 28, 6],
-        [u'Ben', 31, 8],
-        # \xc3\x80 is LATIN CAPITAL LETTER A WITH MACRON
-        ['\xc4\x80dam'.decode('utf8'), 11, 4],
-    ])
-    fp.close()
-    """
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        # Redirect output to a queue
-        self.queue = StringIO.StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
-        self.stream = f
-        self.encoding = encoding
-    
-    def writerow(self, row):
-        # Modified from original: now using unicode(s) to deal with e.g. ints
-        self.writer.writerow([unicode(s).encode("utf-8") for s in row])
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = data.encode(self.encoding)
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
-    
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+_engine = None
+
+def loadGeoparser():
+    # The geoparser module `geoparser` selects, imported the first time it's needed
+    global _engine
+    if _engine is None or _engine.__name__ != geoparserModules[geoparser]:
+        _engine = importlib.import_module(geoparserModules[geoparser])
+    if hasattr(_engine, 'windowTimeLimit'):
+        _engine.windowTimeLimit, _engine.documentTimeLimit = windowTimeLimit, documentTimeLimit
+    return _engine
 
 
 class ParseLog(object):
     def __init__(self):
-        self.messages = []
+        self.runlog = None  # RunLog the messages are streamed to
         self.countArticles = 0
         self.countGeoTagged = 0
         self.locations = 0
         self.countErrors = 0
         self.countNoAuthors = 0
+        self.countNoText = 0
         self.countArticlesWritten = 0
+        self.countCached = 0
+        self.countTimedOut = 0
+        self.timedOutFiles = []  # Articles the geoparser gave up on part of
+        self.countStopped = 0
+        self.stoppedFiles = []  # Articles the watchdog stopped, with the limit and stage
+        self.countRetried = 0
+        self.decodePaths = {}  # decodeArticleXML path -> articles decoded that way
+        self.bytesRead = 0  # Bytes of the article files processed
     
-    def add_msg(self, msg):
-        self.messages.append(msg)
+    def add_msg(self, msg, level='info', event='message', **fields):
+        self.runlog.log(level, msg, event, **fields)
 
 
 class Location(object):
@@ -171,263 +223,704 @@ class Article(object):
         return citation
 
 
-#start logging
-log = ParseLog()
-lf = open(logFile,"w")
-lf.write("Starting processing of "+startDir+" on "+datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')+"\n")
-lf.write("Parsing geolocations using "+parserVersion+"\n\n")
+class ArticleResult(object):
+    """
+    Everything parsing one article produces: the CSV lines to write, the
+    messages to print and log, and the ParseLog counters to bump. Workers
+    fill these in and hand them back so that only the writer touches the
+    output files and the ParseLog.
+    """
+    def __init__(self, xmlFile):
+        self.xmlFile = xmlFile
+        self.digest = None  # SHA-1 of the file, the cache key
+        self.size = 0  # Bytes of the file
+        self.cached = False
+        self.messages = []  # (level, event, message, fields) in the order they happened
+        self.articleLine = None
+        self.locationLines = []
+        self.geoTagged = False
+        self.noAuthors = False
+        self.noText = False
+        self.error = False
+        self.timedOut = False  # The geoparser hit its time limit on part of the text
+        self.timeouts = []  # (position, 'window' or 'document') for each time it did
+        self.stopped = None  # (limit, stage) if the watchdog stopped the article's worker
+        self.retried = False  # Parsed again with the re geoparser after being stopped
+        self.stages = None  # StageTimer.stages of an instrumented run
+        self.source = {}  # archive and member, for an article read from an archive
+        self.decodePath = None  # How decodeArticleXML got the file to UTF-8
 
-with open(articlesFile, 'wb') as articlesCSV:
-    with open(locationsFile, 'wb') as locationsCSV:
-        articleWriter = unicodecsv.writer(articlesCSV)
-        articlelines = [['doi','publisher_name','publisher_abbreviation','citation','title','publish_year','first_author','authors_list','volume_issue_pages','volume','issue','start_page','end_page','keywords_list','no_keywords_list','abstract','no_abstract','url']]
-        articleWriter.writerows(articlelines)    
-    
-        locationWriter = unicodecsv.writer(locationsCSV)
-        locationlines = [['doi','title','longitude','latitude','place','no_recorded_place','coordinates','coordinate_type','no_recorded_coordinate','location_type','location_scale','location_reliability','location_conformance','error_type','error_description']]
-        locationWriter.writerows(locationlines)
-    
-        ## Traverse the start directory structure
-        for root, dirs, files in os.walk(startDir):
-            for name in fnmatch.filter(files, '*.xml'):
-                ###############################
-                ## Grab the article XML file ##
-                ############################### 
-                xmlFile = os.path.join(root,name)
-                print("Processing " + xmlFile)
-                log.add_msg("Processing " + xmlFile)
-                log.countArticles += 1
-                
-                ###############################
-                ## Grab the article metadata ##
-                ###############################        
-    
-                # Read the XML
-                f = open(xmlFile)
-                #xmlStr = UnicodeDammit(f.read())
-                #tree = BeautifulSoup(xmlStr.unicode_markup,"lxml")
-                rawtext = UnicodeDammit.detwingle(f.read())
-                tree = BeautifulSoup(rawtext.decode('utf-8','ignore'),"xml")
-                #tree = BeautifulSoup(f.read(),"lxml")
-                f.close()
-                #print tree.prettify()
-
-                #############################################
-                ## Process NLM or JATS-formatted XML files ##
-                #############################################                
-                if tree.find('front'):  # NLM or JATS formatted XML
-                    fmt = "NLM"
-                    # Read the first three elements and create the article object
-                    try: doi = tree.front.find('article-id', {'pub-id-type':'doi'}).text 
-                    except: doi=''
-                    try: title = tree.front.find('article-title').text
-                    except: title=''
-                    try: year = tree.front.find('pub-date').year.text
-                    except: year = ''
-        
-                    article = Article(doi, title, year)
-        
-                    # Add the other single item attributes
-                    try: article.publisher_name = tree.front.find('journal-title').text
-                    except: article.publisher_name = ''            
-                    
-                    try: article.volume = tree.front.find('volume').text
-                    except: article.volume = ''
-                    
-                    try: article.issue = tree.front.find('issue').text
-                    except: article.issue = ''
-                    
-                    try: article.start_page = tree.front.find('fpage').text
-                    except:
-                        try: article.start_page = tree.front.find('elocation-id').text
-                        except: article.start_page = ''
-                        
-                    try: article.end_page = tree.front.find('lpage').text
-                    except: article.end_page = ''
-                    
-                    try:
-                        for a in tree.find_all('abstract'):
-                            if not a.get('abstract-type')=='precis':
-                                article.abstract = a.text
-                            else:
-                                article.abstract = ''
-                        if not article.abstract: article.no_abstract = True
-                    except: 
-                        article.abstract = ''
-                        article.no_abstract = True
-                    
-                    
-                    ###############################
-                    ## Build authors list        ##
-                    ############################### 
-                    try:
-                        for author in tree.find_all('contrib'):
-                            article.add_author(author.find('surname').text + ", " + author.find('given-names').text)
-                        if len(article.authors)==0: raise
-                    except:
-                        print "No authors found for " + xmlFile + ". Skipping this article."
-                        log.add_msg("No authors found for " + xmlFile + ". Skipping this article.")
-                        log.countNoAuthors += 1
-                        continue
-                    
-                    ###############################
-                    ## Build keywords list       ##
-                    ############################### 
-                    if tree.find('kwd'):
-                        for kw in tree.find_all('kwd'):
-                            article.add_keyword(kw.text)
-                    if collectionKeyword: article.add_keyword(collectionKeyword)    
-                    if not article.keywords: no_keywords = True
-
-                ########################################
-                ## Process Elsevier XML files         ##
-                ########################################                
-                elif tree.find('coredata'):
-                    fmt = "Elsevier"
-                    meta = tree.find('coredata')
-                    print 'Elsevier formatted XML for' + xmlFile
-                    # Read the first three elements and create the article object
-                    try: doi = tree.coredata.find('doi').text 
-                    except: doi=''
-                    try: title = tree.coredata.find('title').text
-                    except: title=''
-                    try: year = tree.coredata.find('coverDate').text[:4]
-                    except: year = ''
-        
-                    article = Article(doi, title, year)
-                    
-                    # Add the other single item attributes
-                    try: article.publisher_name = tree.coredata.find('publicationName').text
-                    except: article.publisher_name = ''            
-                    
-                    try: article.volume = tree.coredata.find('volume').text
-                    except: article.volume = ''
-                    
-                    try: article.issue = tree.coredata.find('issueIdentifier').text
-                    except: article.issue = ''
-                    
-                    try: article.start_page = tree.coredata.find('startingPage').text
-                    except: article.start_page = ''
-                        
-                    try: article.end_page = tree.coredata.find('endingPage').text
-                    except: article.end_page = ''                    
-                    
-                    try: 
-                        abs = tree.coredata.find('description').text
-                        if abs[:8] == "Abstract":
-                            article.abstract = abs[8:]
-                        else: 
-                            article.abstract = abs
-                        if not article.abstract: article.no_abstract = True
-                    except: 
-                        article.abstract = ''
-                        article.no_abstract = True                    
-
-                    ###############################
-                    ## Build keywords list       ##
-                    ############################### 
-                    if tree.coredata.find('subject'):
-                        for kw in tree.coredata.find_all('subject'):
-                            article.add_keyword(kw.text)
-                    if collectionKeyword: article.add_keyword(collectionKeyword)    
-                    if not article.keywords: no_keywords = True                    
-                    
-                    ###############################
-                    ## Build authors list        ##
-                    ############################### 
-                    try:
-                        for author in tree.coredata.find_all('creator'):
-                            article.add_author(author.text)
-                        if len(article.authors)==0: raise
-                    except:
-                        print "No authors found for " + xmlFile + ". Skipping this article."
-                        log.add_msg("No authors found for " + xmlFile + ". Skipping this article.")
-                        log.countNoAuthors += 1
-                        continue
-                    
-                else:
-                    fmt = "other"
-                    print 'Unknown XML format...'
-                    
-                
-                ###############################
-                ## parse XML for locations   ##
-                ## and write to CSV file     ##
-                ###############################
+    @property
+    def outcome(self):
+        # What happened to the article, as recorded in the run manifest
+        if self.stopped and not self.retried: return 'stopped'
+        if self.noAuthors: return 'no_authors'
+        if self.noText: return 'no_text'
+        if self.error: return 'error'
+        if self.articleLine: return 'written'
+        return 'skipped'
+
+    def add_msg(self, msg, level='info', event='message', **fields):
+        self.messages.append((level, event, msg, fields))
+
+    @classmethod
+    def from_cache(cls, xmlFile, digest, entry):
+        # Rebuild a result from a ResultCache entry. The file may have moved
+        # since it was cached, so messages get the current path.
+        result = cls(xmlFile)
+        result.digest = digest
+        result.cached = True
+        result.messages = [(level, event, msg.replace(entry['xmlFile'], xmlFile), fields) for level, event, msg, fields in entry['messages']]
+        result.articleLine = entry['articleLine']
+        result.locationLines = entry['locationLines']
+        result.geoTagged = entry['geoTagged']
+        result.noAuthors = entry['noAuthors']
+        result.noText = entry['noText']
+        result.error = entry['error']
+        result.decodePath = entry['decodePath']
+        return result
+
+    def cache(self, cache):
+        cache.put(self.digest, self.xmlFile, self.articleLine, self.locationLines, self.messages, self.geoTagged, self.noAuthors, self.noText, self.error, self.decodePath)
+
+
+class UnreadableArchive(object):
+    # What findXMLFiles gives for an archive it can't read (or can't read to
+    # the end), so the failure is logged and checkpointed like an article's
+    def __init__(self, path, error):
+        self.path = path
+        self.error = error
+
+
+def findXMLFiles(startDir, skip=()):
+    """
+    Walk the directories and files in sorted order so the output order
+    doesn't depend on the file system or on the number of workers. Yields
+    the path of each XML file, and (path, bytes, source) for each XML member
+    of an archive, source being the log fields that say where it came from;
+    an UnreadableArchive after the members read from an archive that fails.
+    Files, members and failed archives in skip are left out; skipped members
+    aren't read.
+    """
+    for root, dirs, files in os.walk(startDir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if fnmatch.fnmatch(name, '*.xml'):
+                if path not in skip: yield path
+            elif readArchives and isArchive(name) and path not in skip:
                 try:
-                    if fmt=='NLM': #NLM/JATS Format
-                        text = " ".join(tree.find('body').stripped_strings)
-                    elif fmt=='Elsevier': #Elsevier Format
-                        text = " ".join(tree.find('originalText').stripped_strings)
-                    else: text = " "
-                    #print text
-                    initlocs = log.locations
-                    if geoparser == "re":
-                        matches = parser_re.finditer(text)
-                        if len(parser_re.findall(text))>0: log.countGeoTagged += 1
-                        for match in matches:
-                            t=match.group()
-                            t2 = GeoCleanup(match.groupdict())
-                            if not t2: break
-                            geodd = GeoConvert(t2[0], t2[1], t2[2], t2[3], t2[4], t2[5], t2[6], t2[7])
-                            if geodd[0] == u'1.00000' and geodd[1] == u'1.00000': break
-                            print "Found coordinate in " + article.doi + ": " + t.encode('ascii','ignore') + ", " + geodd[0] + ", " + geodd[1]
-                            log.add_msg("Found coordinate in " + article.doi + ": " + t.encode('ascii','ignore') + ", " + geodd[0] + ", " + geodd[1])
-                            loc = Location(t,geodd[0],geodd[1])                        
-                            locationLine = [[article.doi,article.title,loc.longitude,loc.latitude,loc.place,loc.no_recorded_place,loc.coordinates,loc.coordinate_type,loc.no_recorded_coordinate,loc.location_type,loc.location_scale,loc.location_reliability,loc.location_conformance,loc.error_type,loc.error_description]]
-                            locationWriter.writerows(locationLine)
-                            log.locations += 1
-                    else:
-                        ## PyParsing geoparser
-                        coords = coordinateParser.searchString(text.encode('utf-8'))
-                        if coords: log.countGeoTagged += 1
-                        for coord in coords:        
-                            coordDD = coordinate(coord).calcDD
-                            print "Found coordinate in " + article.doi + ": " + str(coordDD()) + ", " + str(coordDD()['latitude']) + ", " + str(coordDD()['longitude'])
-                            log.add_msg("Found coordinate in " + article.doi + ": " + str(coordDD()) + ", " + str(coordDD()['latitude']) + ", " + str(coordDD()['longitude']))   
-                            loc = Location(str(coordDD()),coordDD()['latitude'],coordDD()['longitude'])                        
-                            locationLine = [[article.doi,article.title,loc.longitude,loc.latitude,loc.place,loc.no_recorded_place,loc.coordinates,loc.coordinate_type,loc.no_recorded_coordinate,loc.location_type,loc.location_scale,loc.location_reliability,loc.location_conformance,loc.error_type,loc.error_description]]
-                            locationWriter.writerows(locationLine)
-                            log.locations += 1
-                            
-                    articlelocs = log.locations-initlocs
+                    for member, xml in iterArchive(path, '*.xml', skip):
+                        yield memberPath(path, member), xml, {'archive': path, 'member': member}
                 except Exception, e:
-                    print(e)
-                    print "No article text found to parse in " + xmlFile
-                    log.add_msg("No article text found to parse in " + xmlFile)
+                    yield UnreadableArchive(path, str(e))
+
+
+def countXMLFiles(startDir, skip=()):
+    """
+    Number of articles findXMLFiles() gives, without reading them, or None
+    if there is a tar bundle in startDir: counting its members would mean
+    decompressing it all over again.
+    """
+    count = 0
+    for root, dirs, files in os.walk(startDir):
+        for name in files:
+            path = os.path.join(root, name)
+            if fnmatch.fnmatch(name, '*.xml'):
+                if path not in skip: count += 1
+            elif readArchives and isArchive(name) and path not in skip:
+                try:
+                    members = listArchive(path, '*.xml', skip)
+                except Exception:
+                    count += 1  # findXMLFiles gives an UnreadableArchive for it
                     continue
-                
-                
-                ###############################
-                ## Write article to output   ##
-                ###############################
-                if (allArticles or articlelocs>0):
-                    try:
-                        articleLine = [[article.doi,article.publisher_name,'',article.build_citation(),article.title,str(article.year),article.authors[0],article.format_authors(),article.format_volisspg(),article.volume,article.issue,article.start_page,article.end_page,article.format_keywords(),article.no_keywords,article.abstract,article.no_abstract,article.url]]
-                        articleWriter.writerows(articleLine)            
-                        log.countArticlesWritten += 1
-                    except: 
-                        print "Error writing record for " + xmlFile + " - " + article.title
-                        log.add_msg("Error writing record for " + xmlFile + " - " + article.title)
-                        log.countErrors += 1
-                        continue                
-                
+                if members is None:
+                    return None
+                count += len(members)
+    return count
+
+
+def resultKey():
+    # Everything besides the file itself that changes what parseArticle returns
+    return "|".join([loadGeoparser().parserVersion, "ingest %d" % ingestVersion, collectionKeyword, str(allArticles)])
+
+
+_caches = {}
+
+def openCache():
+    # One cache connection per process. Connections inherited from the
+    # parent by forked workers are left alone rather than reused or closed.
+    pid = os.getpid()
+    if pid not in _caches:
+        _caches[pid] = ResultCache(cacheFile, resultKey())
+    return _caches[pid]
+
+
+def fileDigest(path):
+    # SHA-1 of the file at path, read feedSize bytes at a time
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(feedSize), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def initWorker(settings):
+    # Start a worker process with the main process's settings and geoparser
+    globals().update(settings)
+    loadGeoparser()
+
+
+def processArticle(item):
+    """
+    Worker entry point, given a findXMLFiles() item: return the cached
+    ArticleResult if this exact file has already been parsed with the
+    current geoparser and settings, and parse it otherwise.
+    """
+    if isinstance(item, UnreadableArchive):
+        result = ArticleResult(item.path)
+        result.source = {'archive': item.path}
+        result.stages = {}
+        result.add_msg("Can't read archive " + item.path + ": " + item.error, 'error', 'archive_error', error=item.error)
+        result.error = True
+        return result
+    stages = StageTimer() if instrumentRun else noTimer
+    enterStage('read')
+    if isinstance(item, tuple):
+        # An archive member, already read
+        xmlFile, xml, source = item
+        size = len(xml)
+    else:
+        xmlFile, source = item, {}
+        size = os.path.getsize(xmlFile)
+        if chunkedScanBytes and size > chunkedScanBytes:
+            xml = None  # Left for parseArticle to read in chunks
+        else:
+            f = open(xmlFile, 'rb')
+            xml = f.read()
+            f.close()
+    digest = hashlib.sha1(xml).hexdigest() if xml is not None else fileDigest(xmlFile)
+    stages.lap('read', size)
+    if cacheFile:
+        enterStage('cache')
+        entry = openCache().get(digest)
+        stages.lap('cache')
+        if entry is not None:
+            result = ArticleResult.from_cache(xmlFile, digest, entry)
+            result.size = size
+            result.source = source
+            result.stages = stages.stages
+            return result
+    jmap_instrument.activeTimer = stages if instrumentRun else None
+    try:
+        result = parseArticle(xmlFile, xml, stages)
+    finally:
+        jmap_instrument.activeTimer = None
+    result.digest = digest
+    result.size = size
+    result.source = source
+    result.stages = stages.stages
+    return result
+
+
+def stoppedArticle(item, func, limit, stage):
+    """
+    What the watched pool gives for an article whose worker went over its
+    budget (limit 'time', 'memory' or 'crash') in the given stage: a Retry
+    with the re geoparser if retryWithRegex, otherwise an ArticleResult
+    recording where it was stopped.
+    """
+    if func is processArticle and retryWithRegex and geoparser != "re":
+        return Retry(retryArticle, (item, limit, stage))
+    if func is retryArticle:
+        item = item[0]
+    result = ArticleResult(item[0] if isinstance(item, tuple) else item)
+    result.source = item[2] if isinstance(item, tuple) else {}
+    result.stopped = (limit, stage)
+    result.add_msg(stoppedMessage(result.xmlFile, limit, stage) +
+                   (" (and again with the re geoparser)" if func is retryArticle else "") + "; worker replaced",
+                   'error', 'stopped', limit=limit, stage=stage, retried=func is retryArticle)
+    return result
+
+
+def stoppedMessage(xmlFile, limit, stage):
+    if limit == 'time': budget = "time limit of %g s" % articleTimeLimit
+    elif limit == 'memory': budget = "memory limit of %g MB" % articleMemoryLimit
+    else: budget = "worker crash"
+    return "Stopped " + xmlFile + " in the " + stage + " stage (" + budget + ")"
+
+
+def retryArticle(task):
+    """
+    Worker entry point for an article the watchdog stopped: parse it again
+    with the re geoparser, without the cache (the result isn't cached either).
+    """
+    global geoparser, cacheFile
+    item, limit, stage = task
+    saved = geoparser, cacheFile
+    geoparser, cacheFile = "re", ''
+    try:
+        result = processArticle(item)
+    finally:
+        geoparser, cacheFile = saved
+    result.stopped = (limit, stage)
+    result.retried = True
+    result.messages.insert(0, ('warning', 'stopped', stoppedMessage(result.xmlFile, limit, stage) + "; parsed again with the re geoparser",
+                               {'limit': limit, 'stage': stage, 'retried': True}))
+    return result
+
+
+def endOfCoordinates(coord):
+    # The re geoparser gives (1, 1) for what isn't a coordinate; nothing after it is used
+    return geoparser == "re" and coord.latitude == 1.0 and coord.longitude == 1.0
+
+
+def scanArticleFile(xmlFile):
+    """
+    Read the article XML file xmlFile a chunk at a time and geoparse its
+    text as it is parsed, so neither the file nor its text is ever in
+    memory whole. Returns (doc, scan, coords, error): the ArticleStream,
+    the geoparser's scan, the coordinates it gave and the error it raised
+    (or None). Returns None if the file turns out not to be UTF-8.
+    """
+    doc, text = streamArticleXML(readUTF8Chunks(xmlFile))
+    scan = loadGeoparser().iterCoordinatesChunks(text)
+    coords = []
+    error = None
+    try:
+        for coord in scan:
+            coords.append(coord)
+            if endOfCoordinates(coord): break
+    except UnicodeDecodeError:
+        return None
+    except Exception, e:
+        error = e
+    for piece in text:
+        pass  # The rest of the document, for its metadata
+    return doc, scan, coords, error
+
+
+def replayCoordinates(coords, error):
+    # The coordinates scanArticleFile's scan gave, then the error it raised
+    for coord in coords:
+        yield coord
+    if error is not None:
+        raise error
+
+
+def parseArticle(xmlFile, xml, stages=noTimer):
+    """
+    Run the full pipeline for one article XML file (metadata, text
+    extraction, geoparsing) given the file's contents, and return an
+    ArticleResult. Nothing is written here, so this can run in a worker
+    process. Each stage is timed with stages (a StageTimer) if given.
+    With xml None the file is read from xmlFile in chunks and geoparsed as
+    it is parsed (scanArticleFile), which takes the place of the decode,
+    ingest and geoparse stages, unless it isn't UTF-8: then it is read
+    whole after all.
+    """
+    result = ArticleResult(xmlFile)
+    result.add_msg("Processing " + xmlFile, 'info', 'processing')
+    
+    ###############################
+    ## Grab the article metadata ##
+    ###############################        
+
+    streamed = None
+    if xml is None:
+        enterStage('geoparse')
+        streamed = scanArticleFile(xmlFile)
+        if streamed is None:
+            f = open(xmlFile, 'rb')
+            xml = f.read()
+            f.close()
+        else:
+            doc = streamed[0]
+            result.decodePath = 'utf-8'
+            stages.lap('geoparse', os.path.getsize(xmlFile))
+    if streamed is None:
+        # Get the file to UTF-8, the slow way only if it isn't already, then
+        # read the XML in one streaming pass (see jmap_ingest.py)
+        enterStage('decode')
+        rawtext, result.decodePath = decodeArticleXML(xml)
+        stages.lap('decode', len(xml))
+        if result.decodePath != 'utf-8':
+            result.add_msg("Converted " + xmlFile + " to UTF-8 (" + result.decodePath + ")", 'info', 'decode', path=result.decodePath)
+        enterStage('ingest')
+        doc = readArticleXML(rawtext)
+        stages.lap('ingest', len(rawtext))
+        del rawtext
+
+    ##########################################################
+    ## Build the article from its format's metadata fields  ##
+    ## (adapters for NLM/JATS, Elsevier, ... in jmap_formats) ##
+    ##########################################################
+    enterStage('metadata')
+    if doc.format is not None:
+        fmt = doc.format.name
+        result.add_msg(fmt + ' formatted XML for ' + xmlFile, 'debug', 'format')
+        meta = doc.format.metadata(doc.formatData)
+        # Read the first three elements and create the article object
+        article = Article(meta['doi'], meta['title'], meta['year'])
+
+        # Add the other single item attributes
+        article.publisher_name = meta['publisher_name']
+        article.volume = meta['volume']
+        article.issue = meta['issue']
+        article.start_page = meta['start_page']
+        article.end_page = meta['end_page']
+        article.abstract = meta['abstract']
+        if not article.abstract: article.no_abstract = True
+        
         ###############################
-        ## Clean up and log errors   ##
+        ## Build authors list        ##
         ############################### 
+        for author in meta['authors']:
+            article.add_author(author)
+        if len(article.authors)==0:
+            result.add_msg("No authors found for " + xmlFile + ". Skipping this article.", 'warning', 'no_authors')
+            result.noAuthors = True
+            stages.lap('metadata')
+            return result
         
+        ###############################
+        ## Build keywords list       ##
+        ############################### 
+        for kw in meta['keywords']:
+            article.add_keyword(kw)
+        if collectionKeyword: article.add_keyword(collectionKeyword)    
+        if not article.keywords: no_keywords = True
+
+    else:
+        fmt = "other"
+        article = None
+        result.add_msg('Unknown XML format...', 'debug', 'format')
+    stages.lap('metadata')
+        
+    
+    ###############################
+    ## parse XML for locations   ##
+    ###############################
+    enterStage('geoparse')
+    try:
+        if article: text = meta['text']
+        else: text = " "
+        if text is None: raise ValueError("No article text element in " + fmt + " XML")
+        #print text
+        # Both geoparsers give CoordinateMatch records (jmap_geocommon.py), with the
+        # span and text of the article text each coordinate was read from
+        if streamed and article and doc.textFormat is not None and doc.formatData is doc.collected[doc.textFormat]:
+            # Already geoparsed as the file was read
+            doc, scan, coords, error = streamed
+            coords = replayCoordinates(coords, error)
+        else:
+            # One lazy pass, which also counts the matches made along the way
+            scan = coords = loadGeoparser().iterCoordinates(text)
+        del doc
+        for coord in coords:
+            if endOfCoordinates(coord): break
+            lat, lon = u'%.5f' % coord.latitude, u'%.5f' % coord.longitude
+            result.add_msg("Found coordinate in " + article.doi + ": " + coord.text.encode('ascii','ignore') + ", " + lat + ", " + lon,
+                           'debug', 'coordinate', latitude=lat, longitude=lon)
+            loc = Location(coord.text, lat, lon)
+            result.locationLines.append([article.doi,article.title,loc.longitude,loc.latitude,loc.place,loc.no_recorded_place,loc.coordinates,loc.coordinate_type,loc.no_recorded_coordinate,loc.location_type,loc.location_scale,loc.location_reliability,loc.location_conformance,loc.error_type,loc.error_description])
+        if scan.matched: result.geoTagged = True
+        if scan.timeouts:
+            result.timedOut = True
+            result.timeouts = list(scan.timeouts)
+            result.add_msg("Scan time limit reached in " + xmlFile + ": " +
+                           ", ".join("%s limit at character %d" % (limit, pos) for pos, limit in scan.timeouts),
+                           'warning', 'timeout', limits=timeoutSummary(result.timeouts),
+                           positions=[[pos, limit] for pos, limit in result.timeouts])
+        if scan.cacheStats:
+            stats = scan.cacheStats
+            result.add_msg("Packrat cache for " + xmlFile + ": %d hits, %d misses, %d entries, peak memory %s KB" %
+                           (stats['hits'], stats['misses'], stats['entries'], stats['peakKB']), 'debug', 'packrat', **stats)
+
+        articlelocs = len(result.locationLines)
+        if not streamed: stages.lap('geoparse', len(text))
+    except Exception, e:
+        result.add_msg("No article text found to parse in " + xmlFile, 'warning', 'no_text', error=str(e))
+        result.noText = True
+        return result
+    
+    
+    ###############################
+    ## Build the article record  ##
+    ###############################
+    if article and (allArticles or articlelocs>0):
+        enterStage('record')
+        try:
+            result.articleLine = [article.doi,article.publisher_name,'',article.build_citation(),article.title,str(article.year),article.authors[0],article.format_authors(),article.format_volisspg(),article.volume,article.issue,article.start_page,article.end_page,article.format_keywords(),article.no_keywords,article.abstract,article.no_abstract,article.url]
+        except: 
+            result.add_msg("Error writing record for " + xmlFile + " - " + article.title, 'error', 'record_error')
+            result.error = True
+        stages.lap('record')
+    
+    return result
+
+
+def outputFiles():
+    # The files outputFormat writes to
+    if outputFormat == "sqlite": return [outputDatabase]
+    if outputFormat == "columnar": return [columnarFile]
+    return [articlesFile, locationsFile]
+
+
+def openSink(offsets=None):
+    # Start the output from scratch, or when resuming cut it back to the
+    # offsets recorded at the last checkpoint and carry on from there
+    if outputFormat == "sqlite":
+        return SQLiteSink(outputDatabase, offsets, outputBatchRows)
+    if outputFormat == "columnar":
+        return ColumnarSink(columnarFile, offsets, outputBatchRows)
+    return CSVSink(articlesFile, locationsFile, offsets, outputBatchRows)
+
+
+def timeoutSummary(timeouts):
+    # The time limits a scan hit and how often, as the manifest records them: "window:2;document:1"
+    counts = {}
+    for pos, limit in timeouts:
+        counts[limit] = counts.get(limit, 0) + 1
+    return ";".join("%s:%d" % (limit, counts[limit]) for limit in ('window', 'document') if limit in counts)
+
+
+def flushOutput(sink, manifest, finished):
+    # Write out the buffered rows, then checkpoint the files they came from
+    sink.flush()
+    for checkpoint in finished:
+        manifest.record(*checkpoint)
+    del finished[:]
+
+
+def writeResult(result, log, sink):
+    """
+    Write one ArticleResult to the output sink and fold it into the ParseLog.
+    Called from the main process only, in file order.
+    """
+    log.countArticles += 1
+    if result.cached: log.countCached += 1
+    for level, event, msg, fields in result.messages:
+        fields = dict(fields, **result.source)
+        log.add_msg(msg, level, event, file=result.xmlFile, **fields)
+    log.bytesRead += result.size
+    if result.noAuthors: log.countNoAuthors += 1
+    if result.noText: log.countNoText += 1
+    if result.decodePath: log.decodePaths[result.decodePath] = log.decodePaths.get(result.decodePath, 0) + 1
+    if result.geoTagged: log.countGeoTagged += 1
+    if result.error: log.countErrors += 1
+    if result.timedOut:
+        log.countTimedOut += 1
+        log.timedOutFiles.append(result.xmlFile)
+    if result.stopped:
+        log.countStopped += 1
+        log.stoppedFiles.append(result.xmlFile + " (" + ":".join(result.stopped) + ")")
+        if result.retried: log.countRetried += 1
+    
+    if result.locationLines:
+        sink.write('locations', result.locationLines)
+        log.locations += len(result.locationLines)
+    
+    if result.articleLine:
+        sink.write('articles', [result.articleLine])
+        log.countArticlesWritten += 1
+
+
+def main(argv=None):
+    global startDir, geoparser, numWorkers, outputFormat, cacheFile, allArticles, resumeRun, instrumentRun
+    global articleTimeLimit, articleMemoryLimit, retryWithRegex, progressSeconds, metricsFile, windowTimeLimit, documentTimeLimit
+    ap = argparse.ArgumentParser(description="Parse a directory of publisher XML files for the citations and coordinates JournalMap imports.")
+    ap.add_argument('startDir', nargs='?', default=startDir,
+                    help="directory of XML files; the output, log, cache and manifest files set to be in it move with it (default: %(default)s)")
+    ap.add_argument('--geoparser', choices=sorted(geoparserModules), default=geoparser, help="geoparser to use (default: %(default)s)")
+    ap.add_argument('--workers', type=int, default=numWorkers, help="worker processes: 1 parses in this process, 0 uses one per CPU core (default: %(default)s)")
+    ap.add_argument('--output-format', choices=['csv', 'sqlite', 'columnar'], default=outputFormat, help="output written (default: %(default)s)")
+    ap.add_argument('--no-cache', action='store_true', help="parse every file, without using or updating the cache")
+    ap.add_argument('--all-articles', action='store_true', default=allArticles, help="also write articles no coordinates were found in")
+    ap.add_argument('--instrument', action='store_true', default=instrumentRun, help="time each stage of the pipeline for every article")
+    ap.add_argument('--resume', action='store_true', default=resumeRun, help="carry on from where an interrupted run stopped")
+    ap.add_argument('--article-timeout', type=float, default=articleTimeLimit, metavar='SECONDS',
+                    help="stop and replace a worker that spends longer than this on one article (default: %(default)s, no limit)")
+    ap.add_argument('--article-memory', type=float, default=articleMemoryLimit, metavar='MB',
+                    help="stop and replace a worker that uses more memory than this on one article (default: %(default)s, no limit)")
+    ap.add_argument('--retry-with-re', action='store_true', default=retryWithRegex,
+                    help="parse an article stopped for going over its budget again with the re geoparser")
+    ap.add_argument('--window-time-limit', type=float, default=windowTimeLimit, metavar='SECONDS',
+                    help="most seconds the re geoparser spends in front of one degree mark (default: no limit; "
+                         "with a limit the output can depend on machine load)")
+    ap.add_argument('--document-time-limit', type=float, default=documentTimeLimit, metavar='SECONDS',
+                    help="most seconds the re geoparser spends scanning one article (default: no limit; "
+                         "with a limit the output can depend on machine load)")
+    ap.add_argument('--progress', type=float, default=progressSeconds, metavar='SECONDS',
+                    help="seconds between progress lines, 0 for none (default: %(default)s)")
+    ap.add_argument('--metrics-file', default=metricsFile, metavar='PATH',
+                    help="keep the run's counters and rates in this Prometheus text file (default: none)")
+    args = ap.parse_args(argv)
+    if args.startDir != startDir:
+        # Files kept in the start directory move with it
+        for name in startDirFiles:
+            if globals()[name].startswith(startDir + '/'):
+                globals()[name] = args.startDir + globals()[name][len(startDir):]
+        startDir = args.startDir
+    geoparser, numWorkers, outputFormat = args.geoparser, args.workers, args.output_format
+    allArticles, instrumentRun, resumeRun = args.all_articles, args.instrument, args.resume
+    articleTimeLimit, articleMemoryLimit, retryWithRegex = args.article_timeout, args.article_memory, args.retry_with_re
+    progressSeconds = args.progress
+    windowTimeLimit, documentTimeLimit = args.window_time_limit, args.document_time_limit
+    if args.metrics_file != metricsFile: metricsFile = args.metrics_file
+    if args.no_cache: cacheFile = ''
+    # Build the geoparser here, before any workers are forked, so they share it
+    parserVersion = loadGeoparser().parserVersion
+    
+    log = ParseLog()
+    manifest = RunManifest(manifestFile)
+    checkpoint = None
+    if resumeRun:
+        manifest.load()
+        checkpoint = manifest.last()
+        if checkpoint and not all(os.path.exists(path) for path in outputFiles()):
+            print "Output files from the interrupted run are missing; starting over."
+            checkpoint = None
+    if checkpoint:
+        try:
+            sink = openSink((checkpoint['articles_offset'], checkpoint['locations_offset']))
+        except ValueError, e:
+            # Output written in another format than the interrupted run's, or cut short
+            print "Can't resume the output of the interrupted run (" + str(e) + "); starting over."
+            checkpoint = None
+    if not checkpoint:
+        sink = openSink()
+    else:
+        # Pick the counters back up from the files already finished
+        for entry in manifest.entries.values():
+            log.countArticles += 1
+            if entry['outcome'] == 'no_authors': log.countNoAuthors += 1
+            if entry['outcome'] == 'error': log.countErrors += 1
+            if entry['outcome'] == 'no_text': log.countNoText += 1
+            log.bytesRead += max(0, int(entry['size']))
+            if entry['timeouts']:
+                log.countTimedOut += 1
+                log.timedOutFiles.append(entry['file'])
+            if entry['stopped']:
+                log.countStopped += 1
+                log.stoppedFiles.append(entry['file'] + " (" + entry['stopped'] + ")")
+                if entry['outcome'] != 'stopped': log.countRetried += 1
+            log.countGeoTagged += entry['geotagged']
+            log.countArticlesWritten += entry['article_rows']
+            log.locations += entry['location_rows']
+        print "Resuming after " + str(log.countArticles) + " articles already processed."
+    
+    #start logging
+    log.runlog = RunLog(logFile, logLevel, consoleLevel, append=checkpoint is not None)
+    if checkpoint:
+        log.add_msg("Resuming processing of " + startDir + " after " + str(log.countArticles) + " articles", 'info', 'start',
+                    start_dir=startDir, parser=parserVersion, resumed_after=log.countArticles)
+    else:
+        log.add_msg("Starting processing of " + startDir, 'info', 'start', start_dir=startDir, parser=parserVersion)
+    manifest.open(append=checkpoint is not None)
+    cache = openCache() if cacheFile else None
+    report = StageReport(slowestArticles) if instrumentRun else None
+    
+    ## Traverse the start directory structure. Articles are parsed
+    ## either here or by a pool of workers; results come back in
+    ## file order and are written from this process only. Files
+    ## finished before an interrupted run stopped are skipped.
+    ## With an article budget set, every article is parsed in a watched
+    ## worker (even with numWorkers = 1) so that it can be stopped.
+    telemetry = RunTelemetry(log, startDir, progressSeconds, metricsFile, metricsSeconds)
+    alreadyDone = set(manifest.entries)
+    telemetry.start(lambda: countXMLFiles(startDir, alreadyDone))
+    xmlFiles = telemetry.dispatching(findXMLFiles(startDir, manifest))
+    settings = dict((name, globals()[name]) for name in workerSettings)
+    inFlight = None
+    if articleTimeLimit or articleMemoryLimit:
+        pool = WatchedPool(numWorkers or multiprocessing.cpu_count(), initWorker, (settings,),
+                           articleTimeLimit or None, articleMemoryLimit or None, stoppedArticle)
+        results = pool.imap(processArticle, xmlFiles)
+    elif numWorkers == 1:
+        pool = None
+        results = itertools.imap(processArticle, xmlFiles)
+    else:
+        pool = multiprocessing.Pool(numWorkers or None, initWorker, (settings,))
+        # The pool takes items as fast as it can; archive members carry their
+        # bytes, so only let a few chunks per worker be handed out at a time
+        inFlight = threading.Semaphore(4 * workerChunkSize * (numWorkers or multiprocessing.cpu_count()))
+        def throttled(items):
+            for item in items:
+                inFlight.acquire()
+                yield item
+        results = pool.imap(processArticle, throttled(xmlFiles), workerChunkSize)
+    
+    finished = []  # Checkpoints of the files whose rows are still buffered
+    for result in results:
+        stages = StageTimer() if report else noTimer
+        written = sink.bytesWritten
+        writeResult(result, log, sink)
+        if inFlight: inFlight.release()
+        finished.append((result.xmlFile, result.outcome, result.geoTagged, int(bool(result.articleLine)), len(result.locationLines)) + sink.position() +
+                        (":".join(result.stopped) if result.stopped else '', timeoutSummary(result.timeouts)))
+        # Checkpoint the files once their rows are safely in the output
+        if sink.full(): flushOutput(sink, manifest, finished)
+        stages.lap('write', sink.bytesWritten - written)
+        if cache:
+            # A scan cut short by the time limit, or stopped by the watchdog, is tried again next run;
+            # an archive that couldn't be read has nothing to cache
+            if result.cached: cache.touch(result.digest)
+            elif not result.timedOut and not result.stopped and result.digest is not None: result.cache(cache)
+            stages.lap('cache_write')
+        if report:
+            result.stages.update(stages.stages)
+            report.add(result.xmlFile, result.stages)
+    
+    flushOutput(sink, manifest, finished)
+    sink.close()
+    telemetry.stop()
+    if pool:
+        pool.close()
+        pool.join()
+    if cache:
+        cacheDropped = cache.trim(cacheMaxEntries, cacheMaxVersions)
+        cacheSize = cache.size()
+        cache.close()
+    manifest.close()
+            
+    ###############################
+    ## Clean up and log errors   ##
+    ############################### 
+    
+    print ""
+    print "Finished!!"
+    print "Processed " + str(log.countArticles) + " articles."
+    print "Errors encountered in " + str(log.countErrors) + " articles."
+    print str(log.countNoAuthors) + " articles had no authors and were skipped."
+    print str(log.countArticlesWritten) + " articles written to " + ", ".join(sink.files)
+    print str(log.countGeoTagged) + " articles had parsed coordinates."
+    print str(log.locations) + " total locations found."
+    if cache:
+        print str(log.countCached) + " articles replayed from the cache (" + str(cacheSize) + " cached, " + str(cacheDropped) + " dropped)."
+    if log.decodePaths:
+        print "Decoding: " + ", ".join(str(log.decodePaths[path]) + " " + path for path in decodePathNames if path in log.decodePaths) + "."
+    if log.countTimedOut:
+        print str(log.countTimedOut) + " articles were only partly scanned (scan time limit reached):"
+        for xmlFile in log.timedOutFiles: print "  " + xmlFile
+    if log.countStopped:
+        print str(log.countStopped) + " articles were stopped for going over their budget (" + str(log.countRetried) + " parsed again with the re geoparser):"
+        for stopped in log.stoppedFiles: print "  " + stopped
+    if report:
+        report.write(stagesFile)
         print ""
-        print "Finished!!"
-        print "Processed " + str(log.countArticles) + " articles."
-        print "Errors encountered in " + str(log.countErrors) + " articles."
-        print str(log.countNoAuthors) + " articles had no authors and were skipped."
-        print str(log.countArticlesWritten) + " articles written to the CSV file"
-        print str(log.countGeoTagged) + " articles had parsed coordinates."
-        print str(log.locations) + " total locations found."
-        for msg in log.messages:
-            lf.write("\n"+msg.encode("UTF-8"))
-        lf.write("\n".join(["","","Finished processing directory "+startDir+" at "+datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S'),"Processed " + str(log.countArticles) + " articles.",
-                           "Errors encountered in " + str(log.countErrors) + str(log.countNoAuthors) + " articles had no authors and were skipped." + str(log.countArticlesWritten) + " articles written to the CSV file" + " articles.", str(log.countGeoTagged) + " articles had parsed coordinates.",str(log.locations) + " total locations found.",
-                           "Created output files:",articlesFile,locationsFile,logFile]))
-        lf.close()  
-        
\ No newline at end of file
+        print "Time per stage, written to " + stagesFile + ":"
+        for line in report.summary(): print line
+    log.runlog.summary("Finished processing directory " + startDir,
+                articles=log.countArticles, errors=log.countErrors, no_authors=log.countNoAuthors,
+                articles_written=log.countArticlesWritten, geotagged=log.countGeoTagged, locations=log.locations,
+                cached=log.countCached, timed_out=log.countTimedOut, timed_out_files=log.timedOutFiles, decode_paths=log.decodePaths,
+                stopped=log.countStopped, stopped_files=log.stoppedFiles, retried=log.countRetried,
+                workers_replaced=pool.restarts if isinstance(pool, WatchedPool) else 0,
+                output_files=sink.files + [logFile] + ([stagesFile] if report else []))
+    log.runlog.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
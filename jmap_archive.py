@@ -0,0 +1,68 @@
+#####################################################################################
+## jmap_archive.py
+## Read article XML straight out of publisher bundles (zip, tar, tar.gz, tgz,
+## tar.bz2) without extracting them to disk. Members are read one at a time:
+## zip members in name order, tar members in the order they are stored, read
+## as a stream so compressed tars are only decompressed once.
+##
+## A member is named as if the archive had been extracted in place, e.g.
+## bundle.zip/journal/article.xml, and that name is used for it everywhere a
+## file path would be (the log, the cache, the run manifest).
+#####################################################################################
+
+import os
+import fnmatch
+import tarfile
+import zipfile
+
+archivePatterns = ['*.zip', '*.tar', '*.tar.gz', '*.tgz', '*.tar.bz2']
+
+
+def isArchive(name):
+    name = name.lower()
+    return any(fnmatch.fnmatch(name, pattern) for pattern in archivePatterns)
+
+
+def memberPath(archive, member):
+    # Name of an archive member as if the archive had been extracted in place
+    return os.path.join(archive, *[part for part in member.split('/') if part not in ('', '.')])
+
+
+def memberFilter(archive, pattern, skip):
+    # Whether a member of archive is one iterArchive() gives
+    def wanted(member):
+        return fnmatch.fnmatch(member.rsplit('/', 1)[-1], pattern) and memberPath(archive, member) not in skip
+    return wanted
+
+
+def iterArchive(archive, pattern='*.xml', skip=()):
+    """
+    Yield (member name, member bytes) for each member of the archive whose
+    file name matches pattern. Members whose memberPath() is in skip are
+    passed over without being read.
+    """
+    wanted = memberFilter(archive, pattern, skip)
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive, 'r') as z:
+            for member in sorted(z.namelist()):
+                if not member.endswith('/') and wanted(member):
+                    yield member, z.read(member)
+    else:
+        # Stream mode: one pass over the (possibly compressed) archive
+        with tarfile.open(archive, 'r|*') as t:
+            for info in t:
+                if info.isfile() and wanted(info.name):
+                    yield info.name, t.extractfile(info).read()
+
+
+def listArchive(archive, pattern='*.xml', skip=()):
+    """
+    The names of the members iterArchive() gives, from a zip's central
+    directory, without reading them. None for a tar: its members can only
+    be found by reading (and decompressing) the whole archive.
+    """
+    if not zipfile.is_zipfile(archive):
+        return None
+    wanted = memberFilter(archive, pattern, skip)
+    with zipfile.ZipFile(archive, 'r') as z:
+        return [member for member in sorted(z.namelist()) if not member.endswith('/') and wanted(member)]
@@ -0,0 +1,141 @@
+#####################################################################################
+## jmap_cache.py
+## On-disk (SQLite) cache of parsed articles for jmapParseXML. Entries are keyed
+## by the SHA-1 of the article file's bytes plus a parser key (the geoparser's
+## parserVersion and any settings that change the output), so a rerun over the
+## same publisher directory only parses files that are new or changed, and
+## everything is parsed again when the geoparser changes.
+##
+## Each entry holds what parsing the article produced: the article CSV row,
+## the location CSV rows, the log messages (level, event, message and fields),
+## the ParseLog flags and how the file was decoded.
+##
+## Any number of processes can read the cache at once; writes (put, touch,
+## trim) are meant to come from one process, jmapParseXML's writer.
+#####################################################################################
+
+import json
+import sqlite3
+import time
+
+cacheFormat = 4  # Bump when the layout of the cached entries changes
+
+schema = """
+CREATE TABLE IF NOT EXISTS results (
+    digest TEXT NOT NULL,
+    parser_key TEXT NOT NULL,
+    xml_file TEXT NOT NULL,
+    article TEXT,
+    locations TEXT NOT NULL,
+    messages TEXT NOT NULL,
+    geotagged INTEGER NOT NULL,
+    no_authors INTEGER NOT NULL,
+    no_text INTEGER NOT NULL,
+    error INTEGER NOT NULL,
+    decode TEXT,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (digest, parser_key)
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+"""
+
+
+class ResultCache(object):
+    """
+    SQLite cache of parsed articles for one parser key.
+
+    Usage example:
+
+    cache = ResultCache(startDir + '/jmap_cache.sqlite', parserVersion)
+    entry = cache.get(digest)
+    if entry is None:
+        ... parse the article ...
+        cache.put(digest, xmlFile, articleLine, locationLines, messages, geoTagged, noAuthors, noText, error, decodePath)
+    cache.close()
+    """
+    def __init__(self, path, parserKey, commitEvery=200):
+        self.path = path
+        self.parserKey = "%d|%s" % (cacheFormat, parserKey)
+        self.commitEvery = commitEvery
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.text_factory = unicode
+        # WAL lets worker processes read while the writer is adding entries
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # A cache written in an older layout is thrown away and rebuilt
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != cacheFormat:
+            self.db.execute("DROP TABLE IF EXISTS results")
+            self.db.execute("PRAGMA user_version=%d" % cacheFormat)
+        self.db.executescript(schema)
+
+    def get(self, digest):
+        """
+        Return the cached entry for the file with this digest as a dict
+        (keys as in put()), or None if it hasn't been parsed with this
+        parser key.
+        """
+        row = self.db.execute("SELECT xml_file, article, locations, messages, geotagged, no_authors, no_text, error, decode FROM results WHERE digest=? AND parser_key=?",
+                              (digest, self.parserKey)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {'xmlFile': row[0],
+                'articleLine': json.loads(row[1]) if row[1] else None,
+                'locationLines': json.loads(row[2]),
+                'messages': [tuple(m) for m in json.loads(row[3])],
+                'geoTagged': bool(row[4]),
+                'noAuthors': bool(row[5]),
+                'noText': bool(row[6]),
+                'error': bool(row[7]),
+                'decodePath': row[8]}
+
+    def put(self, digest, xmlFile, articleLine, locationLines, messages, geoTagged, noAuthors, noText, error, decodePath=None):
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                        (digest, self.parserKey, xmlFile,
+                         json.dumps(articleLine) if articleLine else None,
+                         json.dumps(locationLines), json.dumps(messages),
+                         int(geoTagged), int(noAuthors), int(noText), int(error), decodePath, time.time()))
+        self._written()
+
+    def touch(self, digest):
+        # Mark an entry as used in this run so trim() keeps it
+        self.db.execute("UPDATE results SET last_used=? WHERE digest=? AND parser_key=?",
+                        (time.time(), digest, self.parserKey))
+        self._written()
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.commitEvery:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def trim(self, maxEntries=0, maxVersions=0):
+        """
+        Drop entries for all but the maxVersions most recently used parser
+        keys, then the least recently used entries beyond maxEntries. A limit
+        of 0 means no limit. Returns the number of entries dropped.
+        """
+        before = self.size()
+        if maxVersions:
+            keys = [r[0] for r in self.db.execute("SELECT parser_key FROM results GROUP BY parser_key ORDER BY MAX(last_used) DESC")]
+            for key in keys[maxVersions:]:
+                if key != self.parserKey:
+                    self.db.execute("DELETE FROM results WHERE parser_key=?", (key,))
+        if maxEntries:
+            self.db.execute("DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (maxEntries,))
+        self.commit()
+        return before - self.size()
+
+    def size(self):
+        return self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,155 @@
+#####################################################################################
+## jmap_formats.py
+## Publisher XML formats jmapParseXML can read, as adapters in a registry.
+## Each adapter declares, rather than codes, where its metadata lives:
+##   container - the element whose first occurrence marks a document as this
+##               format; fields are read from inside it
+##   fields    - field name -> the first element inside the container with
+##               that name (and attribute value, and parent, if given)
+##   lists     - list name -> every element of that name (inside the
+##               container, or anywhere in the document)
+##   records   - list name -> every element of that name, with the text of
+##               the first of each of its parts (e.g. a contrib's surname and
+##               given names)
+##   text      - the element whose text is geoparsed
+## and turns what was collected into the article's citation fields in
+## metadata(). jmap_ingest compiles the registry once into a table of element
+## name -> what to do with it, so a document is read in one pass whatever the
+## number of formats, and a format only costs anything on its own elements.
+##
+## To add a format, subclass FormatAdapter and registerFormat() an instance.
+## When a document has the containers of more than one format, the one
+## registered first wins.
+#####################################################################################
+
+from collections import namedtuple
+
+# The first element named `element` with attribute values `attrib` (a dict),
+# inside the first element named `within` if given
+Field = namedtuple('Field', 'element attrib within')
+# Every element named `element`, with the value of its attribute `attrib`
+# if given, inside the container if `scoped`
+List = namedtuple('List', 'element attrib scoped')
+# Every element named `element`, with the text of the first of each of its
+# `parts` inside it (None where it has none)
+Record = namedtuple('Record', 'element parts scoped')
+
+
+def field(element, attrib=None, within=None):
+    return Field(element, attrib, within)
+
+
+class FormatAdapter(object):
+    """
+    One publisher XML format. metadata() gets a FormatData of what the
+    document held and returns the citation fields as a dict:
+    doi, title, year, publisher_name, volume, issue, start_page, end_page,
+    abstract (strings), authors and keywords (lists of strings) and text
+    (the text to geoparse, or None if the document has no text element).
+    An empty author list means the article can't be used.
+    """
+    name = None
+    container = None
+    fields = {}
+    lists = {}
+    records = {}
+    text = None
+
+    def metadata(self, data):
+        raise NotImplementedError
+
+
+class FormatData(object):
+    # What the document held for one format: fields, lists and records by
+    # name, the text element's text, and whether the container was seen
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.seen = False
+        self.fields = {}
+        self.lists = dict((name, []) for name in list(adapter.lists) + list(adapter.records))
+        self.text = None
+
+
+class NLMFormat(FormatAdapter):
+    """
+    NLM/JATS (Journal Publishing and Archiving DTDs); also used by T&F.
+    """
+    name = "NLM"
+    container = 'front'
+    fields = dict((name, field(name)) for name in ('article-title', 'journal-title', 'volume', 'issue', 'fpage', 'elocation-id', 'lpage'))
+    fields.update({'doi': field('article-id', {'pub-id-type': 'doi'}),   # the article-id with pub-id-type="doi"
+                   'year': field('year', within='pub-date')})            # the first <year> of the first <pub-date>
+    lists = {'abstracts': List('abstract', 'abstract-type', False),
+             'keywords': List('kwd', None, False)}
+    records = {'contribs': Record('contrib', ('surname', 'given-names'), False)}
+    text = 'body'
+
+    def metadata(self, data):
+        front = data.fields
+        abstract = ''
+        for abstractType, text in data.lists['abstracts']:
+            abstract = text if abstractType != 'precis' else ''
+        authors = []
+        for surname, given in data.lists['contribs']:
+            if surname is None or given is None:
+                # A contrib without a name means the author list can't be trusted
+                authors = []
+                break
+            authors.append(surname + ", " + given)
+        return {'doi': front.get('doi') or '',
+                'title': front.get('article-title') or '',
+                'year': front.get('year') or '',
+                'publisher_name': front.get('journal-title') or '',
+                'volume': front.get('volume') or '',
+                'issue': front.get('issue') or '',
+                'start_page': front['fpage'] if 'fpage' in front else front.get('elocation-id') or '',
+                'end_page': front.get('lpage') or '',
+                'abstract': abstract,
+                'authors': authors,
+                'keywords': data.lists['keywords'],
+                'text': data.text}
+
+
+class ElsevierFormat(FormatAdapter):
+    """
+    Elsevier full-text XML (the ScienceDirect API's <coredata> and
+    <originalText>).
+    """
+    name = "Elsevier"
+    container = 'coredata'
+    fields = dict((name, field(name)) for name in ('doi', 'title', 'coverDate', 'publicationName', 'volume', 'issueIdentifier', 'startingPage', 'endingPage', 'description'))
+    lists = {'subjects': List('subject', None, True),
+             'creators': List('creator', None, True)}
+    text = 'originalText'
+
+    def metadata(self, data):
+        meta = data.fields
+        abstract = meta.get('description') or ''
+        if abstract[:8] == "Abstract":
+            abstract = abstract[8:]
+        return {'doi': meta.get('doi') or '',
+                'title': meta.get('title') or '',
+                'year': (meta.get('coverDate') or '')[:4],
+                'publisher_name': meta.get('publicationName') or '',
+                'volume': meta.get('volume') or '',
+                'issue': meta.get('issueIdentifier') or '',
+                'start_page': meta.get('startingPage') or '',
+                'end_page': meta.get('endingPage') or '',
+                'abstract': abstract,
+                'authors': data.lists['creators'],
+                'keywords': data.lists['subjects'],
+                'text': data.text}
+
+
+formats = []  # Registered adapters, in order of precedence
+formatsVersion = 0  # Bumped on every change to formats, so compiled tables can tell they're stale
+
+
+def registerFormat(adapter):
+    global formatsVersion
+    formats.append(adapter)
+    formatsVersion += 1
+    return adapter
+
+registerFormat(NLMFormat())
+registerFormat(ElsevierFormat())
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#####################################################################################
+## jmap_geocommon.py
+## Text handling shared by the two geoparsers.
+##
+## Articles write degree, minute and second marks, minus signs and decimal points
+## with many look-alike characters (and some mojibake of them). normalizeMarks
+## maps every variant to one canonical character in a single pass, so the
+## grammars in jmap_geoparser.py and jmap_geoparser_re.py only have to match a
+## small alphabet:
+##   degrees  °     minutes  '     seconds  "     minus  -     dash  –     decimal point  .
+## Dashes are kept apart from minus signs since they mostly mark ranges
+## (48°51′–50°12′ N) rather than negative values.
+## ø (° read as CP437) is not one of the variants: it is mostly just a letter,
+## so only the pyparsing grammar takes it, as it always has.
+## It also returns the offsets needed to map a match in the normalized text back
+## to the text as it appears in the article.
+##
+## Both geoparsers hand back what they find as CoordinateMatch records, one
+## at a time from a CoordinateScan.
+##
+## A ChunkWindow holds the part of a long text, given in chunks, that a
+## geoparser still needs while it scans its way through, so a huge document
+## can be scanned without ever being one string in memory.
+#####################################################################################
+
+import re
+from bisect import bisect_right
+from collections import namedtuple
+
+DEGREE = u'\xb0'
+MINUTE = u"'"
+SECOND = u'"'
+MINUS = u'-'
+DASH = u'\u2013'
+DECIMAL = u'.'
+
+# Single characters written for each mark
+markVariants = {
+    DEGREE: u'\xba\u02da\u0366',  # º ˚, combining ring
+    MINUTE: u'′’‘‛ʹʼ',
+    SECOND: u'″“”‟〞＂ʺ˝',
+    MINUS: u'−',
+    DASH: u'—―‒',
+    DECIMAL: u'·',
+}
+# Longer forms: the HTML entity, and marks whose UTF-8 bytes were read as
+# Latin-1 (Â° for °)
+markSequences = {u'&deg;': DEGREE}
+for mark, variants in markVariants.items():
+    for variant in mark + variants:
+        if variant > u'\x7f' and variant != u'\u0366':
+            markSequences[variant.encode('utf-8').decode('latin-1')] = mark
+
+markTable = dict((variant, mark) for mark, variants in markVariants.items() for variant in variants)
+markTable.update(markSequences)
+# Every alternative starts with a literal character (and no IGNORECASE) so the
+# regex engine can skip straight to the characters that can start a mark
+marks_re = re.compile(u'|'.join([u'&[dD][eE][gG];'] +
+                                [re.escape(s) for s in sorted(markSequences, key=len, reverse=True) if s != u'&deg;'] +
+                                [re.escape(c) for c in u''.join(markVariants.values())]))
+
+# One coordinate found in an article: decimal degrees (floats), the span of the
+# article text it was read from and that text, and the geoparser that found it
+# ('re' or 'pyparsing'). A namedtuple, so it can't be changed once made and
+# holds no per-instance __dict__.
+CoordinateMatch = namedtuple('CoordinateMatch', 'latitude longitude start end text engine')
+
+
+class CoordinateScan(object):
+    """
+    A single pass over a piece of text, as iterCoordinates returns it.
+    Iterating over it scans the text as it goes, giving CoordinateMatch
+    records, and keeps count of what it has seen so far:
+      matched - matches the geoparser made, including one it stopped at
+                without making a coordinate of it
+      found   - CoordinateMatch records given
+    and, from the pyparsing geoparser, cacheStats: a dict of how the scan
+    used the packrat cache (see scanCoordinates in jmap_geoparser.py), empty
+    if the grammar wasn't used. It is None for the re geoparser.
+    timeouts lists where a guarded scan gave up on part of the text, as
+    (position, 'window' or 'document'); see GeoFinditer in jmap_geoparser_re.py.
+
+    Usage example:
+
+    scan = iterCoordinates(text)
+    for coord in scan:
+        print coord.latitude, coord.longitude, coord.text
+    print scan.matched, scan.found
+    """
+    def __init__(self, scanner):
+        # scanner(scan) is a generator of records that counts scan.matched
+        self.matched = 0
+        self.found = 0
+        self.cacheStats = None
+        self.timeouts = []
+        self._records = scanner(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        coord = next(self._records)
+        self.found += 1
+        return coord
+
+
+def normalizeMarks(text):
+    """
+    Return (normalized, offsets): the unicode string text with every mark
+    variant replaced by its canonical character, and the offsets to give
+    originalSpan(), or None if every character stayed where it was.
+    """
+    pieces = []
+    breaks = []  # normalized positions after which the original text is longer...
+    shifts = []  # ...by this many characters
+    last = 0
+    for match in marks_re.finditer(text):
+        start, end = match.span()
+        pieces.append(text[last:start])
+        mark = match.group()
+        pieces.append(markTable.get(mark) or markTable[mark.lower()])
+        if end - start > 1:
+            breaks.append(start - (shifts[-1] if shifts else 0) + 1)
+            shifts.append((shifts[-1] if shifts else 0) + end - start - 1)
+        last = end
+    if not pieces:
+        return text, None
+    pieces.append(text[last:])
+    return u''.join(pieces), (breaks, shifts) if breaks else None
+
+
+def originalSpan(offsets, start, end):
+    # Map a (start, end) span of the normalized text back to the original text
+    if offsets is None:
+        return start, end
+    breaks, shifts = offsets
+    def original(pos):
+        i = bisect_right(breaks, pos)
+        return pos + shifts[i-1] if i else pos
+    return original(start), original(end)
+
+
+def candidateStart(text, loc, prefix_re):
+    """
+    Earliest position a coordinate whose first degree mark is at loc can
+    start: loc less the longest run before it that prefix_re (matching the
+    text backwards) allows.
+    """
+    size = 64
+    while True:
+        start = max(0, loc - size)
+        prefix = prefix_re.match(text[start:loc][::-1]).end()
+        if prefix < loc - start or start == 0:
+            return loc - prefix
+        size *= 4
+
+
+windowMargin = 16  # Characters at the end of a window that aren't final yet: normalizeMarks may see only part of a mark there
+
+
+class ChunkWindow(object):
+    """
+    A window onto a text given as an iterable of unicode chunks (of any
+    size), for a geoparser to scan it in one pass with memory bounded by
+    chunkSize. The window holds raw, the text from position base of the
+    whole text on, and text and offsets, raw run through normalizeMarks.
+    Each advance() drops what the scan no longer needs from the front and
+    reads chunkSize more characters onto the end; final says the window
+    reaches the end of the text. Until then the last windowMargin characters
+    of text may still change (a mark cut in two by the end of the window),
+    so nothing after len(text) - windowMargin should be scanned.
+    """
+    def __init__(self, chunks, chunkSize):
+        self._chunks = iter(chunks)
+        self._piece = u''  # chunk being read from, and how much of it has been read
+        self._read = 0
+        self.chunkSize = chunkSize
+        self.raw = u''
+        self.base = 0
+        self.final = False
+        self._fill()
+
+    def _fill(self):
+        pieces = [self.raw]
+        wanted = self.chunkSize
+        while wanted > 0:
+            if self._read == len(self._piece):
+                self._piece = next(self._chunks, None)
+                self._read = 0
+                if self._piece is None:
+                    self.final = True
+                    break
+            piece = self._piece[self._read:self._read + wanted]
+            self._read += len(piece)
+            wanted -= len(piece)
+            pieces.append(piece)
+        self.raw = u''.join(pieces)
+        self.text, self.offsets = normalizeMarks(self.raw)
+
+    def advance(self, cut):
+        # Drop text[:cut] and read the next chunk; positions in text move back by cut
+        cut = originalSpan(self.offsets, cut, cut)[0]
+        self.raw = self.raw[cut:]
+        self.base += cut
+        self._fill()
+
+    def span(self, start, end):
+        # Span in the whole text, and the text as given, of a span of text
+        first, last = originalSpan(self.offsets, start, end)
+        return self.base + first, self.base + last, self.raw[first:last]
@@ -0,0 +1,370 @@
+#####################################################################################
+## jmap_geoparse_service.py
+## Long-running geoparse service. Both geoparsers are loaded (and the pyparsing
+## grammar built) once when the service starts, and parse requests are then
+## answered over local HTTP, on a TCP port of 127.0.0.1 or on a Unix socket,
+## without paying interpreter start-up and grammar construction per call.
+##
+## Endpoints (requests and responses are JSON):
+##   POST /parse   {"text": "...", "engine": "re"}
+##                 -> {"coordinates": [...], "matched": 2, "timeouts": [], "ms": 0.4}
+##   POST /batch   {"engine": "pyparsing", "items": [{"id": 1, "text": "..."},
+##                                                   {"id": 2, "xml": "<article>..."}]}
+##                 -> {"results": [{"id": 1, "coordinates": [...], ...}, ...], "ms": 12.5}
+##                 Items are text snippets, or whole article XML documents whose
+##                 body text is geoparsed (see jmap_formats.py). An item that
+##                 fails gets an "error" instead of coordinates; the rest of the
+##                 batch still runs.
+##   GET  /metrics request, item and error counts, requests turned away, and
+##                 latency (histogram and recent percentiles) per endpoint
+##   GET  /health  the engines loaded and their parserVersions
+## "engine" is "re" or "pyparsing" (default: defaultEngine). Each coordinate is
+## {"latitude", "longitude", "start", "end", "text"}, the span and text being
+## those of the text as sent.
+##
+## At most maxConcurrent requests are parsed at once; others wait up to
+## queueTimeout seconds for a turn and then get 503. Requests over
+## maxRequestBytes get 413, batches over maxBatchItems get 400.
+##
+## Usage:
+##   python jmap_geoparse_service.py --port 8765
+##   python jmap_geoparse_service.py --socket /tmp/jmap_geoparse.sock --max-concurrent 8
+##   curl -s localhost:8765/parse -d '{"text": "45\u00b012\u2032N, 110\u00b05\u2032W"}'
+#####################################################################################
+
+import os, sys, json, socket, signal, threading
+import argparse
+import BaseHTTPServer, SocketServer
+from collections import deque
+from timeit import default_timer as timer
+
+import jmap_geoparser_re
+import jmap_geoparser
+from jmap_ingest import decodeArticleXML, readArticleXML, declareUTF8
+from jmap_instrument import histogramBucket
+
+host = '127.0.0.1'
+port = 8765
+defaultEngine = "re"  # Engine used when a request doesn't name one: "re" or "pyparsing"
+maxConcurrent = 4  # Most requests parsed at the same time
+queueTimeout = 5.0  # Seconds a request waits for a turn before it gets 503
+maxBatchItems = 1000  # Most items in one /batch request
+maxRequestBytes = 64 * 1048576  # Largest request body accepted
+recentLatencies = 1000  # Number of most recent requests the latency percentiles are taken over
+
+engines = {'re': jmap_geoparser_re, 'pyparsing': jmap_geoparser}
+# The pyparsing grammar keeps its packrat cache in module state, so scans
+# that use it take turns (see engineLock); all others run side by side
+engineLocks = {'pyparsing': threading.Lock()}
+
+
+class ServiceError(Exception):
+    # A request the service turns down, with the HTTP status to send
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Admission(object):
+    """
+    Lets at most `limit` requests in at once; the others wait up to
+    `timeout` seconds for one to finish.
+    """
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def enter(self):
+        # True once the request may go ahead, False if it timed out waiting
+        deadline = timer() + self.timeout
+        with self.condition:
+            while self.active >= self.limit:
+                left = deadline - timer()
+                if left <= 0:
+                    return False
+                self.condition.wait(left)
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of an already sorted list
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+
+class ServiceMetrics(object):
+    """
+    Counts and latencies of the requests to each endpoint since the service
+    started: a histogram of all of them (power-of-two millisecond buckets, as
+    in jmap_instrument.py) and percentiles over the most recent ones.
+    """
+    def __init__(self):
+        self.started = timer()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.rejected = 0  # requests turned away because the service was busy
+
+    def record(self, endpoint, seconds, items=0, errors=0):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {'requests': 0, 'items': 0, 'errors': 0, 'seconds': 0.0, 'max_ms': 0.0,
+                                                    'histogram': {}, 'recent': deque(maxlen=recentLatencies)}
+            stats['requests'] += 1
+            stats['items'] += items
+            stats['errors'] += errors
+            stats['seconds'] += seconds
+            stats['max_ms'] = max(stats['max_ms'], seconds * 1000)
+            bucket = histogramBucket(seconds)
+            stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+            stats['recent'].append(seconds * 1000)
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+
+    def asDict(self, active=0):
+        with self.lock:
+            endpoints = {}
+            for endpoint, stats in self.endpoints.items():
+                recent = sorted(stats['recent'])
+                endpoints[endpoint] = {
+                    'requests': stats['requests'], 'items': stats['items'], 'errors': stats['errors'],
+                    'mean_ms': 1000 * stats['seconds'] / stats['requests'], 'max_ms': stats['max_ms'],
+                    'recent_ms': dict((name, percentile(recent, p)) for name, p in (('p50', 50), ('p95', 95), ('p99', 99))),
+                    'histogram_ms': [[bucket, count] for bucket, count in sorted(stats['histogram'].items())]}
+            return {'uptime_seconds': timer() - self.started, 'active': active, 'rejected': self.rejected,
+                    'max_concurrent': maxConcurrent, 'endpoints': endpoints}
+
+
+def engineLock(engine):
+    # The lock a scan with engine has to hold, or None: only the pyparsing
+    # grammar with its packrat cache on shares state between scans, the fast
+    # build (the default) never touches it
+    if engine == 'pyparsing' and not jmap_geoparser.fastBuild and jmap_geoparser.packratPolicy != "off":
+        return engineLocks['pyparsing']
+    return None
+
+
+def geoparseText(text, engine):
+    # The coordinates one engine finds in a unicode string, as a response item
+    start = timer()
+    lock = engineLock(engine)
+    if lock: lock.acquire()
+    try:
+        scan = engines[engine].iterCoordinates(text)
+        coordinates = [{'latitude': coord.latitude, 'longitude': coord.longitude,
+                        'start': coord.start, 'end': coord.end, 'text': coord.text} for coord in scan]
+    finally:
+        if lock: lock.release()
+    return {'coordinates': coordinates, 'matched': scan.matched,
+            'timeouts': [[pos, limit] for pos, limit in scan.timeouts],
+            'ms': 1000 * (timer() - start)}
+
+
+def geoparseItem(item, engine):
+    # One /parse request or /batch item: a text snippet, or an article XML
+    # document whose body text is geoparsed
+    if not isinstance(item, dict):
+        raise ServiceError(400, "an item must be an object with a text or xml field")
+    if isinstance(item.get('text'), basestring):
+        return geoparseText(item['text'], engine)
+    if isinstance(item.get('xml'), basestring):
+        xml = item['xml']
+        if isinstance(xml, unicode):
+            # Already decoded (JSON strings always are): whatever encoding its
+            # declaration names, it's UTF-8 once encoded here
+            xml = declareUTF8(xml.encode('utf-8'))
+        doc = readArticleXML(decodeArticleXML(xml)[0])
+        if doc.format is None:
+            raise ServiceError(400, "unknown XML format")
+        text = doc.formatData.text
+        if text is None:
+            raise ServiceError(400, "no article text element in " + doc.format.name + " XML")
+        result = geoparseText(text, engine)
+        result['format'] = doc.format.name
+        result['doi'] = doc.format.metadata(doc.formatData)['doi']
+        return result
+    raise ServiceError(400, "an item must have a text or xml field")
+
+
+def requestEngine(request):
+    engine = request.get('engine') or defaultEngine
+    if engine not in engines:
+        raise ServiceError(400, "unknown engine %r: use %s" % (engine, " or ".join(sorted(engines))))
+    return engine
+
+
+class GeoparseHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections open between requests
+    server_version = 'JournalMapGeoparse/1.0'
+    quiet = True  # don't log every request
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.respond(200, self.server.metrics.asDict(self.server.admission.active))
+        elif self.path == '/health':
+            self.respond(200, {'status': 'ok', 'engines': dict((name, module.parserVersion) for name, module in engines.items())})
+        else:
+            self.respond(404, {'error': "no such endpoint: " + self.path})
+
+    def do_POST(self):
+        endpoint = self.path
+        if endpoint not in ('/parse', '/batch'):
+            self.respond(404, {'error': "no such endpoint: " + endpoint})
+            return
+        start = timer()
+        admitted = False
+        items = errors = 0
+        try:
+            request = self.readRequest()
+            engine = requestEngine(request)
+            if not self.server.admission.enter():
+                self.server.metrics.reject()
+                raise ServiceError(503, "busy: %d requests already running" % self.server.admission.limit)
+            admitted = True
+            if endpoint == '/parse':
+                items = 1
+                response = geoparseItem(request, engine)
+            else:
+                batch = request.get('items')
+                if not isinstance(batch, list):
+                    raise ServiceError(400, "a batch needs a list of items")
+                if len(batch) > maxBatchItems:
+                    raise ServiceError(400, "%d items in the batch; at most %d are taken" % (len(batch), maxBatchItems))
+                results = []
+                for item in batch:
+                    try:
+                        result = geoparseItem(item, engine)
+                    except Exception, e:
+                        # GeoConvert can raise on a match it can't convert
+                        result = {'error': str(e)}
+                        errors += 1
+                    if isinstance(item, dict) and 'id' in item:
+                        result['id'] = item['id']
+                    results.append(result)
+                items = len(batch)
+                response = {'results': results, 'ms': 1000 * (timer() - start)}
+            status = 200
+        except ServiceError, e:
+            status, response = e.status, {'error': str(e)}
+        except Exception, e:
+            status, response = 500, {'error': "%s: %s" % (type(e).__name__, e)}
+        finally:
+            if admitted:
+                self.server.admission.leave()
+        if status != 503:
+            self.server.metrics.record(endpoint, timer() - start, items, errors + (status != 200))
+        self.respond(status, response)
+
+    def readRequest(self):
+        length = self.headers.getheader('content-length')
+        if length is None:
+            raise ServiceError(411, "Content-Length required")
+        length = int(length)
+        if length > maxRequestBytes:
+            self.close_connection = 1  # the body isn't read
+            raise ServiceError(413, "request of %d bytes; at most %d are taken" % (length, maxRequestBytes))
+        try:
+            request = json.loads(self.rfile.read(length))
+        except ValueError, e:
+            raise ServiceError(400, "request is not JSON: " + str(e))
+        if not isinstance(request, dict):
+            raise ServiceError(400, "request must be a JSON object")
+        return request
+
+    def respond(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else self.server.server_address
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class GeoparseServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler=GeoparseHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.metrics = ServiceMetrics()
+        self.admission = Admission(maxConcurrent, queueTimeout)
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class UnixGeoparseServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, path, handler=GeoparseHandler):
+            if os.path.exists(path):
+                os.remove(path)  # left behind by a service that didn't shut down cleanly
+            SocketServer.UnixStreamServer.__init__(self, path, handler)
+            self.metrics = ServiceMetrics()
+            self.admission = Admission(maxConcurrent, queueTimeout)
+else:  # Windows
+    UnixGeoparseServer = None
+
+
+def warmUp():
+    # Run both engines once, so the first request doesn't pay for anything
+    # either of them sets up on first use
+    for engine in engines:
+        geoparseText(u"45\xb0 12' N, 110\xb0 5' W", engine)
+
+
+def main(argv=None):
+    global maxConcurrent, queueTimeout, defaultEngine
+    ap = argparse.ArgumentParser(description="Serve geoparse requests over local HTTP with both geoparsers kept loaded.")
+    ap.add_argument('--port', type=int, default=port, help="TCP port on %s (default: %%(default)s)" % host)
+    ap.add_argument('--socket', help="serve on this Unix socket instead of a TCP port")
+    ap.add_argument('--max-concurrent', type=int, default=maxConcurrent, help="requests parsed at the same time (default: %(default)s)")
+    ap.add_argument('--queue-timeout', type=float, default=queueTimeout, help="seconds a request waits for a turn before it gets 503 (default: %(default)s)")
+    ap.add_argument('--engine', default=defaultEngine, choices=sorted(engines), help="engine for requests that don't name one (default: %(default)s)")
+    ap.add_argument('--verbose', action='store_true', help="log every request")
+    args = ap.parse_args(argv)
+    maxConcurrent, queueTimeout, defaultEngine = args.max_concurrent, args.queue_timeout, args.engine
+    GeoparseHandler.quiet = not args.verbose
+
+    warmUp()
+    if args.socket:
+        if UnixGeoparseServer is None:
+            ap.error("Unix sockets aren't available here; use --port")
+        server = UnixGeoparseServer(args.socket)
+        where = args.socket
+    else:
+        server = GeoparseServer((host, args.port))
+        where = "http://%s:%d" % server.server_address
+    print "Geoparse service on " + where + " (" + ", ".join(module.parserVersion for module in engines.values()) + ")"
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # shut down as on Ctrl-C
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
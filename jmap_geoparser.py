@@ -5,10 +5,122 @@
 ### test = "45º 23' 12'', 123º 23' 56''"  
 ### assert coordinate(coordinateParser.parseString(test)).calcDD() == {'latitude': 45.38667, 'longitude': 123.39889}
 
+import re, sys
+from collections import OrderedDict
 from pyparsing import *
-ParserElement.enablePackrat()
+from jmap_geocommon import candidateStart, normalizeMarks, originalSpan, CoordinateMatch, CoordinateScan, ChunkWindow, windowMargin
+import jmap_instrument
 
-parserVersion = "PyParsing GeoParser 2.0 beta, 05/25/2016"
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+parserVersion = "PyParsing GeoParser 2.3 beta, 10/18/2026"
+fastBuild = True  # Scan with coordinate_re, the grammar compiled to one regex (same results), rather than coordinateParser
+packratPolicy = "off"  # Packrat cache for coordinateParser: "document", "lru" or "off" (see below)
+packratCacheSize = 1024  # Most entries the "lru" cache holds
+scanChunkChars = 1048576  # Characters read at a time when scanning text given in chunks (iterCoordinatesChunks)
+chunkOverlap = 4096  # Characters kept before the next degree sign when scanning in chunks; a coordinate with more than this in front of its degree sign could be missed
+
+## Packrat cache
+# coordinateParser memoizes its parse attempts (packrat parsing). Every entry
+# is keyed by the whole text being parsed, so entries kept after a document
+# has been scanned keep that document in memory. packratPolicy sets how the
+# cache is kept:
+#   "document" - no size limit while a document is scanned, emptied after it
+#   "lru"      - the packratCacheSize most recently used entries, kept from
+#                one document to the next
+#   "off"      - no cache
+# The grammar seldom tries the same element at the same place twice: on
+# test_set_full.csv under 1% of lookups are hits, and scanning without the
+# cache is about 3 times faster, so it is off unless asked for.
+# The fast build (coordinate_re) doesn't use the cache at all.
+# The "document" and "lru" caches are put in place of pyparsing's own, which
+# means replacing parts of ParserElement that aren't public; they are only
+# used with the pyparsing versions in packratVersions, and asking for them
+# with any other raises an error rather than risk a cache that silently
+# doesn't work. Cache stats are reported only where pyparsing keeps them.
+packratVersions = ((2, 4), (2, 5))  # pyparsing versions the packrat caches support: from the first, up to but not including the second
+
+def pyparsingVersion():
+    # The installed pyparsing's version as a tuple of numbers, e.g. (2, 4, 7)
+    import pyparsing
+    return tuple(int(part) for part in re.findall(r'\d+', pyparsing.__version__.split()[0])[:3])
+
+def packratCacheStats():
+    # (hits, misses) of pyparsing's packrat cache so far, or None where it doesn't count them
+    stats = getattr(ParserElement, 'packrat_cache_stats', None)
+    if stats is None:
+        return None
+    return stats[0], stats[1]
+
+class _PackratCache(object):
+    # Packrat cache (the interface of pyparsing's own caches) holding the
+    # size most recently used entries, or every entry if size is None
+    def __init__(self, size=None):
+        self.size = size
+        self.not_in_cache = object()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if self.size is None:
+            return self.entries.get(key, self.not_in_cache)
+        value = self.entries.pop(key, self.not_in_cache)
+        if value is not self.not_in_cache:
+            self.entries[key] = value
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = value
+        if self.size is not None and len(self.entries) > self.size:
+            self.entries.popitem(False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+_packratSetting = None  # (packratPolicy, packratCacheSize) of the cache in use
+
+def usePackrat():
+    # Put the packrat cache packratPolicy and packratCacheSize ask for in place,
+    # if it isn't already
+    global _packratSetting
+    setting = (packratPolicy, packratCacheSize)
+    if setting == _packratSetting:
+        return
+    if packratPolicy == "off" and _packratSetting is None:
+        pass  # Never switched on: pyparsing is left alone
+    elif packratPolicy not in ("document", "lru", "off"):
+        raise ValueError("Unknown packratPolicy: %s" % packratPolicy)
+    elif not (packratVersions[0] <= pyparsingVersion() < packratVersions[1]) or \
+            not all(hasattr(ParserElement, name) for name in ('_parseCache', '_parseNoCache', 'packrat_cache_stats')):
+        import pyparsing
+        raise RuntimeError("packratPolicy %r replaces pyparsing's packrat cache, which is only supported with pyparsing >= %s, < %s (installed: %s)" %
+                           (packratPolicy, ".".join(map(str, packratVersions[0])), ".".join(map(str, packratVersions[1])),
+                            pyparsing.__version__))
+    elif packratPolicy == "off":
+        ParserElement.packrat_cache = {}
+        ParserElement._parse = ParserElement._parseNoCache
+        ParserElement._packratEnabled = False
+    else:
+        ParserElement.packrat_cache = _PackratCache(packratCacheSize if packratPolicy == "lru" else None)
+        ParserElement._parse = ParserElement._parseCache
+        ParserElement._packratEnabled = True
+    _packratSetting = setting
+
+def peakMemoryKB():
+    # Peak memory of this process so far, or None where it can't be read
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes on OS X, kilobytes elsewhere
+        rss = rss // 1024
+    return rss
+
+usePackrat()
 
 ## Parsing validation functions
 def validateLatDeg(nums):
@@ -84,48 +196,40 @@ class coordinate(object):
         #if 'lonHemi' in parseDict: self.lonHemi = parseDict.lonHemi[0]
     
     def calcDD(self):
+        # Works on copies of the parts, so every call gives the same answer
+        lat = (self.latDeg, self.latMin, self.latSec, self.latHemi, self.latSign)
+        lon = (self.lonDeg, self.lonMin, self.lonSec, self.lonHemi, self.lonSign)
         # Check if the coordinate pair is actually Long/Lat
         if self.latHemi.upper() in ['E','W']:
             #switch things around
-            holdDeg = self.latDeg
-            holdMin = self.latMin
-            holdSec = self.latSec
-            holdHemi = self.latHemi
-            holdSign = self.latSign
-            self.latDeg = self.lonDeg
-            self.latMin = self.lonMin
-            self.latSec = self.lonSec
-            self.latHemi = self.lonHemi
-            self.latSign = self.lonSign
-            self.lonDeg = holdDeg
-            self.lonMin = holdMin
-            self.lonSec = holdSec
-            self.lonHemi = holdHemi
-            self.latSign = holdSign
-        
+            lat, lon = lon, lat
+        latDeg, latMin, latSec, latHemi, latSign = lat
+        lonDeg, lonMin, lonSec, lonHemi, lonSign = lon
+
         # Check for latitude values greater than 90º
-        if self.latDeg > 90:
-            print "Invalid Latitude Degrees: " +str(self.latDeg)
+        if latDeg > 90:
+            print "Invalid Latitude Degrees: " +str(latDeg)
             return {"latitude":-999, "longitude":-999}
-        
 
-        if self.latHemi.upper() == 'S': self.latSign = -1
-        if self.lonHemi.upper() == 'W': self.lonSign = -1
-        lat = self.latSign*(self.latDeg + self.latMin/60 + self.latSec/3600)
-        lon = self.lonSign*(self.lonDeg + self.lonMin/60 + self.lonSec/3600)
+        if latHemi.upper() == 'S': latSign = -1
+        if lonHemi.upper() == 'W': lonSign = -1
+        lat = latSign*(latDeg + latMin/60 + latSec/3600)
+        lon = lonSign*(lonDeg + lonMin/60 + lonSec/3600)
         return {"latitude":round(lat,5), "longitude":round(lon,5)}
-    
+
 
 
 
 ## Parsing elements
 digits = Word(nums)
 
-degSign = Literal("º") | Literal('°') | Literal(' ͦ') | Literal('˚') | Literal('º') | Literal('ø') | CaselessLiteral("degrees") | CaselessLiteral("deg") | CaselessLiteral("&deg;") # º|°|˚|°|degrees|&deg;
-minSign = Literal("’") | Literal("′") | Literal("'") | Literal("‛") | Literal("‘") | Literal('ʹ') | Literal('ʼ')  | CaselessLiteral("minutes") | CaselessLiteral("min") # ″|"|′|'|’|minutes|′′|''
-secSign = Literal('″') | Literal('"') | Literal("′′") | Literal("''") | Literal("’’") | Literal("‛‛") | Literal("‘‘") | Literal("ʹʹ") | Literal("ʼʼ") | Literal('“') | Literal('”') | Literal('‟') | Literal('〞') | Literal('＂') | Literal('ʺ') | Literal('˝')| CaselessLiteral("seconds") | CaselessLiteral("sec")
-negSign = Literal('-') | Literal('−') | Literal('–') | Literal('—') | Literal('―') | Literal('‒')
-decPoint = Literal(".") | Literal(".") | Literal("·")
+# The marks are the canonical ones normalizeMarks (jmap_geocommon.py) turns all
+# their look-alikes into, so text has to be normalized before it is parsed
+degSign = Literal('°') | Literal('ø') | CaselessLiteral("degrees") | CaselessLiteral("deg") # º|°|˚|ͦ|&deg; normalized to °; ø (° read as CP437) isn't normalized, the re geoparser doesn't take it
+minSign = Literal("'") | CaselessLiteral("minutes") | CaselessLiteral("min") # ’|′|‛|‘|ʹ|ʼ normalized to '
+secSign = Literal('"') | Literal("''") | CaselessLiteral("seconds") | CaselessLiteral("sec") # ″|“|”|‟|〞|＂|ʺ|˝ normalized to "
+negSign = Literal('-') | Literal('–') # − normalized to -, —|―|‒ normalized to –
+decPoint = Literal(".") # · normalized to .
 
 coordPart = Combine(digits + Optional(decPoint + digits))
 
@@ -156,4 +260,312 @@ fluff = Suppress(Optional(Literal("") | CaselessLiteral("latitude of") | Casele
 latPart = fluff + Optional(hemi.setResultsName('hemi11')) + Optional(negSign.setResultsName('latNeg')) + latDeg.setResultsName('latDeg') + Optional(mins.setResultsName('latMin')) + Optional(secs.setResultsName('latSec')) + Optional(hemi.setResultsName('hemi12')) + Optional(fluff)
 lonPart = Optional(fluff) + Optional(hemi.setResultsName('hemi21')) + Optional(negSign.setResultsName('lonNeg')) + lonDeg.setResultsName('lonDeg') + Optional(mins.setResultsName('lonMin')) + Optional(secs.setResultsName('lonSec')) + Optional(hemi.setResultsName('hemi22')) + fluff
 
-coordinateParser = latPart + separator.setResultsName('sep') + lonPart
\ No newline at end of file
+coordinateParser = latPart + separator.setResultsName('sep') + lonPart
+
+
+
+## Fast build
+# The same grammar compiled into a single regular expression, so a coordinate
+# is matched in one call into the regex engine instead of one Python call per
+# element. It follows pyparsing's rules exactly:
+#  - tokens skip the whitespace in front of them. An Optional of an And (the
+#    minutes and seconds) skips it even when it doesn't match; an Optional of
+#    a MatchFirst (the marks, hemispheres, fluff) only when an alternative does;
+#  - alternatives are tried in order (oneOf's in the order it puts them) and,
+#    like anything else that has matched, are never taken back to let a later
+#    element match. So each element, whitespace and all, is an atomic group,
+#    (?=(?P<name>...))(?P=name);
+#  - the validate* parse actions become the ranges the numbers can have.
+_white = r"[ \t\r\n]*"
+_atomics = []
+
+def _atomic(pattern):
+    _atomics.append('_a%d' % len(_atomics))
+    return r"(?=(?P<%s>%s))(?P=%s)" % (_atomics[-1], pattern, _atomics[-1])
+
+def _required(pattern):
+    return _atomic(r"%s(?:%s)" % (_white, pattern))
+
+def _optionalAnd(pattern):
+    return _atomic(r"%s(?:%s)?" % (_white, pattern))
+
+def _optionalMatchFirst(pattern):
+    return _atomic(r"(?:%s(?:%s))?" % (_white, pattern))
+
+_hemi = r"north|south|east|west|[nsew]"
+_negSign = r"-|\xe2\x80\x93"
+_degNumber = r"0*(?:1[0-7]\d|[1-9]?\d)(?!\d)(?:\.\d+)?" # Word(nums) + Optional("." + Word(nums)), under 180
+_minSecNumber = r"0*[1-5]?\d(?!\d)(?:\.\d+)?"           # Word(nums) + Optional("." + Word(nums)), under 60
+_degSign = r"\xc2\xb0|\xc3\xb8|degrees|deg"
+_minSign = r"'|minutes|min"
+_secSign = r"\"|''|seconds|sec"
+_separator = r",|;|\x02|by|and"
+_fluff = r"\x02|latitude of|longitude of|latitude:|latitude|lat\.|lat:|lat|longitude:|longitude|long\.|long|lon\.|lon:|lon"
+
+def _part(part, hemi1, hemi2):
+    return (_optionalMatchFirst(_fluff) +
+            _optionalMatchFirst("(?P<%s>%s)" % (hemi1, _hemi)) +
+            _optionalMatchFirst("(?P<%sNeg>%s)" % (part, _negSign)) +
+            _required("(?P<%sDeg>%s)" % (part, _degNumber)) + _required(_degSign) +
+            _optionalAnd("(?P<%sMin>%s)%s" % (part, _minSecNumber, _optionalMatchFirst(_minSign))) +
+            _optionalAnd("(?P<%sSec>%s)%s" % (part, _minSecNumber, _optionalMatchFirst(_secSign))) +
+            _optionalMatchFirst("(?P<%s>%s)" % (hemi2, _hemi)) +
+            _optionalMatchFirst(_fluff))
+
+coordinate_re = re.compile(_part('lat', 'hemi11', 'hemi12') + _optionalMatchFirst(_separator) + _part('lon', 'hemi21', 'hemi22'), re.IGNORECASE)
+
+# Results names in the order coordinateParser gives their tokens; the degrees,
+# minutes and seconds are And's, so their results are lists of one token
+_resultNames = ['hemi11', 'latNeg', 'latDeg', 'latMin', 'latSec', 'hemi12',
+                'hemi21', 'lonNeg', 'lonDeg', 'lonMin', 'lonSec', 'hemi22']
+_listResults = set(['latDeg', 'latMin', 'latSec', 'lonDeg', 'lonMin', 'lonSec'])
+_hemiWords = {'north': 'n', 'south': 's', 'east': 'e', 'west': 'w'}
+
+def _coordinateTokens(match):
+    # The ParseResults coordinateParser would give for a coordinate_re match
+    names = []
+    values = []
+    for name in _resultNames:
+        value = match.group(name)
+        if value is None:
+            continue
+        if name.startswith('hemi'):
+            value = _hemiWords.get(value.lower()) or value.upper()  # as formatHemi / CaselessLiteral give it
+        names.append(name)
+        values.append(value)
+    tokens = ParseResults(values)
+    for name, value in zip(names, values):
+        tokens[name] = ParseResults([value]) if name in _listResults else value
+    return tokens
+
+# coordinateParser's drop-in as a pyparsing element (searchString, scanString...)
+fastCoordinateParser = Regex(coordinate_re.pattern, re.IGNORECASE)
+fastCoordinateParser.setParseAction(lambda s, loc, toks: _coordinateTokens(coordinate_re.match(s, loc)))
+
+
+## Candidate prefilter
+# Every coordinate has a degSign after the latitude degrees, and the only
+# things that can come before it are fluff words, hemispheres, signs, digits
+# and whitespace. So rather than trying coordinateParser at every position of
+# an article, it is only tried on the run of such text leading up to a degSign.
+degSign_re = re.compile(r"\xc2\xb0|\xc3\xb8|deg", re.IGNORECASE)
+# Run of text that can come before a degSign, matched backwards: whitespace,
+# digits, decimal points and negSigns (the bytes of the UTF-8 dash too), then
+# up to three words and the "\x02" fluff
+latPrefix_re = re.compile(r"[ \t\r\n0-9.\-\xe2\x80\x93\x02]*(?:[ \t\r\n.:\x02]*[a-zA-Z]{1,12}){0,3}[ \t\r\n\x02]*")
+white_re = re.compile(_white)  # what coordinateParser.preParse skips
+
+def scanCoordinates(text, fast=None, stats=None):
+    """
+    Same as coordinateParser.scanString(text) for a UTF-8 encoded string
+    that has been through normalizeMarks (jmap_geocommon.py):
+    yields (tokens, start, end) for each coordinate, trying the parser at
+    the same positions scanString does, minus those that can't start one.
+    With fast (fastBuild unless given) coordinate_re is tried instead of
+    coordinateParser.
+    When coordinateParser is used and stats is a dict, the scan's packrat
+    cache use is put in it once the scan ends: hits, misses, entries (in
+    the cache at the end of the scan) and peakKB (see peakMemoryKB).
+    """
+    if isinstance(text, unicode):
+        for match in coordinateParser.scanString(text):
+            yield match
+        return
+    if fast is None:
+        fast = fastBuild
+    if not coordinateParser.keepTabs:
+        text = text.expandtabs()
+    if fast:
+        for match in _scanCandidates(text, True):
+            yield match
+        return
+    for match in _packratScan(_scanCandidates(text, False), stats):
+        yield match
+
+def _packratScan(matches, stats):
+    # Run a scan with coordinateParser, the packrat cache kept the way
+    # packratPolicy says, and put its cache use in stats (see scanCoordinates)
+    usePackrat()
+    if packratPolicy == "document":
+        ParserElement.packrat_cache.clear()
+    before = packratCacheStats()
+    try:
+        for match in matches:
+            yield match
+    finally:
+        after = packratCacheStats()
+        if stats is not None and before is not None and after is not None:
+            stats.update(hits=after[0] - before[0],
+                         misses=after[1] - before[1],
+                         entries=len(getattr(ParserElement, 'packrat_cache', ())),
+                         peakKB=peakMemoryKB())
+        if packratPolicy == "document":
+            ParserElement.packrat_cache.clear()
+
+def _scanCandidates(text, fast, loc=0, fits=None, left=None):
+    # The candidate loop of scanCoordinates, over the expanded text, from loc.
+    # With fits, the degree signs after it are left alone, and once the scan
+    # is over the first of them (or None) and the loc it would carry on from
+    # are put in the list left.
+    resume = None
+    for mark in degSign_re.finditer(text, loc):
+        a = mark.start()
+        if fits is not None and a > fits:
+            resume = a
+            break
+        loc = max(loc, candidateStart(text, a, latPrefix_re))
+        while loc < a:
+            if fast:
+                preloc = white_re.match(text, loc).end()
+                if preloc >= a:
+                    break
+                match = coordinate_re.match(text, preloc)
+                if match is None:
+                    loc = preloc + 1
+                else:
+                    yield _coordinateTokens(match), preloc, match.end()
+                    loc = match.end()
+                continue
+            preloc = coordinateParser.preParse(text, loc)
+            if preloc >= a:
+                break
+            try:
+                nextLoc, tokens = coordinateParser._parse(text, preloc, callPreParse=False)
+            except ParseException:
+                loc = preloc + 1
+            else:
+                yield tokens, preloc, nextLoc
+                loc = nextLoc
+        loc = max(loc, a)
+    if left is not None:
+        left[:] = [resume, loc]
+
+def searchCoordinates(text, fast=None):
+    # Drop-in for coordinateParser.searchString(text)
+    return ParseResults([tokens for tokens, start, end in scanCoordinates(text, fast)])
+
+def _tabOffsets(data):
+    # Offsets (as normalizeMarks gives them, for originalSpan) from positions
+    # in data.expandtabs() back to positions in data
+    breaks = []
+    shifts = []
+    shift = 0      # how much longer the expanded text is so far
+    lineStart = 0  # where the current line starts in the expanded text
+    for m in re.finditer(r"[\t\r\n]", data):
+        pos = m.start() + shift
+        if m.group() == "\t":
+            width = 8 - (pos - lineStart) % 8
+            shift += width - 1
+            breaks.append(pos + width)
+            shifts.append(-shift)
+        else:
+            lineStart = pos + 1
+    return (breaks, shifts) if breaks else None
+
+def iterCoordinates(text, fast=None):
+    """
+    Find the coordinates in a unicode string of article text in a single
+    lazy pass over scanCoordinates: a CoordinateScan of CoordinateMatch
+    records whose spans and text are those of the text as given (it is
+    normalized and encoded here). Its cacheStats are scanCoordinates'
+    packrat cache stats, once the scan ends.
+    """
+    def scanner(scan):
+        normText, offsets = normalizeMarks(text)
+        data = normText.encode('utf-8')
+        tabs = _tabOffsets(data) if not coordinateParser.keepTabs else None
+        byte = char = 0  # last position converted from UTF-8 bytes to characters
+        scan.cacheStats = {}
+        for tokens, start, end in scanCoordinates(data, fast, scan.cacheStats):
+            scan.matched += 1
+            span = []
+            for pos in originalSpan(tabs, start, end):
+                char += len(data[byte:pos].decode('utf-8'))
+                byte = pos
+                span.append(char)
+            start, end = originalSpan(offsets, *span)
+            with jmap_instrument.stage('convert'):
+                dd = coordinate(tokens).calcDD()
+            yield CoordinateMatch(float(dd['latitude']), float(dd['longitude']), start, end, text[start:end], 'pyparsing')
+    return CoordinateScan(scanner)
+
+def _scanChunks(chunks, fast):
+    """
+    _scanCandidates over text given as an iterable of unicode chunks, a
+    ChunkWindow (jmap_geocommon.py) of scanChunkChars at a time: yields
+    (tokens, start, end, text), the span and text being those of the whole
+    text as given. Each window is normalized, encoded and has its tabs
+    expanded from the column it starts at, so it reads just as that part of
+    the whole text would. A degree sign is only tried with at least
+    chunkOverlap characters of the window after it, and the next window
+    keeps chunkOverlap characters before the first sign left for it.
+    """
+    window = ChunkWindow(chunks, scanChunkChars)
+    loc = 0  # where the scan carries on from, in window.text
+    column = 0  # column window.text starts at in the expanded text, modulo 8
+    while True:
+        text = window.text
+        pad = column
+        data = ' ' * pad + text.encode('utf-8')
+        if coordinateParser.keepTabs:
+            expanded, tabs = data, None
+        else:
+            expanded, tabs = data.expandtabs(), _tabOffsets(data)
+        def toExpanded(pos):
+            # Position in text -> position in expanded
+            end = pad + len(text[:pos].encode('utf-8'))
+            return len(data[:end].expandtabs()) if tabs else end
+        def toText(pos):
+            # Position in expanded -> position in text
+            return len(data[pad:originalSpan(tabs, pos, pos)[0]].decode('utf-8'))
+        fits = len(text) - windowMargin - chunkOverlap  # last degree sign tried in this window
+        left = []
+        byte, char = pad, 0  # last position converted from UTF-8 bytes to characters
+        for tokens, start, end in _scanCandidates(expanded, fast, toExpanded(loc),
+                                                  None if window.final else toExpanded(fits) if fits >= 0 else -1, left):
+            span = []
+            for pos in originalSpan(tabs, start, end):
+                char += len(data[byte:pos].decode('utf-8'))
+                byte = pos
+                span.append(char)
+            yield (tokens,) + window.span(*span)
+        if window.final:
+            return
+        resume, loc = left
+        resume = toText(resume) if resume is not None else fits + 1
+        loc = toText(loc)
+        cut = max(0, resume - chunkOverlap, min(loc, resume))
+        if not coordinateParser.keepTabs:
+            before = data[:pad + len(text[:cut].encode('utf-8'))]
+            column = len(before[max(before.rfind('\n'), before.rfind('\r')) + 1:].expandtabs()) % 8
+        window.advance(cut)
+        loc = max(0, loc - cut)
+
+def iterCoordinatesChunks(chunks, fast=None):
+    """
+    iterCoordinates for text given as an iterable of unicode chunks (the
+    strings of an article as it is read, say), scanned scanChunkChars at a
+    time without ever joining them together (see _scanChunks). The
+    coordinates and their spans are the ones iterCoordinates(u''.join(chunks))
+    gives, as long as no coordinate has more than chunkOverlap characters in
+    front of its degree sign.
+    """
+    def scanner(scan):
+        if fast is None:
+            useFast = fastBuild
+        else:
+            useFast = fast
+        scan.cacheStats = {}
+        matches = _scanChunks(chunks, useFast)
+        if not useFast:
+            matches = _packratScan(matches, scan.cacheStats)
+        for tokens, start, end, text in matches:
+            scan.matched += 1
+            with jmap_instrument.stage('convert'):
+                dd = coordinate(tokens).calcDD()
+            yield CoordinateMatch(float(dd['latitude']), float(dd['longitude']), start, end, text, 'pyparsing')
+    return CoordinateScan(scanner)
+
+def findCoordinates(text, fast=None):
+    # All of iterCoordinates(text) as a list
+    return list(iterCoordinates(text, fast))
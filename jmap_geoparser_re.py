@@ -8,10 +8,25 @@ purpose: parses each XML file in the input directory for geographic coordinates
 arguments: none, but paths and file variables need to be modified below
 """
 
-import os, re, sys
+import os, re, sys, mmap, sre_parse
+from bisect import bisect_left
 from decimal import Decimal, setcontext, ExtendedContext
-
-parserVersion = "Regular Expression GeoParser 2.0 beta, 05/25/2016"
+from timeit import default_timer as timer
+import jmap_instrument
+from jmap_geocommon import DEGREE, markTable, candidateStart, normalizeMarks, originalSpan, CoordinateMatch, CoordinateScan, ChunkWindow, windowMargin
+
+# numpy is imported by GeoConvertBatch the first time it has coordinates to
+# convert, not here: it takes longer to import than the rest of the geoparser
+numpy = None
+numpyChecked = False  # Whether that import has been tried
+
+parserVersion = "Regular Expression GeoParser 2.3 beta, 10/18/2026"
+# The scan time limits are off by default: with a limit, what is found in an
+# article depends on how busy the machine is, so two runs can differ
+windowTimeLimit = None    # Most seconds spent trying parser_re in front of one degree mark before moving on (None for no limit)
+documentTimeLimit = None  # Most seconds spent scanning one article before giving up on the rest of it (None for no limit)
+scanWindowBytes = 4096    # Bytes decoded at a time around the degree marks when scanning UTF-8 bytes (iterCoordinatesBytes)
+scanChunkChars = 1048576  # Characters read at a time when scanning text given in chunks (iterCoordinatesChunks)
 
 def GeoCleanup(parts):
     """
@@ -174,31 +189,111 @@ def GeoConvert(latdir, latdeg, latmin, latsec, longdir, longdeg, longmin, longse
     return (lat_str, long_str)
 
 
+# One coordinate from GeoCleanup as "deg min sec deg min sec": numbers of up
+# to four digits and up to eight decimal places, where only the degrees can
+# be negative
+_number = ur'(\d{1,4})(?:\.(\d{1,8}))?'
+_half = ur'(-?)' + _number + u' ' + _number + u' ' + _number
+batchRow_re = re.compile(_half + u' ' + _half + u'$')
+
+def _loadNumpy():
+    global numpy, numpyChecked
+    numpyChecked = True
+    try:
+        import numpy
+    except ImportError:  # GeoConvertBatch then converts one at a time with GeoConvert
+        numpy = None
+
+def GeoConvertBatch(parts):
+    """
+    Convert many coordinates at once: parts is a list of the lists GeoCleanup
+    returns, and the result is a pair of arrays of latitudes and longitudes
+    that are float(GeoConvert(*p)) for every p, bit for bit.
+
+    GeoConvert works in Decimal, which is exact here up to the final
+    quantize, so the same sums are done exactly on integers (the degrees,
+    minutes and seconds in units of 1e-8) across the whole batch and rounded
+    half-even to 5 places, as quantize does. Anything that isn't a plain
+    number goes through GeoConvert itself; a coordinate GeoConvert raises an
+    error for comes back as NaN.
+    """
+    if parts and not numpyChecked:
+        _loadNumpy()
+    if numpy is None:
+        converted = []
+        for p in parts:
+            try:
+                converted.append(map(float, GeoConvert(*p)))
+            except Exception:
+                converted.append([float('nan')] * 2)
+        return [c[0] for c in converted], [c[1] for c in converted]
+
+    n = len(parts)
+    scaled = numpy.zeros((n, 6), dtype=numpy.int64)   # lat deg/min/sec, long deg/min/sec in units of 1e-8
+    negative = numpy.zeros((n, 2), dtype=bool)        # negative degrees or S/W
+    other = {}  # row -> (latitude, longitude) converted by GeoConvert
+    for i, p in enumerate(parts):
+        m = batchRow_re.match(u' '.join((p[1], p[2], p[3], p[5], p[6], p[7])))
+        if m is None:
+            try:
+                other[i] = map(float, GeoConvert(*p))
+            except Exception:
+                other[i] = [float('nan')] * 2
+            continue
+        g = m.groups('')
+        row = [int(g[j]) * 100000000 + int(g[j+1].ljust(8, '0')) for j in (1, 3, 5, 8, 10, 12)]
+        scaled[i] = row
+        negative[i, 0] = p[0] == 'S' or (g[0] == u'-' and row[0] > 0)
+        negative[i, 1] = p[4] == 'W' or (g[7] == u'-' and row[3] > 0)
+
+    # Seconds over 59 (in either half) are taken to be hundredths of minutes
+    hundredths = (scaled[:, 2] > 5900000000) | (scaled[:, 5] > 5900000000)
+    perDegree = numpy.where(hundredths, 6000, 3600)
+    perMinute = numpy.where(hundredths, 100, 60)
+    converted = []
+    for half in (0, 1):
+        deg, mins, secs = scaled[:, 3*half], scaled[:, 3*half+1], scaled[:, 3*half+2]
+        # Value times perDegree * 1e8, then rounded half-even to units of 1e-5
+        total = perDegree * deg + perMinute * mins + secs
+        unit = perDegree * 1000
+        rounded, rest = numpy.divmod(total, unit)
+        rounded += (2 * rest > unit) | ((2 * rest == unit) & (rounded % 2 == 1))
+        # A value that is exactly 0 keeps its sign, even in the S/W hemisphere
+        sign = numpy.where(negative[:, half] & (total > 0), -1.0, 1.0)
+        converted.append(sign * (rounded / 100000.0))
+    for i, (latitude, longitude) in other.items():
+        converted[0][i] = latitude
+        converted[1][i] = longitude
+    return converted[0], converted[1]
+
+
 lat_degrees = ur'(?:-?1(?:[0-7][0-9]|80)|(?:-?0?[0-9][0-9])|(?:-?[0-9]))'
 
+# Matches text that has been through normalizeMarks (jmap_geocommon.py): the
+# degree, minute and second marks, minus signs and decimal points are canonical
 parser_re = re.compile(ur"""\b
     # Optional word "latitude" or "longitude" offset by optional spaces 
     (\ ?(LATITUDE|LONGITUDE|LAT|LONG|LON)[.:]?\ ?)?
     # Latitude direction, first position: one of N, S, NORTH, SOUTH
     ((?P<dir11>NORTH|SOUTH|EAST|WEST|[NSEW])\ ?)?
     # Latitude degrees: two digits 0-90
-    (?P<latsign>(?:-|−))?
+    (?P<latsign>-)?
     (?P<latdeg>(?:1(?:[0-7][0-9]|80)|(?:-?0?[0-9][0-9])|(?:-?[0-9])))
-    (?P<latdecdeg>[\.|·|.]\d{1,8})?
+    (?P<latdecdeg>[\.|]\d{1,8})?
     # Degree mark or word separating degrees and minutes
-    (?P<degmark>\ ?(?:º|°|˚|°|˚| ͦ|˚|º|°|Â°|degrees|&deg;|deg))\ ?  
+    (?P<degmark>\ ?(?:°|degrees|deg))\ ?  
     (?P<latminsec>
     # Latitude minutes: two digits 0-59
     (?P<latmin>[0-5]?[0-9])
-    (?P<latdecmin>[\.|·|.]\d{1,8})?
+    (?P<latdecmin>[\.|]\d{1,8})?
     # If there was a degree mark before, look for punctuation after the minutes
-    (\ |(?(degmark)(″|"|′|'|’|minutes|′′|''|‘|‘‘|’|’’|‛|‛‛|‘|‘‘|ʹ|ʹʹ|ʼ|ʼʼ|“|”|‟|‟|〞|＂|ʺ|˝|â²)))?\ ?
+    (\ |(?(degmark)("|'|minutes|'')))?\ ?
     (
     # Latitude seconds: two digits
     ((?P<latsec>(\d{1,2}))
     # Decimal fraction of seconds
-    (?P<latdecsec>[\.|·|.]\d{1,8})?)?)
-    (?(degmark)(″|"|′|'|seconds|′′|''|‘|‘‘|’|’’|‛|‛‛|‘|‘‘|ʹ|ʹʹ|ʼ|ʼʼ|“|”|‟|‟|〞|＂|ʺ|˝)?)\ ?
+    (?P<latdecsec>[\.|]\d{1,8})?)?)
+    (?(degmark)("|'|seconds|'')?)\ ?
     )? 
     # Latitude direction, second position, optionally preceded by a space
     (\ ?(?P<dir12>(?(dir11)|(NORTH|SOUTH|EAST|WEST|[NSEW]))))?
@@ -211,23 +306,23 @@ parser_re = re.compile(ur"""\b
     # Longitude direction, first position: one of E, W, EAST, WEST
     (?(dir11)((?P<dir21>NORTH|SOUTH|EAST|WEST|[NSEW])\ ?))?
     # Longitude degrees: two or three digits
-    (?P<longsign>(?:-|−))? 
+    (?P<longsign>-)? 
     (?P<longdeg>(?:1(?:[0-7][0-9]|80)|(?:-?0?[0-9][0-9])|(?:-?[0-9])))
-    (?P<longdecdeg>[\.|·|.]\d{1,8})?   
+    (?P<longdecdeg>[\.|]\d{1,8})?   
     # If there was a degree mark before, look for another one here
-    ((?(degmark)(\ ?(?:º|°|˚|°|˚| ͦ|˚|º|°|Â°|degrees|&deg;|deg))))\ ?
+    ((?(degmark)(\ ?(?:°|degrees|deg))))\ ?
     (?(latminsec)   #Only look for minutes and seconds in the longitude
     (?P<longminsec> #if they were there in the latitude
     # Longitude minutes: two digits
     (?P<longmin>[0-5]?[0-9])
-    (?P<longdecmin>[\.|·|.]\d{1,8})?
+    (?P<longdecmin>[\.|]\d{1,8})?
     # If there was a degree mark before, look for punctuation after the minutes
-    (\ |(?(degmark)(″|"|′|'|’|minutes|′′|''|‘|‘‘|’|’’|‛|‛‛|‘|‘‘|ʹ|ʹʹ|ʼ|ʼʼ|“|”|‟|‟|〞|＂|ʺ|˝|â²)))?\ ?
+    (\ |(?(degmark)("|'|minutes|'')))?\ ?
     # Longitude seconds: two digits
     ((?P<longsec>(\d{1,2}))
     # Decimal fraction of minutes
-    (?P<longdecsec>[\.|·|.]\d{1,8})?)?)
-    (?(degmark)(″|"|′|'|seconds|′′|''|‘|‘‘|’|’’|‛|‛‛|‘|‘‘|ʹ|ʹʹ|ʼ|ʼʼ|“|”|‟|‟|〞|＂|ʺ|˝)?)\ ?
+    (?P<longdecsec>[\.|]\d{1,8})?)?)
+    (?(degmark)("|'|seconds|'')?)\ ?
     )
     #Longitude direction, second position: optionally preceded by a space
     (?(dir21)|\ ?(?P<dir22>(NORTH|SOUTH|EAST|WEST|[NSEW])))?
@@ -237,3 +332,389 @@ parser_re = re.compile(ur"""\b
     """, re.IGNORECASE | re.VERBOSE)
 
 
+# Every coordinate parser_re matches has a degree mark after the first degrees,
+# and the only things that can come before that mark are the latitude/longitude
+# words, hemispheres, signs, digits and spaces. So parser_re only has to be tried
+# on the run of such text leading up to each degree mark.
+degmark_re = re.compile(ur'°|deg', re.IGNORECASE)
+# Run of text that can come before the degree mark, matched backwards: spaces,
+# digits, signs and decimal points, then up to three words and the space that
+# parser_re lets in front of the first
+latPrefix_re = re.compile(ur'[ 0-9.|\-]*(?:[ .:]*[a-zA-Z]{1,12}){0,3} *')
+matchWidth = sre_parse.parse(parser_re.pattern, parser_re.flags).getwidth()[1]  # longest possible match
+
+
+def GeoFinditer(text, windowLimit=None, documentLimit=None, timeouts=None):
+    """
+    Iterate over the same matches as parser_re.finditer(text), for text that
+    has been through normalizeMarks (jmap_geocommon.py), but only try
+    parser_re at the positions in front of a degree mark where a coordinate
+    could start instead of at every position of the whole article.
+
+    Each attempt may look more than matchWidth characters ahead, so it
+    matches exactly as it would in a full scan, including the \\b at the end.
+
+    With windowLimit or documentLimit (seconds) the scan is guarded: once
+    the attempts in front of one degree mark have taken windowLimit it moves
+    on to the next mark, and once the scan has taken documentLimit it stops.
+    A single attempt can't be cut short, but it only ever sees the window of
+    matchWidth characters after the mark. Each time the scan gives up,
+    (position, 'window' or 'document') is appended to the timeouts list.
+    """
+    n = len(text)
+    pos = 0  # where a full finditer would carry on from
+    if timeouts is None:
+        timeouts = []
+    stopAt = timer() + documentLimit if documentLimit is not None else None
+    for mark in degmark_re.finditer(text):
+        a = mark.start()
+        end = min(n, a + matchWidth + 1)
+        start = max(pos, candidateStart(text, a, latPrefix_re))
+        if stopAt is not None and start < a and timer() > stopAt:
+            timeouts.append((start, 'document'))
+            return
+        moveOnAt = timer() + windowLimit if windowLimit is not None else None
+        while start < a:
+            if moveOnAt is not None and timer() > moveOnAt:
+                timeouts.append((start, 'window'))
+                break
+            match = parser_re.match(text, start, end)
+            if match:
+                yield match
+                start = pos = match.end()
+            else:
+                start += 1
+        pos = max(pos, a + 1)
+
+
+# Scanning UTF-8 bytes (iterCoordinatesBytes): the degree marks are found in
+# the bytes themselves, and only a window of text around them is decoded and
+# normalized. degmarkBytes_re finds the UTF-8 of every form of degree mark
+# normalizeMarks knows, so no mark GeoFinditer would try is passed over. The
+# lookahead on their first bytes lets the search skip ahead quickly.
+degmarkBytes = sorted([mark.encode('utf-8') for mark in
+    [DEGREE] + [variant for variant, mark in markTable.items() if mark == DEGREE and variant != u'&deg;']], key=len, reverse=True)
+degmarkBytes_re = re.compile('(?=[%s])(?:%s)' % (''.join(sorted(set(re.escape(mark[0]) for mark in degmarkBytes + ['d', 'D']))),
+                                                 '|'.join([re.escape(mark) for mark in degmarkBytes] + ['[dD][eE][gG]'])))
+# Runs of well-formed UTF-8, or one byte that isn't part of any
+utf8Run_re = re.compile(r'(?:[\x00-\x7f]|[\xc2-\xdf][\x80-\xbf]|\xe0[\xa0-\xbf][\x80-\xbf]|[\xe1-\xef][\x80-\xbf]{2}|'
+                        r'\xf0[\x90-\xbf][\x80-\xbf]{2}|[\xf1-\xf3][\x80-\xbf]{3}|\xf4[\x80-\x8f][\x80-\xbf]{2})+|([\x80-\xff])')
+lookBehindBytes = 1024  # Bytes decoded before a degree mark at first, when it is far from the last one
+minWindowBytes = 6 * (matchWidth + 1 + windowMargin)  # Room for one whole match (a normalized character is at most 6 bytes)
+
+
+class ByteWindow(object):
+    """
+    data[start:end] (UTF-8 bytes, or a memory map of them) decoded and run
+    through normalizeMarks, with the way back from positions in the
+    normalized text to byte offsets in data. A byte that isn't part of a
+    UTF-8 character is read as U+FFFD.
+    """
+    def __init__(self, data, start, end):
+        raw = data[start:end]
+        self.start = start
+        self.end = start + len(raw)
+        self.bad = []  # Positions in chars of the bytes that weren't UTF-8
+        try:
+            self.chars = raw.decode('utf-8')
+        except UnicodeDecodeError:
+            pieces = []
+            size = 0
+            for run in utf8Run_re.finditer(raw):
+                if run.group(1) is None:
+                    piece = run.group().decode('utf-8')
+                else:
+                    piece = u'\ufffd'
+                    self.bad.append(size)
+                pieces.append(piece)
+                size += len(piece)
+            self.chars = u''.join(pieces)
+        self.text, self.offsets = normalizeMarks(self.chars)
+        self._char = self._byte = 0  # last character converted to a byte offset, and its offset
+
+    def byte(self, pos):
+        # Byte offset in data of position pos of the normalized text (or of
+        # the end of a character that ends there)
+        char = originalSpan(self.offsets, pos, pos)[0]
+        if char < self._char:
+            self._char = self._byte = 0
+        self._byte += len(self.chars[self._char:char].encode('utf-8')) - 2 * (bisect_left(self.bad, char) - bisect_left(self.bad, self._char))
+        self._char = char
+        return self.start + self._byte
+
+    def span(self, start, end):
+        # Byte offsets in data and the text as decoded of a span of the normalized text
+        first, last = originalSpan(self.offsets, start, end)
+        return self.byte(start), self.byte(end), self.chars[first:last]
+
+
+def charStart(data, pos):
+    # The start of the UTF-8 character byte pos of data is part of
+    if pos >= len(data):
+        return len(data)
+    for back in xrange(3):
+        if pos <= 0 or not '\x80' <= data[pos] <= '\xbf':
+            break
+        pos -= 1
+    return max(pos, 0)
+
+
+def GeoFinditerBytes(data, windowLimit=None, documentLimit=None, timeouts=None):
+    """
+    GeoFinditer for UTF-8 bytes: yield (match, window) for the same matches
+    GeoFinditer would give in the normalized text of data.decode('utf-8'),
+    where match is made in window.text and window is the ByteWindow that
+    maps it back to byte offsets. data is decoded scanWindowBytes at a time
+    around its degree marks; the text between marks is never decoded.
+
+    What GeoFinditer carries from one degree mark to the next is pos, where
+    a full scan would carry on from: no attempt starts before it, and every
+    mark before it has been tried. A window starts at the character before
+    pos, so it sees everything the next attempts can, or, when the next mark
+    is far off, far enough before that mark that the run of text it can
+    start in (candidateStart) begins inside the window. Marks too close to
+    the end of a window to fit a whole match are left for the next one.
+    Timeouts are appended to timeouts as byte offsets.
+    """
+    n = len(data)
+    if timeouts is None:
+        timeouts = []
+    stopAt = timer() + documentLimit if documentLimit is not None else None
+    posByte = 0  # pos, as a byte offset in data
+    searchFrom = 0  # where to look for the next degree mark in data
+    while True:
+        found = degmarkBytes_re.search(data, searchFrom)
+        if found is None:
+            return
+        end = charStart(data, found.end() + max(scanWindowBytes, minWindowBytes))
+        back = lookBehindBytes
+        while True:
+            start = charStart(data, found.start() - back)
+            if start <= posByte:
+                # Start at the character before pos, which is position 1 of the window
+                start = charStart(data, posByte - 1)
+                window = ByteWindow(data, start, end)
+                pos = 1 if posByte else 0
+                break
+            window = ByteWindow(data, start, end)
+            pos = 0
+            first = degmark_re.search(window.text)
+            if first is None or len(window.text[:candidateStart(window.text, first.start(), latPrefix_re)].rstrip(u' .:')) >= windowMargin:
+                break
+            back *= 4
+        text = window.text
+        if window.end < n:
+            fits = len(text) - windowMargin - matchWidth - 1  # last mark with room for a whole match after it
+        else:
+            fits = len(text)
+        left = None  # first mark left for the next window
+        for mark in degmark_re.finditer(text):
+            a = mark.start()
+            if a < pos:
+                continue  # GeoFinditer would try nothing here
+            if a > fits:
+                left = a
+                break
+            stop = min(len(text), a + matchWidth + 1)
+            start = max(pos, candidateStart(text, a, latPrefix_re))
+            if stopAt is not None and start < a and timer() > stopAt:
+                timeouts.append((window.byte(start), 'document'))
+                return
+            moveOnAt = timer() + windowLimit if windowLimit is not None else None
+            while start < a:
+                if moveOnAt is not None and timer() > moveOnAt:
+                    timeouts.append((window.byte(start), 'window'))
+                    break
+                match = parser_re.match(text, start, stop)
+                if match:
+                    yield match, window
+                    start = pos = match.end()
+                else:
+                    start += 1
+            pos = max(pos, a + 1)
+        if left is None and window.end >= n:
+            return
+        posByte = window.byte(pos)
+        if left is not None:
+            searchFrom = window.byte(left)
+        else:
+            # A mark cut by the end of the window is looked for again
+            searchFrom = max(posByte, window.byte(max(0, len(text) - windowMargin)))
+
+
+# Scanning text given in chunks (iterCoordinatesChunks). Everything parser_re
+# matches in front of its degree mark (words, hemisphere, sign and degrees)
+# is under 40 characters long, so once the scan has moved past a stretch of
+# text, at most that much of it before the next degree mark is still needed.
+chunkOverlap = matchWidth + windowMargin  # Characters kept before the next degree mark when a window moves on
+
+
+def GeoFinditerChunks(chunks, windowLimit=None, documentLimit=None, timeouts=None):
+    """
+    GeoFinditer for text given as an iterable of unicode chunks: yield
+    (match, window) for the same matches GeoFinditer would give in the
+    normalized text of u''.join(chunks), where match is made in window.text
+    and window is the ChunkWindow (jmap_geocommon.py) that maps it back to
+    the whole text. The text is read scanChunkChars at a time, and only
+    chunkOverlap characters of what has been scanned are kept, so memory
+    stays bounded by the chunk size however long the text is.
+
+    A mark is only tried once the window holds a whole match after it; the
+    rest are left for the next window, which starts chunkOverlap characters
+    before the first of them (or at the character before pos, if that's
+    later). No attempt is made at the first character of a window that was
+    cut short of pos: a match starting that far before the next mark would
+    have had its own degree mark in the last window, and been tried there.
+    Timeouts are appended to timeouts as positions in the whole text.
+    """
+    if timeouts is None:
+        timeouts = []
+    stopAt = timer() + documentLimit if documentLimit is not None else None
+    window = ChunkWindow(chunks, scanChunkChars)
+    pos = 0  # where a full finditer would carry on from, in window.text
+    while True:
+        text = window.text
+        if window.final:
+            fits = len(text)
+        else:
+            fits = len(text) - windowMargin - matchWidth - 1  # last mark with room for a whole match after it
+        first = 1 if window.base else 0  # first position an attempt can start at
+        left = fits + 1  # first mark left for the next window
+        for mark in degmark_re.finditer(text, pos):
+            a = mark.start()
+            if a > fits:
+                left = a
+                break
+            stop = min(len(text), a + matchWidth + 1)
+            start = max(pos, first, candidateStart(text, a, latPrefix_re))
+            if stopAt is not None and start < a and timer() > stopAt:
+                timeouts.append((window.span(start, start)[0], 'document'))
+                return
+            moveOnAt = timer() + windowLimit if windowLimit is not None else None
+            while start < a:
+                if moveOnAt is not None and timer() > moveOnAt:
+                    timeouts.append((window.span(start, start)[0], 'window'))
+                    break
+                match = parser_re.match(text, start, stop)
+                if match:
+                    yield match, window
+                    start = pos = match.end()
+                else:
+                    start += 1
+            pos = max(pos, a + 1)
+        if window.final:
+            return
+        cut = max(0, left - chunkOverlap, min(pos - 1, left))
+        window.advance(cut)
+        pos = max(0, pos - cut)
+
+
+def iterCoordinates(text, batchSize=32):
+    """
+    Find the coordinates in a unicode string of article text in a single
+    lazy pass: a CoordinateScan of CoordinateMatch records whose spans and
+    text are those of the text as given (it is normalized here). Like the
+    loop over parser_re matches it replaces, it stops at the first match
+    GeoCleanup rejects, and raises the error GeoConvert gives for a match it
+    can't convert when it gets to it. Matches are converted batchSize at a
+    time with GeoConvertBatch.
+    The scan is guarded by windowTimeLimit and documentTimeLimit (see
+    GeoFinditer); where it gave up is in the scan's timeouts, as positions
+    in the text as given.
+    """
+    def scanner(scan):
+        normText, offsets = normalizeMarks(text)
+        found = []
+        timeouts = []
+        def timedOut():
+            # Move where GeoFinditer gave up so far over to the scan
+            for pos, limit in timeouts:
+                scan.timeouts.append((originalSpan(offsets, pos, pos)[0], limit))
+            del timeouts[:]
+        for match in GeoFinditer(normText, windowTimeLimit, documentTimeLimit, timeouts):
+            timedOut()
+            scan.matched += 1
+            parts = GeoCleanup(match.groupdict())
+            if not parts: break
+            start, end = originalSpan(offsets, match.start(), match.end())
+            found.append((parts, start, end, text[start:end]))
+            if len(found) == batchSize:
+                for coord in _converted(found):
+                    yield coord
+                found = []
+        for coord in _converted(found):
+            yield coord
+        timedOut()
+    return CoordinateScan(scanner)
+
+def _converted(found):
+    # CoordinateMatch records for a list of (GeoCleanup parts, start, end, text)
+    with jmap_instrument.stage('convert'):
+        latitudes, longitudes = GeoConvertBatch([parts for parts, start, end, text in found])
+    for (parts, start, end, text), lat, lon in zip(found, latitudes, longitudes):
+        if lat != lat:
+            GeoConvert(*parts)  # NaN: raise GeoConvert's error for it
+        yield CoordinateMatch(float(lat), float(lon), start, end, text, 're')
+
+def iterCoordinatesBytes(data, batchSize=32):
+    """
+    iterCoordinates for text given as UTF-8 bytes: a byte string, or a
+    memory map of a file (see scanFile). The text is never decoded as a
+    whole, only the windows around its degree marks (see GeoFinditerBytes),
+    so a large document is scanned without a unicode copy of it. The
+    coordinates are the ones iterCoordinates(data.decode('utf-8')) finds,
+    but their spans, and the scan's timeouts, are byte offsets in data.
+    """
+    def scanner(scan):
+        found = []
+        for match, window in GeoFinditerBytes(data, windowTimeLimit, documentTimeLimit, scan.timeouts):
+            scan.matched += 1
+            parts = GeoCleanup(match.groupdict())
+            if not parts: break
+            found.append((parts,) + window.span(match.start(), match.end()))
+            if len(found) == batchSize:
+                for coord in _converted(found):
+                    yield coord
+                found = []
+        for coord in _converted(found):
+            yield coord
+    return CoordinateScan(scanner)
+
+def iterCoordinatesChunks(chunks, batchSize=32):
+    """
+    iterCoordinates for text given as an iterable of unicode chunks (the
+    strings of an article as it is read, say), scanned scanChunkChars at a
+    time (see GeoFinditerChunks) without ever joining them together. The
+    coordinates, their spans and the scan's timeouts are the ones
+    iterCoordinates(u''.join(chunks)) gives.
+    """
+    def scanner(scan):
+        found = []
+        for match, window in GeoFinditerChunks(chunks, windowTimeLimit, documentTimeLimit, scan.timeouts):
+            scan.matched += 1
+            parts = GeoCleanup(match.groupdict())
+            if not parts: break
+            found.append((parts,) + window.span(match.start(), match.end()))
+            if len(found) == batchSize:
+                for coord in _converted(found):
+                    yield coord
+                found = []
+        for coord in _converted(found):
+            yield coord
+    return CoordinateScan(scanner)
+
+def scanFile(path):
+    """
+    iterCoordinatesBytes over a UTF-8 text file (a thesis, a supplementary
+    data dump), memory-mapped rather than read in: only the windows around
+    its degree marks are ever copied out of it.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return iterCoordinatesBytes('')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return iterCoordinatesBytes(data)
+
+def findCoordinates(text):
+    # All of iterCoordinates(text) as a list
+    return list(iterCoordinates(text))
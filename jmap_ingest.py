@@ -0,0 +1,382 @@
+#####################################################################################
+## jmap_ingest.py
+## Streaming ingestion of publisher XML for jmapParseXML. Rather than building a
+## full BeautifulSoup tree for every article, the document is fed through lxml's
+## parser target interface in a single event-driven pass. Only the citation
+## fields and the body text jmapParseXML uses are kept; every other element is
+## dropped as soon as it has been parsed, so no tree is ever built.
+##
+## What is collected is declared by the format adapters in jmap_formats.py:
+## NLM/JATS - <front> metadata, <abstract>, <contrib>, <kwd> and <body> text
+## Elsevier - <coredata> metadata, <subject>, <creator> and <originalText> text
+##
+## decodeArticleXML() gets the raw file into the UTF-8 the parser is fed. Most
+## files are already valid UTF-8 and are used as they are, after one strict
+## decode in C to check; only the rest go on to slower repairs, and only they
+## load BeautifulSoup's encoding tables (bs4 is slow to import).
+##
+## streamArticleXML() reads a file too big to hold in memory: the file is fed
+## to the parser a chunk at a time, and the body text is handed on as it is
+## parsed instead of being collected into one string.
+#####################################################################################
+
+import re, codecs
+from lxml import etree
+import jmap_formats
+from jmap_formats import FormatData
+
+feedSize = 65536  # Number of bytes handed to the parser at a time
+
+decodePathNames = ('utf-8', 'declared', 'detwingle')  # decodeArticleXML paths, fastest first
+ingestVersion = 1  # Bumped when a change here changes what is read from a file, so cached results are parsed again
+
+# What an element can mean to a format, in the order they are handled when
+# an element means more than one thing
+handlerKinds = ('container', 'within', 'field', 'list', 'record', 'part', 'text')
+
+
+def localName(tag):
+    # '{http://prismstandard.org/namespaces/basic/2.0/}doi' -> 'doi'
+    if tag[:1] == '{':
+        return tag[tag.index('}')+1:]
+    return tag
+
+
+def compileFormats(formats):
+    """
+    Turn the format adapters into a table of element name -> list of
+    (kind, format index, name, spec) for ArticleStream to look elements up in.
+    """
+    table = {}
+    def add(element, kind, i, name, spec=None):
+        table.setdefault(element, []).append((handlerKinds.index(kind), i, name, spec))
+    for i, adapter in enumerate(formats):
+        add(adapter.container, 'container', i, None)
+        for name, spec in adapter.fields.items():
+            add(spec.element, 'field', i, name, spec)
+            if spec.within:
+                add(spec.within, 'within', i, spec.within)
+        for name, spec in adapter.lists.items():
+            add(spec.element, 'list', i, name, spec)
+        for name, spec in adapter.records.items():
+            add(spec.element, 'record', i, name, spec)
+            for j, part in enumerate(spec.parts):
+                add(part, 'part', i, name, j)
+        if adapter.text:
+            add(adapter.text, 'text', i, None)
+    for handlers in table.values():
+        handlers.sort(key=lambda handler: handler[:2])
+    return table
+
+_compiled = {}  # formatsVersion -> compiled table of jmap_formats.formats
+
+
+def formatTable():
+    if jmap_formats.formatsVersion not in _compiled:
+        _compiled.clear()
+        _compiled[jmap_formats.formatsVersion] = compileFormats(jmap_formats.formats)
+    return _compiled[jmap_formats.formatsVersion]
+
+
+class ArticleStream(object):
+    """
+    lxml parser target that collects everything the registered formats
+    (jmap_formats.py) need from an article in one pass over the document.
+
+    Text is handled the way BeautifulSoup does it: a string is all the
+    character data between two tags (or comments), the text of an element is
+    all of its strings joined together, and the body text is its stripped,
+    non-empty strings joined with spaces.
+
+    After parsing, collected holds a FormatData for each format, and format /
+    formatData are the adapter and FormatData of the document's format (the
+    first registered one whose container it has), or None. A format's text
+    element is only collected if no other format's container came first.
+
+    With streamText, the first text element is streamed rather than
+    collected: its strings (with the spaces between them) are put in
+    textChunks as they are parsed, for takeText() to hand on, and its
+    FormatData's text is left as u''. textFormat is the index in collected
+    of the format it belongs to, or None if there was none.
+    """
+    def __init__(self, formats=None, table=None, streamText=False):
+        if formats is None:
+            formats, table = jmap_formats.formats, formatTable()
+        self.table = table or compileFormats(formats)
+        self.collected = [FormatData(adapter) for adapter in formats]
+        self.streamText = streamText
+        self.textFormat = None
+        self.textChunks = []
+
+        self._depth = 0
+        self._data = []         # character data of the current string
+        self._captures = []     # (depth, container, key, parts, stripped) of the elements whose text is being collected
+        self._scopes = []       # (depth, kind, key) of the open elements that matter when they close
+        self._seen = 0          # number of formats whose container has been seen
+        self._open = set()      # formats whose container is open, and (format, element) of the open `within` elements
+        self._within = set()    # (format, element) of the `within` elements seen, as only the first one counts
+        self._records = {}      # (format, record name) -> the open records, innermost last
+        self._streamed = False  # whether any of the streamed text has been put in textChunks
+
+    @property
+    def formatData(self):
+        for data in self.collected:
+            if data.seen:
+                return data
+        return None
+
+    @property
+    def format(self):
+        data = self.formatData
+        return data and data.adapter
+
+    def _capture(self, container, key, stripped=False, streamed=False):
+        # Collect the text of the element that was just opened and store it
+        # in container[key] when the element closes. Stripped text is the
+        # element's stripped, non-empty strings joined by spaces. Streamed
+        # text goes to textChunks instead (parts is None).
+        container[key] = u''
+        self._captures.append((self._depth, container, key, None if streamed else [], stripped))
+
+    def _captureItem(self, items, item=u''):
+        items.append(item)
+        self._capture(items, len(items)-1)
+
+    def _finish(self):
+        depth, container, key, parts, stripped = self._captures.pop()
+        if parts is not None:
+            container[key] = (u" " if stripped else u"").join(parts)
+
+    def _flush(self):
+        # Close off the current string and hand it to everyone collecting text
+        if not self._data:
+            return
+        s = u''.join(self._data)
+        self._data = []
+        for depth, container, key, parts, stripped in self._captures:
+            if parts is None:
+                if s.strip():
+                    if self._streamed:
+                        self.textChunks.append(u" ")
+                    self.textChunks.append(s.strip())
+                    self._streamed = True
+            elif not stripped:
+                parts.append(s)
+            elif s.strip():
+                parts.append(s.strip())
+
+    def start(self, tag, attrib):
+        self._flush()
+        self._depth += 1
+        handlers = self.table.get(localName(tag))
+        if not handlers:
+            return
+        for kind, i, name, spec in handlers:
+            data = self.collected[i]
+            if kind == 0:  # container
+                if not data.seen:
+                    data.seen = True
+                    self._seen += 1
+                    self._open.add(i)
+                    self._scopes.append((self._depth, 'container', i))
+            elif kind == 1:  # within
+                if i in self._open and (i, name) not in self._within:
+                    self._within.add((i, name))
+                    self._open.add((i, name))
+                    self._scopes.append((self._depth, 'within', (i, name)))
+            elif kind == 2:  # field
+                if (i in self._open and name not in data.fields
+                        and (spec.within is None or (i, spec.within) in self._open)
+                        and (spec.attrib is None or all(attrib.get(k) == v for k, v in spec.attrib.items()))):
+                    self._capture(data.fields, name)
+            elif kind == 3:  # list
+                if not spec.scoped or i in self._open:
+                    if spec.attrib:
+                        item = [attrib.get(spec.attrib), u'']
+                        data.lists[name].append(item)
+                        self._capture(item, 1)
+                    else:
+                        self._captureItem(data.lists[name])
+            elif kind == 4:  # record
+                if not spec.scoped or i in self._open:
+                    record = [None] * len(spec.parts)
+                    data.lists[name].append(record)
+                    self._records.setdefault((i, name), []).append(record)
+                    self._scopes.append((self._depth, 'record', (i, name)))
+            elif kind == 5:  # part of the innermost open record
+                records = self._records.get((i, name))
+                if records and records[-1][spec] is None:
+                    self._capture(records[-1], spec)
+            elif kind == 6:  # text
+                if data.text is None and (data.seen or not self._seen):
+                    streamed = self.streamText and self.textFormat is None
+                    if streamed:
+                        self.textFormat = i
+                    self._capture(data.__dict__, 'text', stripped=True, streamed=streamed)
+
+    def end(self, tag):
+        self._flush()
+        depth = self._depth
+        self._depth -= 1
+        while self._captures and self._captures[-1][0] == depth:
+            self._finish()
+        while self._scopes and self._scopes[-1][0] == depth:
+            depth, kind, key = self._scopes.pop()
+            if kind == 'record':
+                self._records[key].pop()
+            else:
+                self._open.discard(key)
+
+    def data(self, data):
+        self._data.append(data)
+
+    def takeText(self):
+        # The streamed text parsed since the last call
+        chunks, self.textChunks = self.textChunks, []
+        return chunks
+
+    def comment(self, text):
+        self._flush()
+
+    def pi(self, target, data=None):
+        self._flush()
+
+    def close(self):
+        # A truncated or broken document can end with elements still open;
+        # their text so far still counts, as it would in a BeautifulSoup tree
+        self._flush()
+        while self._captures:
+            self._finish()
+        return self
+
+
+_dammit = None  # bs4.dammit, imported the first time a file needs more than the UTF-8 check
+
+def _loadDammit():
+    global _dammit
+    if _dammit is None:
+        from bs4 import dammit
+        _dammit = dammit
+    return _dammit
+
+
+def _windows1252(match):
+    # A byte that isn't part of a UTF-8 character, read as Windows-1252
+    byte = match.group(1)
+    if byte is None:
+        return match.group(0)
+    return _dammit.UnicodeDammit.WINDOWS_1252_TO_UTF8.get(ord(byte)) or byte.decode('latin-1').encode('utf-8')
+
+# A well-formed UTF-8 multibyte character (as Python's decoder accepts them),
+# or else one byte that isn't ASCII
+utf8Char_re = re.compile(r'[\xc2-\xdf][\x80-\xbf]|\xe0[\xa0-\xbf][\x80-\xbf]|[\xe1-\xef][\x80-\xbf]{2}|'
+                         r'\xf0[\x90-\xbf][\x80-\xbf]{2}|[\xf1-\xf3][\x80-\xbf]{3}|\xf4[\x80-\x8f][\x80-\xbf]{2}|([\x80-\xff])')
+
+# Declared encodings whose text detwingling reads correctly
+windows1252Encodings = ('iso-8859-1', 'latin-1', 'latin1', 'windows-1252', 'cp1252', 'us-ascii', 'ascii')
+
+# The encoding named by an XML declaration at the start of a document (after any UTF-8 byte order mark)
+xmlDeclEncoding_re = re.compile(r'^((?:\xef\xbb\xbf)?\s*<\?xml\b[^>]*?\bencoding\s*=\s*)(["\'])[^"\']*\2')
+
+
+def detwingle(xml):
+    """
+    Convert the Windows-1252 characters mixed into a UTF-8 byte string, as
+    UnicodeDammit.detwingle does, but leaving only well-formed UTF-8
+    characters alone: a byte that merely looks like the start of one (e.g.
+    ISO-8859-1 e-acute before a tag) is converted rather than taking the
+    bytes after it along.
+    """
+    _loadDammit()
+    return utf8Char_re.sub(_windows1252, xml)
+
+
+def declareUTF8(xml):
+    # The UTF-8 document xml with its XML declaration (if any) naming UTF-8;
+    # lxml goes by the declaration, whatever encoding the parser is given
+    return xmlDeclEncoding_re.sub(r'\1\2utf-8\2', xml, 1)
+
+
+def decodeArticleXML(xml):
+    """
+    Return the article file `xml` (a byte string) as UTF-8, and which way
+    it was decoded (a converted file's XML declaration is changed to say
+    UTF-8):
+      'utf-8'     - valid UTF-8, used as it is
+      'declared'  - in the encoding named by its byte order mark or XML
+                    declaration, one that isn't Windows-1252 or a subset
+      'detwingle' - UTF-8 with Windows-1252 characters mixed in, or wholly
+                    ISO-8859-1/Windows-1252, converted by detwingle()
+    """
+    try:
+        # The UTF-16 and UTF-32 byte order marks aren't valid UTF-8, so this
+        # is all a file without one (or with UTF-8's) needs
+        xml.decode('utf-8')
+        return xml, 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    EncodingDetector = _loadDammit().EncodingDetector
+    data, encoding = EncodingDetector.strip_byte_order_mark(xml)
+    if encoding in (None, 'utf-8'):
+        encoding = EncodingDetector.find_declared_encoding(xml, is_html=False)
+    if encoding and encoding not in ('utf-8', 'utf8') + windows1252Encodings:
+        try:
+            return declareUTF8(data.decode(encoding).encode('utf-8')), 'declared'
+        except (UnicodeDecodeError, LookupError):
+            pass
+    return declareUTF8(detwingle(xml)), 'detwingle'
+
+
+def readArticleXML(xml):
+    """
+    Stream the UTF-8 encoded XML document `xml` (a byte string) through an
+    ArticleStream and return it. The parser is set up the way BeautifulSoup's
+    "xml" builder sets it up, including recovering from malformed markup.
+    """
+    target = ArticleStream()
+    parser = etree.XMLParser(target=target, strip_cdata=False, recover=True, encoding='utf-8')
+    try:
+        for i in xrange(0, len(xml), feedSize):
+            parser.feed(xml[i:i+feedSize])
+        return parser.close()
+    except etree.XMLSyntaxError:
+        # Nothing recoverable (e.g. an empty file); keep whatever was read
+        return target.close()
+
+
+def readUTF8Chunks(path):
+    """
+    The file at path, feedSize bytes at a time, checked to be UTF-8 as it
+    is read: UnicodeDecodeError is raised at the first chunk that isn't.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(feedSize), ''):
+            decoder.decode(chunk)
+            yield chunk
+    decoder.decode('', True)
+
+
+def streamArticleXML(chunks):
+    """
+    readArticleXML for a document given as an iterable of UTF-8 byte string
+    chunks, that is never held in memory whole. Returns (stream, text):
+    stream is the ArticleStream (with streamText), and text an iterator over
+    the text of its text element, a piece at a time, that feeds the document
+    to the parser as it goes; stream is complete once text is exhausted.
+    Joined, the pieces are the text readArticleXML would have collected.
+    """
+    target = ArticleStream(streamText=True)
+    def text():
+        parser = etree.XMLParser(target=target, strip_cdata=False, recover=True, encoding='utf-8')
+        try:
+            for chunk in chunks:
+                parser.feed(chunk)
+                for piece in target.takeText():
+                    yield piece
+            parser.close()
+        except etree.XMLSyntaxError:
+            target.close()
+        for piece in target.takeText():
+            yield piece
+    return target, text()
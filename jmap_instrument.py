@@ -0,0 +1,197 @@
+#####################################################################################
+## jmap_instrument.py
+## Optional per-stage timing of the jmapParseXML pipeline. When a run is
+## instrumented, every article gets a StageTimer that records the wall time,
+## CPU time and bytes of each stage it goes through:
+##   read       - reading the file and taking its digest (bytes of the file)
+##   cache      - looking it up in the result cache
+##   decode     - getting the file to UTF-8 (decodeArticleXML): a strict check
+##                for most files, repairs for the rest (bytes of the file)
+##   ingest     - readArticleXML: the one streaming lxml pass that collects the
+##                metadata fields and the body text (bytes of XML)
+##   metadata   - building the Article: citation fields, authors, keywords
+##   geoparse   - normalizing the text and scanning it for coordinates
+##                (characters of text)
+##   convert    - converting the matches to decimal degrees (GeoConvertBatch,
+##                calcDD); taken out of geoparse
+##   record     - building the article CSV row
+##   write      - writing the output rows, and the manifest entries whenever a
+##                batch is flushed (bytes of CSV written)
+##   cache_write - storing the result in the cache
+## Each stage's time is its own: time spent in a nested stage (convert) is not
+## counted again in the stage around it (geoparse).
+##
+## A StageReport gathers the timers of a whole run into totals per stage,
+## histograms of the per-article time of each stage and the slowest articles
+## with their stage breakdown, and writes it all out as JSON.
+#####################################################################################
+
+import os, json, math, heapq
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+try:
+    import resource
+    def cpuTime():
+        # CPU seconds (user and system) used by this process so far
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+except ImportError:  # Windows
+    def cpuTime():
+        times = os.times()
+        return times[0] + times[1]
+
+# Stages in pipeline order, for reports
+stageOrder = ['read', 'cache', 'decode', 'ingest', 'metadata', 'geoparse', 'convert', 'record', 'write', 'cache_write']
+
+activeTimer = None  # StageTimer of the article this process is working on, if the run is instrumented
+
+
+class StageTimer(object):
+    """
+    Wall time, CPU time and bytes of each stage of processing one article.
+    A stage runs from the previous lap() (or from when the timer was made or
+    restarted) to the lap() that names it.
+
+    Usage example:
+
+    stages = StageTimer()
+    xml = f.read()
+    stages.lap('read', len(xml))
+    ...
+    result.stages = stages.stages
+    """
+    def __init__(self):
+        self.stages = {}  # stage name -> [wall seconds, CPU seconds, bytes]
+        self.restart()
+
+    def restart(self):
+        # Start the next stage now, leaving the time since the last lap out
+        self._wall = timer()
+        self._cpu = cpuTime()
+        self._nestedWall = self._nestedCpu = 0.0
+
+    def lap(self, name, size=0):
+        wall, cpu = timer(), cpuTime()
+        self._add(name, wall - self._wall - self._nestedWall, cpu - self._cpu - self._nestedCpu, size)
+        self._wall, self._cpu = wall, cpu
+        self._nestedWall = self._nestedCpu = 0.0
+
+    def add(self, name, wall, cpu, size=0):
+        # Time of a stage nested in the current one, which is then left out
+        # of the current one when it ends
+        self._add(name, wall, cpu, size)
+        self._nestedWall += wall
+        self._nestedCpu += cpu
+
+    def _add(self, name, wall, cpu, size):
+        stage = self.stages.setdefault(name, [0.0, 0.0, 0])
+        stage[0] += wall
+        stage[1] += cpu
+        stage[2] += size
+
+
+class NullTimer(object):
+    # Stands in for a StageTimer when the run isn't instrumented
+    stages = None
+
+    def restart(self):
+        pass
+
+    def lap(self, name, size=0):
+        pass
+
+    def add(self, name, wall, cpu, size=0):
+        pass
+
+noTimer = NullTimer()
+
+
+@contextmanager
+def stage(name):
+    # Time the block as a stage nested in the current stage of activeTimer,
+    # if this article is being timed
+    stages = activeTimer
+    if stages is None:
+        yield
+        return
+    wall, cpu = timer(), cpuTime()
+    try:
+        yield
+    finally:
+        stages.add(name, timer() - wall, cpuTime() - cpu)
+
+
+def histogramBucket(seconds):
+    # Upper bound in milliseconds of the power-of-two bucket a time falls in
+    ms = seconds * 1000
+    if ms <= 1.0 / 64:
+        return 1.0 / 64
+    return 2.0 ** math.ceil(math.log(ms, 2))
+
+
+class StageReport(object):
+    """
+    Stage times of every article in a run: totals per stage, a histogram
+    of the per-article wall time of each stage, and the `slowest` articles
+    by total wall time with their stages.
+    """
+    def __init__(self, slowest=20):
+        self.slowest = slowest
+        self.articles = 0
+        self.totals = {}      # stage name -> [wall seconds, CPU seconds, bytes, articles]
+        self.histograms = {}  # stage name -> {bucket upper bound in ms: articles}
+        self._slowest = []    # heap of (total wall seconds, file, stages)
+
+    def add(self, xmlFile, stages):
+        self.articles += 1
+        for name, (wall, cpu, size) in stages.items():
+            total = self.totals.setdefault(name, [0.0, 0.0, 0, 0])
+            total[0] += wall
+            total[1] += cpu
+            total[2] += size
+            total[3] += 1
+            histogram = self.histograms.setdefault(name, {})
+            bucket = histogramBucket(wall)
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+        entry = (sum(s[0] for s in stages.values()), xmlFile, stages)
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, entry)
+        elif self.slowest:
+            heapq.heappushpop(self._slowest, entry)
+
+    def stageNames(self):
+        return [s for s in stageOrder if s in self.totals] + sorted(s for s in self.totals if s not in stageOrder)
+
+    def asDict(self):
+        # The report as it is written out
+        def stageDict(wall, cpu, size):
+            return {'wall_seconds': wall, 'cpu_seconds': cpu, 'bytes': size}
+        stages = []
+        for name in self.stageNames():
+            wall, cpu, size, articles = self.totals[name]
+            entry = stageDict(wall, cpu, size)
+            entry.update({'stage': name, 'articles': articles,
+                          'mb_per_sec': size / wall / 1048576 if wall and size else None,
+                          'histogram_ms': [[bucket, count] for bucket, count in sorted(self.histograms[name].items())]})
+            stages.append(entry)
+        slowest = [{'file': xmlFile, 'wall_seconds': total,
+                    'stages': dict((name, stageDict(*s)) for name, s in articleStages.items())}
+                   for total, xmlFile, articleStages in sorted(self._slowest, reverse=True)]
+        return {'articles': self.articles, 'stages': stages, 'slowest': slowest}
+
+    def summary(self):
+        # Lines for the end of the run: the totals of each stage, then the
+        # five slowest articles
+        lines = ["%-12s %10s %10s %10s %9s" % ('Stage', 'Wall (s)', 'CPU (s)', 'MB', 'Articles')]
+        for name in self.stageNames():
+            wall, cpu, size, articles = self.totals[name]
+            lines.append("%-12s %10.3f %10.3f %10.2f %9d" % (name, wall, cpu, size / 1048576.0, articles))
+        for total, xmlFile, stages in sorted(self._slowest, reverse=True)[:5]:
+            lines.append("%.3fs %s (%s)" % (total, xmlFile, ", ".join(
+                "%s %.3f" % (name, stages[name][0]) for name in stageOrder if name in stages)))
+        return lines
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.asDict(), f, indent=2, sort_keys=True)
@@ -0,0 +1,71 @@
+#####################################################################################
+## jmap_log.py
+## Streaming log of a jmapParseXML run, written as JSON lines: one record per
+## line, as the run goes, rather than kept in memory and written at the end.
+## Each record is a JSON object
+##   {"time": "2016-05-12 10:31:07", "level": "info", "event": "processing",
+##    "message": "Processing ...", "file": "...", ...}
+## with any other fields the event has. Records below the log's level are
+## not written, and only those at or above consoleLevel are printed, so the
+## per-match "coordinate" records (level "debug") are only there when asked
+## for. The final "summary" record of the run's counters is always written.
+##
+## Writes go through a buffer that is flushed every flushSeconds, whenever a
+## warning or error is logged, and on close, so a run that dies leaves all but
+## the last moments of its log on disk.
+#####################################################################################
+
+import json
+from datetime import datetime
+from timeit import default_timer as timer
+
+levels = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+
+
+class RunLog(object):
+    """
+    Usage example:
+
+    runlog = RunLog(startDir + '/jmap_parse.jsonl', level='info', consoleLevel='warning')
+    runlog.log('info', "Starting processing of " + startDir, event='start')
+    runlog.log('debug', "Found coordinate in ...", event='coordinate', file=xmlFile)
+    runlog.close()
+    """
+    def __init__(self, path, level='info', consoleLevel='info', append=False, flushSeconds=2.0):
+        self.path = path
+        self.level = levels[level]
+        self.consoleLevel = levels[consoleLevel]
+        self.flushSeconds = flushSeconds
+        self.counts = dict((name, 0) for name in levels)  # records logged at each level
+        self.f = open(path, 'a' if append else 'w')
+        self.flushed = timer()
+
+    def log(self, level, message, event='message', **fields):
+        rank = levels[level]
+        if rank >= self.consoleLevel:
+            print message.encode('utf-8') if isinstance(message, unicode) else message
+        if rank >= self.level:
+            self._write(level, event, message, fields)
+
+    def summary(self, message, **counters):
+        # The run's final counters, written (not printed) whatever the level,
+        # with the number of records logged at each level
+        counters['records'] = dict(self.counts)
+        self._write('info', 'summary', message, counters)
+        self.flush()
+
+    def _write(self, level, event, message, fields):
+        self.counts[level] += 1
+        record = {'time': datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S'),
+                  'level': level, 'event': event, 'message': message}
+        record.update(fields)
+        self.f.write(json.dumps(record, sort_keys=True) + "\n")
+        if levels[level] >= levels['warning'] or timer() - self.flushed >= self.flushSeconds:
+            self.flush()
+
+    def flush(self):
+        self.f.flush()
+        self.flushed = timer()
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,105 @@
+#####################################################################################
+## jmap_manifest.py
+## Checkpoint manifest for jmapParseXML runs. Every article file that has been
+## processed gets one row in a CSV manifest, written and flushed right after the
+## file's rows have been flushed to the output (see jmap_output.py). Each row
+## also records how far the articles and locations output had been written at
+## that point (byte offsets for CSV, row counts otherwise), so an interrupted
+## run can be resumed: the outputs are cut back to the last checkpoint and the
+## files already in the manifest are skipped, without losing or duplicating any
+## output rows. An article the watchdog stopped (see jmap_workers.py) has the
+## limit it went over and the stage it was in, e.g. "time:geoparse", in the
+## stopped column. One whose scan hit the re geoparser's time limits has which
+## limits and how often, e.g. "window:2;document:1", in the timeouts column.
+#####################################################################################
+
+import os
+import csv
+from collections import OrderedDict
+
+manifestFields = ['file', 'size', 'mtime', 'outcome', 'geotagged', 'article_rows', 'location_rows', 'articles_offset', 'locations_offset', 'stopped', 'timeouts']
+countFields = ['geotagged', 'article_rows', 'location_rows', 'articles_offset', 'locations_offset']
+
+
+class RunManifest(object):
+    """
+    Usage example:
+
+    manifest = RunManifest(startDir + '/jmap_manifest.csv')
+    manifest.load()              # only when resuming
+    checkpoint = manifest.last() # where the outputs can be cut back to
+    manifest.open(append=checkpoint is not None)
+    for each article:
+        ... write and flush the article's output rows ...
+        manifest.record(xmlFile, 'written', True, 1, 3, *sink.position())
+    manifest.close()
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = OrderedDict()  # file -> manifest row (dict)
+        self.f = None
+        self.writer = None
+
+    def load(self):
+        """
+        Read the manifest of an earlier run, if there is one. A row cut off
+        by a crash (no line ending) is ignored, as if it was never written.
+        """
+        self.entries = OrderedDict()
+        if not os.path.exists(self.path):
+            return self.entries
+        with open(self.path, 'rb') as f:
+            lines = f.read().splitlines(True)
+        if lines and not lines[-1].endswith('\n'):
+            lines.pop()
+        for row in csv.DictReader(lines):
+            for field in countFields:
+                row[field] = int(row[field])
+            for field in ('stopped', 'timeouts'):
+                row[field] = row.get(field) or ''  # Not in manifests of older runs
+            self.entries[row['file']] = row
+        return self.entries
+
+    def last(self):
+        # The most recent complete checkpoint, or None
+        if not self.entries:
+            return None
+        return next(reversed(self.entries.values()))
+
+    def __contains__(self, xmlFile):
+        return xmlFile in self.entries
+
+    def open(self, append=False):
+        if append:
+            # Rewrite the manifest without any partial last row, then add to it
+            self.f = open(self.path, 'wb')
+            self.writer = csv.writer(self.f)
+            self.writer.writerow(manifestFields)
+            for row in self.entries.values():
+                self.writer.writerow([row[field] for field in manifestFields])
+        else:
+            self.entries = OrderedDict()
+            self.f = open(self.path, 'wb')
+            self.writer = csv.writer(self.f)
+            self.writer.writerow(manifestFields)
+        self.f.flush()
+
+    def record(self, xmlFile, outcome, geotagged, articleRows, locationRows, articlesOffset, locationsOffset, stopped='', timeouts=''):
+        """
+        Checkpoint one processed file. The output files must already be
+        flushed up to the given offsets.
+        """
+        try:
+            st = os.stat(xmlFile)
+            size, mtime = st.st_size, int(st.st_mtime)
+        except OSError:
+            size, mtime = -1, -1
+        row = dict(zip(manifestFields, [xmlFile, size, mtime, outcome, int(geotagged), articleRows, locationRows, articlesOffset, locationsOffset, stopped, timeouts]))
+        self.writer.writerow([row[field] for field in manifestFields])
+        self.f.flush()
+        self.entries[xmlFile] = row
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
@@ -0,0 +1,269 @@
+#####################################################################################
+## jmap_output.py
+## Output sinks for jmapParseXML: where the article and location rows go.
+## Rows are buffered and written out a batch at a time rather than one call
+## per row. Three sinks, with the same two tables and columns:
+##   CSVSink      - articles.csv and locations.csv, as JournalMap imports them.
+##                  Rows are encoded to UTF-8 once, into an in-memory buffer
+##                  that is written to the file in one go.
+##   SQLiteSink   - an SQLite database with an articles and a locations table,
+##                  each batch added in one transaction. latitude/longitude
+##                  are stored as numbers and the yes/no columns as 0/1.
+##   ColumnarSink - a zip file with the rows stored by column: each batch adds
+##                  one JSON member per table holding a list of values for
+##                  every column (typed as in the SQLite sink). readColumns()
+##                  loads a table back as {column: [values]}.
+## Later steps can load the SQLite or columnar output without parsing CSV.
+##
+## position() is how far each table has been written, rows still in the
+## buffer included: byte offsets for CSV, row counts for the others. It is
+## what the run manifest records, and an interrupted run is resumed by
+## opening the sink with the position of the last checkpoint, which cuts the
+## output back to it. Only positions reached by a flush() are safe to record.
+#####################################################################################
+
+import os, json, zipfile, sqlite3
+import csv, cStringIO
+from collections import OrderedDict
+
+articleFields = ['doi','publisher_name','publisher_abbreviation','citation','title','publish_year','first_author','authors_list','volume_issue_pages','volume','issue','start_page','end_page','keywords_list','no_keywords_list','abstract','no_abstract','url']
+locationFields = ['doi','title','longitude','latitude','place','no_recorded_place','coordinates','coordinate_type','no_recorded_coordinate','location_type','location_scale','location_reliability','location_conformance','error_type','error_description']
+tableFields = OrderedDict([('articles', articleFields), ('locations', locationFields)])
+
+# Columns stored as something other than text by the SQLite and columnar sinks
+realColumns = set(['longitude', 'latitude'])
+booleanColumns = set(['no_keywords_list', 'no_abstract', 'no_recorded_place', 'no_recorded_coordinate'])
+
+columnarFormat = 1  # Bump when the layout of the columnar file changes
+
+
+def typedValue(field, value):
+    # A row value as the SQLite and columnar sinks store it
+    if value is None or value == '':
+        return None
+    if field in realColumns:
+        return float(value)
+    if field in booleanColumns:
+        return value if isinstance(value, bool) else value in ('True', 'true', '1', 1)
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if isinstance(value, unicode):
+        return value
+    return unicode(value)
+
+
+class OutputSink(object):
+    """
+    Buffers the rows of each table until flush(). Subclasses write a batch
+    out in _writeRows().
+
+    Usage example:
+
+    sink = CSVSink(articlesFile, locationsFile)
+    sink.write('locations', result.locationLines)
+    sink.write('articles', [result.articleLine])
+    position = sink.position()
+    if sink.full():
+        sink.flush()
+        ... checkpoint up to position ...
+    sink.close()
+    """
+    def __init__(self, batchRows=500):
+        self.batchRows = batchRows
+        self.buffers = dict((table, []) for table in tableFields)
+        self.rows = dict((table, 0) for table in tableFields)  # rows written, buffered ones included
+        self.unflushed = 0  # rows written since the last flush
+        self.bytesWritten = 0  # Bytes of output produced so far, where the sink knows it
+        self.files = []
+
+    def write(self, table, rows):
+        self.buffers[table].extend(rows)
+        self.rows[table] += len(rows)
+        self.unflushed += len(rows)
+
+    def full(self):
+        return self.unflushed >= self.batchRows
+
+    def position(self):
+        return self.rows['articles'], self.rows['locations']
+
+    def flush(self):
+        for table in tableFields:
+            if self.buffers[table]:
+                self._writeRows(table, self.buffers[table])
+                self.buffers[table] = []
+        self.unflushed = 0
+
+    def _writeRows(self, table, rows):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class CSVSink(OutputSink):
+    """
+    articles.csv and locations.csv, byte for byte as unicodecsv wrote them.
+    offsets are the byte offsets to cut the files back to when resuming.
+    """
+    def __init__(self, articlesFile, locationsFile, offsets=None, batchRows=500):
+        OutputSink.__init__(self, batchRows)
+        self.files = [articlesFile, locationsFile]
+        self.streams = {}
+        self.queues = {}
+        self.writers = {}
+        for table, path, offset in zip(tableFields, self.files, offsets or (None, None)):
+            if offset is None:
+                f = open(path, 'wb')
+            else:
+                f = open(path, 'r+b')
+                f.seek(0, os.SEEK_END)
+                if f.tell() < offset:
+                    f.close()
+                    raise ValueError("%s is shorter than the checkpoint (%d bytes)" % (path, offset))
+                f.truncate(offset)
+                f.seek(offset)
+            self.streams[table] = f
+            self.queues[table] = cStringIO.StringIO()
+            self.writers[table] = csv.writer(self.queues[table])
+            if offset is None:
+                self.write(table, [tableFields[table]])
+
+    def write(self, table, rows):
+        # Encode once, straight into the buffer the file is written from
+        queue = self.queues[table]
+        start = queue.tell()
+        self.writers[table].writerows([[s.encode('utf-8') if isinstance(s, unicode) else ('' if s is None else s) for s in row] for row in rows])
+        self.bytesWritten += queue.tell() - start
+        self.rows[table] += len(rows)
+        self.unflushed += len(rows)
+
+    def position(self):
+        return tuple(self.streams[table].tell() + self.queues[table].tell() for table in tableFields)
+
+    def flush(self):
+        for table in tableFields:
+            queue = self.queues[table]
+            if queue.tell():
+                self.streams[table].write(queue.getvalue())
+                queue.seek(0)
+                queue.truncate()
+            self.streams[table].flush()
+        self.unflushed = 0
+
+    def close(self):
+        self.flush()
+        for f in self.streams.values():
+            f.close()
+
+
+class SQLiteSink(OutputSink):
+    """
+    articles and locations tables in an SQLite database. offsets are the row
+    counts to cut the tables back to when resuming.
+    """
+    def __init__(self, path, offsets=None, batchRows=500):
+        OutputSink.__init__(self, batchRows)
+        self.files = [path]
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = unicode
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for table, fields in tableFields.items():
+            if offsets is None:
+                self.db.execute("DROP TABLE IF EXISTS " + table)
+            self.db.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (table, ", ".join(
+                field + (" REAL" if field in realColumns else " INTEGER" if field in booleanColumns else " TEXT") for field in fields)))
+        if offsets is not None:
+            for table, offset in zip(tableFields, offsets):
+                rows = self.db.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]
+                if rows < offset:
+                    raise ValueError("%s has fewer %s than the checkpoint (%d rows)" % (path, table, offset))
+                self.db.execute("DELETE FROM %s WHERE rowid > ?" % table, (offset,))
+                self.rows[table] = offset
+        self.db.commit()
+
+    def _writeRows(self, table, rows):
+        fields = tableFields[table]
+        with self.db:
+            self.db.executemany("INSERT INTO %s VALUES (%s)" % (table, ", ".join("?" * len(fields))),
+                                ([typedValue(field, value) for field, value in zip(fields, row)] for row in rows))
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class ColumnarSink(OutputSink):
+    """
+    Rows stored by column in a zip file: columns.json names the columns of
+    each table, and each flush adds <table>/<batch>.json, an object of
+    column name -> list of values. offsets are the row counts to cut the
+    tables back to when resuming.
+    """
+    def __init__(self, path, offsets=None, batchRows=500):
+        OutputSink.__init__(self, batchRows)
+        self.files = [path]
+        self.path = path
+        self.batches = 0
+        if offsets is None:
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+                z.writestr('columns.json', json.dumps({'format': columnarFormat, 'tables': tableFields}))
+        else:
+            self._cut(offsets)
+
+    def _cut(self, offsets):
+        # Rewrite the file without the batches written after the checkpoint
+        kept = []
+        with zipfile.ZipFile(self.path, 'r') as z:
+            for table, offset in zip(tableFields, offsets):
+                rows = 0
+                for name in _batchNames(z, table):
+                    if rows == offset: break
+                    data = z.read(name)
+                    columns = json.loads(data, object_pairs_hook=OrderedDict)
+                    size = len(columns[tableFields[table][0]])
+                    if rows + size > offset:
+                        # The checkpoint is part way through this batch
+                        data = json.dumps(OrderedDict((field, values[:offset - rows]) for field, values in columns.items()), separators=(',', ':'))
+                        size = offset - rows
+                    rows += size
+                    kept.append((name, data))
+                if rows != offset:
+                    raise ValueError("%s has fewer %s than the checkpoint (%d rows)" % (self.path, table, offset))
+                self.rows[table] = offset
+            columns = z.read('columns.json')
+        tmp = self.path + '.tmp'
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('columns.json', columns)
+            for name, data in kept:
+                z.writestr(name, data)
+        os.remove(self.path)
+        os.rename(tmp, self.path)
+        self.batches = max([int(name.split('/')[1].split('.')[0]) + 1 for name, data in kept] or [0])
+
+    def _writeRows(self, table, rows):
+        fields = tableFields[table]
+        columns = OrderedDict((field, [typedValue(field, row[i]) for row in rows]) for i, field in enumerate(fields))
+        # The zip is closed after every batch, so it stays readable if the run dies
+        with zipfile.ZipFile(self.path, 'a', zipfile.ZIP_DEFLATED) as z:
+            z.writestr("%s/%06d.json" % (table, self.batches), json.dumps(columns, separators=(',', ':')))
+        self.batches += 1
+
+
+def _batchNames(z, table):
+    return sorted(name for name in z.namelist() if name.startswith(table + '/'))
+
+
+def readColumns(path, table):
+    """
+    Load one table of a ColumnarSink file as an OrderedDict of column name
+    -> list of values, in row order.
+    """
+    with zipfile.ZipFile(path, 'r') as z:
+        fields = json.loads(z.read('columns.json'))['tables'][table]
+        columns = OrderedDict((field, []) for field in fields)
+        for name in _batchNames(z, table):
+            batch = json.loads(z.read(name))
+            for field in fields:
+                columns[field].extend(batch[field])
+    return columns
@@ -0,0 +1,205 @@
+#####################################################################################
+## jmap_telemetry.py
+## Live throughput of a jmapParseXML run. A RunTelemetry watches the run's
+## ParseLog counters from a background thread and, every so often,
+##   - prints a compact progress line: articles done (of how many, once they
+##     have been counted), articles, MB and coordinate matches per second over
+##     the last minute, the share of articles with problems, how many articles
+##     are handed out to workers but not yet written (the queue), and the ETA
+##     (only when the articles can be counted without reading them: a run over
+##     tar bundles goes without);
+##   - writes the same numbers, and the counters behind them, to a text file in
+##     the Prometheus exposition format, for node exporter's textfile collector
+##     to scrape. The file is written to a temporary name and renamed, so a
+##     scrape never sees half of it.
+## Rates and the ETA only count this run's articles, not those finished by an
+## interrupted run it resumes.
+#####################################################################################
+
+import os, sys, time, threading
+from collections import deque
+from timeit import default_timer as timer
+
+# Counters exported, as (metric name, ParseLog attribute, help text)
+logCounters = [('jmap_articles_total', 'countArticles', "Articles processed"),
+               ('jmap_articles_geotagged_total', 'countGeoTagged', "Articles coordinates were found in"),
+               ('jmap_articles_written_total', 'countArticlesWritten', "Article rows written"),
+               ('jmap_locations_total', 'locations', "Coordinates found (location rows written)"),
+               ('jmap_articles_cached_total', 'countCached', "Articles replayed from the cache"),
+               ('jmap_bytes_total', 'bytesRead', "Bytes of article XML processed")]
+# Articles with problems, exported as jmap_article_problems_total{kind="..."}
+problemCounters = [('error', 'countErrors'), ('no_authors', 'countNoAuthors'), ('no_text', 'countNoText'),
+                   ('timed_out', 'countTimedOut'), ('stopped', 'countStopped')]
+# Problems that count as errors in the error rate
+errorKinds = ['error', 'no_text', 'stopped']
+
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def labelValue(value):
+    # A Prometheus label value, quoted and escaped
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+class RunTelemetry(object):
+    """
+    Usage example:
+
+    telemetry = RunTelemetry(log, startDir, progressSeconds=10, metricsFile=startDir + '/jmap_metrics.prom')
+    telemetry.start(lambda: countXMLFiles(startDir))  # counted in the background, for the ETA
+    for item in telemetry.dispatching(xmlFiles): ...  # what was handed out, for the queue depth
+    ... write each result, updating the ParseLog ...
+    telemetry.stop()
+    """
+    def __init__(self, log, run='', progressSeconds=10.0, metricsFile='', metricsSeconds=15.0, windowSeconds=60.0, out=None):
+        self.log = log
+        self.run = run  # run label of the exported metrics (the start directory)
+        self.progressSeconds = progressSeconds
+        self.metricsFile = metricsFile
+        self.metricsSeconds = metricsSeconds
+        self.windowSeconds = windowSeconds
+        self.out = out or sys.stderr
+        self.total = None  # Articles this run has to process, once counted (None if they can't be counted cheaply)
+        self.dispatched = 0  # Articles handed out to be parsed
+        self.finished = False
+        self.started = timer()
+        self.startTime = time.time()
+        self.baseline = self._sample()  # counters before this run (when resuming)
+        self.samples = deque([self.baseline])  # (time, articles, bytes, matches) over the window
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        return (timer(), self.log.countArticles, self.log.bytesRead, self.log.locations)
+
+    def dispatching(self, items):
+        # Pass items on, counting them as they are handed out
+        for item in items:
+            self.dispatched += 1
+            yield item
+
+    def start(self, countArticles=None):
+        # Start reporting; countArticles() is called in a thread of its own to set total
+        if not (self.progressSeconds or self.metricsFile):
+            return
+        if countArticles is not None:
+            counter = threading.Thread(target=self._count, args=(countArticles,))
+            counter.daemon = True
+            counter.start()
+        self._thread = threading.Thread(target=self._report)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _count(self, countArticles):
+        try:
+            self.total = countArticles()
+        except Exception:
+            pass  # Left without an ETA
+
+    def _report(self):
+        intervals = [seconds for seconds in (self.progressSeconds, self.metricsFile and self.metricsSeconds) if seconds]
+        tick = min(intervals)
+        lastProgress = lastMetrics = timer()
+        while not self._stopping.wait(tick):
+            now = timer()
+            self.samples.append(self._sample())
+            while len(self.samples) > 2 and now - self.samples[1][0] >= self.windowSeconds:
+                self.samples.popleft()
+            if self.progressSeconds and now - lastProgress >= self.progressSeconds:
+                self.out.write(self.progressLine() + "\n")
+                lastProgress = now
+            if self.metricsFile and now - lastMetrics >= self.metricsSeconds:
+                self.writeMetrics()
+                lastMetrics = now
+
+    def stop(self):
+        # Stop reporting, with a last progress line and metrics file for the finished run
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.finished = True
+        self.samples.append(self._sample())
+        if self.progressSeconds:
+            self.out.write(self.progressLine() + "\n")
+        if self.metricsFile:
+            self.writeMetrics()
+
+    def stats(self):
+        """
+        The numbers reported, as a dict: articles done this run, rates per
+        second over the last window, error rate, queue depth and ETA (None
+        until the articles have been counted, or while nothing is done yet).
+        """
+        log = self.log
+        first, last = self.samples[0], self.samples[-1]
+        span = last[0] - first[0]
+        rate = lambda i: (last[i] - first[i]) / span if span > 0 else 0.0
+        done = log.countArticles - self.baseline[1]
+        errors = sum(getattr(log, attr) for kind, attr in problemCounters if kind in errorKinds)
+        stats = {'done': done,
+                 'total': self.total,
+                 'elapsed': timer() - self.started,
+                 'articles_per_second': rate(1),
+                 'bytes_per_second': rate(2),
+                 'matches_per_second': rate(3),
+                 'error_rate': float(errors) / log.countArticles if log.countArticles else 0.0,
+                 'queue': max(0, self.dispatched - done),
+                 'eta': None}
+        if self.finished:
+            stats['eta'] = 0.0
+        elif self.total is not None and stats['articles_per_second'] > 0:
+            stats['eta'] = max(0, self.total - done) / stats['articles_per_second']
+        return stats
+
+    def progressLine(self):
+        stats = self.stats()
+        if stats['total']:
+            done = "%d/%d %.1f%%" % (stats['done'], stats['total'], 100.0 * stats['done'] / stats['total'])
+        else:
+            done = "%d" % stats['done']
+        eta = formatDuration(stats['eta']) if stats['eta'] is not None else "?"
+        return ("[%s] %.1f articles/s %.2f MB/s %.1f matches/s errors %.1f%% queue %d elapsed %s ETA %s" %
+                (done, stats['articles_per_second'], stats['bytes_per_second'] / 1048576.0, stats['matches_per_second'],
+                 100.0 * stats['error_rate'], stats['queue'], formatDuration(stats['elapsed']), eta))
+
+    def metrics(self):
+        # The metrics file's text
+        labels = '{run=%s}' % labelValue(self.run)
+        stats = self.stats()
+        lines = []
+        def metric(name, kind, help, value, labelSet=labels):
+            if help is not None:
+                lines.extend(["# HELP %s %s." % (name, help), "# TYPE %s %s" % (name, kind)])
+            lines.append("%s%s %s" % (name, labelSet, repr(float(value)) if isinstance(value, float) else value))
+        for name, attr, help in logCounters:
+            metric(name, 'counter', help, getattr(self.log, attr))
+        for i, (kind, attr) in enumerate(problemCounters):
+            metric('jmap_article_problems_total', 'counter', "Articles with problems, by kind" if i == 0 else None,
+                   getattr(self.log, attr), '{run=%s,kind=%s}' % (labelValue(self.run), labelValue(kind)))
+        metric('jmap_articles_per_second', 'gauge', "Articles processed per second over the last %g s" % self.windowSeconds, stats['articles_per_second'])
+        metric('jmap_bytes_per_second', 'gauge', "Bytes of article XML processed per second over the last %g s" % self.windowSeconds, stats['bytes_per_second'])
+        metric('jmap_matches_per_second', 'gauge', "Coordinates found per second over the last %g s" % self.windowSeconds, stats['matches_per_second'])
+        metric('jmap_error_ratio', 'gauge', "Share of the articles processed with an error, no text, or stopped", stats['error_rate'])
+        metric('jmap_queue_depth', 'gauge', "Articles handed out to be parsed but not yet written", stats['queue'])
+        if stats['total'] is not None:
+            metric('jmap_articles_expected', 'gauge', "Articles this run has to process", stats['total'])
+        if stats['eta'] is not None:
+            metric('jmap_eta_seconds', 'gauge', "Estimated seconds until the run is finished", stats['eta'])
+        metric('jmap_run_start_time_seconds', 'gauge', "When the run started, in seconds since the epoch", self.startTime)
+        metric('jmap_run_finished', 'gauge', "1 once the run has finished", int(self.finished))
+        return "\n".join(lines) + "\n"
+
+    def writeMetrics(self):
+        text = self.metrics()
+        tmp = self.metricsFile + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(text)
+            if os.name != 'posix' and os.path.exists(self.metricsFile):
+                os.remove(self.metricsFile)  # rename doesn't replace on Windows
+            os.rename(tmp, self.metricsFile)
+        except (IOError, OSError), e:
+            self.out.write("Can't write metrics file " + self.metricsFile + ": " + str(e) + "\n")
@@ -0,0 +1,241 @@
+#####################################################################################
+## jmap_workers.py
+## Worker pool with a watchdog for jmapParseXML runs. One pathological article
+## (a giant numeric table, a grammar that blows up) can keep a worker busy for
+## ever, or eat all the memory there is, and no except clause in the worker can
+## stop it. A WatchedPool gives every article a wall-clock and a memory budget:
+## the main process keeps an eye on each worker, and when one goes over budget
+## it is killed and a fresh one started in its place, while the other workers
+## carry on with the rest of the corpus.
+##
+## Each worker has its own pipe to the main process, so killing one can't
+## leave a queue shared with the others locked or half written. Workers tell
+## the main process which stage of the pipeline they are in (enterStage) so it
+## can say where an article was stopped. Memory is the worker's resident set
+## size, read from /proc; where there is no /proc only the time limit is kept.
+#####################################################################################
+
+import os, time, signal, select, traceback
+import multiprocessing
+from timeit import default_timer as timer
+
+pollSeconds = 0.05  # How often busy workers are checked against their budgets
+
+stageSlot = None  # In a worker: the shared array the stage it is in is written to
+
+try:
+    pageSize = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):  # Windows
+    pageSize = None
+
+
+def enterStage(name):
+    # Note that the worker has started the stage `name` of the article it is on
+    if stageSlot is not None:
+        stageSlot.value = name[:31]
+
+
+def residentMB(pid):
+    # Resident memory of process pid in MB, or None where it can't be read
+    if pageSize is None:
+        return None
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * pageSize / 1048576.0
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _wait(conns, timeout):
+    # The connections with something to read, waiting up to timeout seconds for one
+    if os.name == 'posix':
+        return select.select(conns, [], [], timeout)[0]
+    stopAt = timer() + timeout
+    while True:
+        ready = [conn for conn in conns if conn.poll()]
+        if ready or timer() >= stopAt:
+            return ready
+        time.sleep(0.005)
+
+
+def _work(conn, slot, initializer, initargs):
+    # A worker's loop: run the tasks sent down conn and send back what they return
+    global stageSlot
+    stageSlot = slot
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        func, item = task
+        slot.value = ''
+        try:
+            reply = ('ok', func(item))
+        except Exception:
+            reply = ('error', traceback.format_exc())
+        conn.send(reply)
+
+
+class Retry(object):
+    # What a WatchedPool's onStop returns to run func(item) in place of the stopped task
+    def __init__(self, func, item):
+        self.func = func
+        self.item = item
+
+
+class WorkerError(Exception):
+    pass
+
+
+class _Worker(object):
+    def __init__(self, process, conn, slot):
+        self.process = process
+        self.conn = conn
+        self.slot = slot
+        self.task = None  # (seq, func, item) being run
+        self.started = None  # when it was handed the task
+
+    def run(self, seq, func, item):
+        self.task = (seq, func, item)
+        self.started = timer()
+        self.conn.send((func, item))
+
+
+class WatchedPool(object):
+    """
+    A pool of worker processes like multiprocessing.Pool, for imap() only,
+    that stops any task going over its budget: timeLimit seconds of wall
+    clock, memoryLimit MB of resident memory (None for no limit). A worker
+    that dies (a crash, or the system running out of memory) counts as
+    stopped too. The stopped worker is killed and replaced, and
+    onStop(item, func, limit, stage) says what to give for the task instead:
+    limit is 'time', 'memory' or 'crash', and stage the last one the worker
+    entered (see enterStage), or 'start'. It returns the result to give, or
+    a Retry to run another function on the item (itself watched the same way).
+
+    Usage example:
+
+    pool = WatchedPool(4, initWorker, (settings,), timeLimit=60, memoryLimit=2048, onStop=stoppedArticle)
+    for result in pool.imap(processArticle, xmlFiles):
+        ...
+    pool.close()
+    pool.join()
+    """
+    def __init__(self, processes, initializer=None, initargs=(), timeLimit=None, memoryLimit=None, onStop=None, maxAhead=None):
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeLimit = timeLimit
+        self.memoryLimit = memoryLimit
+        self.onStop = onStop
+        self.maxAhead = maxAhead or 32 * processes  # Most results held back waiting for an earlier one
+        self.stopped = 0  # Tasks stopped
+        self.restarts = 0  # Workers started in place of another
+        self.workers = [self._start() for i in range(processes)]
+
+    def _start(self):
+        conn, childConn = multiprocessing.Pipe()
+        slot = multiprocessing.RawArray('c', 32)
+        process = multiprocessing.Process(target=_work, args=(childConn, slot, self.initializer, self.initargs))
+        process.daemon = True
+        process.start()
+        childConn.close()
+        return _Worker(process, conn, slot)
+
+    def _kill(self, worker):
+        worker.conn.close()
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join(1)
+            if worker.process.is_alive() and hasattr(signal, 'SIGKILL'):
+                os.kill(worker.process.pid, signal.SIGKILL)
+        worker.process.join()
+
+    def _replace(self, worker):
+        self._kill(worker)
+        self.workers[self.workers.index(worker)] = self._start()
+        self.restarts += 1
+
+    def imap(self, func, items):
+        """
+        func(item) for each of items, run in the workers and given back in
+        the order of items; a task that raises stops the run, as with Pool.
+        """
+        items = iter(items)
+        done = {}  # seq -> what to give for it, once the tasks before it are given
+        retries = []  # (seq, func, item) to run before any new item
+        nextSeq = 0  # next to give back
+        handedOut = 0  # seq of the next new item
+        exhausted = False
+        while True:
+            for worker in self.workers:
+                if worker.task is not None:
+                    continue
+                if retries:
+                    worker.run(*retries.pop(0))
+                elif not exhausted and handedOut - nextSeq < self.maxAhead:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        continue
+                    worker.run(handedOut, func, item)
+                    handedOut += 1
+            while nextSeq in done:
+                yield done.pop(nextSeq)
+                nextSeq += 1
+            if exhausted and nextSeq == handedOut:
+                return
+            busy = [worker for worker in self.workers if worker.task is not None]
+            ready = _wait([worker.conn for worker in busy], pollSeconds)
+            for worker in busy:
+                if worker.conn in ready:
+                    try:
+                        status, value = worker.conn.recv()
+                    except (EOFError, IOError):
+                        self._stopTask(worker, 'crash', done, retries)
+                        continue
+                    if status == 'error':
+                        raise WorkerError("Worker failed on %s:\n%s" % (worker.task[2], value))
+                    done[worker.task[0]] = value
+                    worker.task = None
+                    if self.memoryLimit and residentMB(worker.process.pid) > self.memoryLimit:
+                        # Still holding on to the memory of a big article; start afresh
+                        self._replace(worker)
+                elif worker.process.exitcode is not None:
+                    self._stopTask(worker, 'crash', done, retries)
+                elif self.timeLimit and timer() - worker.started > self.timeLimit:
+                    self._stopTask(worker, 'time', done, retries)
+                elif self.memoryLimit and residentMB(worker.process.pid) > self.memoryLimit:
+                    self._stopTask(worker, 'memory', done, retries)
+
+    def _stopTask(self, worker, limit, done, retries):
+        seq, func, item = worker.task
+        stage = worker.slot.value or 'start'
+        self._replace(worker)
+        self.stopped += 1
+        outcome = self.onStop(item, func, limit, stage)
+        if isinstance(outcome, Retry):
+            retries.append((seq, outcome.func, outcome.item))
+        else:
+            done[seq] = outcome
+
+    def close(self):
+        # Let the workers finish and exit
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except (IOError, OSError):
+                pass
+
+    def join(self):
+        for worker in self.workers:
+            worker.process.join()
+            worker.conn.close()
+
+    def terminate(self):
+        for worker in self.workers:
+            self._kill(worker)